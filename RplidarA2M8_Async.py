@@ -0,0 +1,443 @@
+# asyncio client of the RPlidar A2 M8, for robot processes multiplexing the
+# sensor with other I/O on one event loop instead of dedicating a thread to
+# the blocking RPLidar of RplidarA2M8_RC.py. The MCU link can share the loop
+# through AsyncMcuOutput.
+#
+#   python RplidarA2M8_Async.py --lidar /dev/ttyUSB0 --mcu /dev/ttyACM0
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import struct
+import time
+import numpy as np
+import serial
+
+from RplidarA2M8_RC import (SYNC_BYTE, GET_INFO_BYTE, GET_HEALTH_BYTE,
+                            STOP_BYTE, RESET_BYTE, SET_PWM_BYTE,
+                            DEFAULT_MOTOR_PWM, MAX_MOTOR_PWM, DESCRIPTOR_LEN,
+                            INFO_LEN, HEALTH_LEN, INFO_TYPE, HEALTH_TYPE,
+                            _SCAN_TYPE, _HEALTH_STATUSES, RPLidarException,
+                            McuOutput, ObstacleGrid, ScanFrame,
+                            ZoneClassifier, _check_descriptor, _parse_descriptor,
+                            _parse_health, _parse_info, _payload_request,
+                            _BATCH_DECODERS, _showhex)
+
+
+class AsyncRPLidar(object):
+    '''asyncio client for RPLidar rangefinder scanners. Serial port is
+    opened in non-blocking mode and drained by an event loop reader
+    callback into an internal buffer (transports without file descriptor,
+    like `ReplaySerial`, are polled every `poll` seconds instead), so no
+    call ever blocks the loop. Waits are bounded by `timeout`.'''
+
+    def __init__(self, port, baudrate=115200, timeout=1, logger=None,
+                 poll=0.002):
+        '''Initilize AsyncRPLidar object, `connect` must be awaited before
+        use (or use it as an async context manager).
+
+        Parameters
+        ----------
+        port : str or serial-like object
+            Serial port name to which sensor is connected, or an already
+            opened transport such as `ReplaySerial`
+        baudrate : int, optional
+            Baudrate for serial connection (the default is 115200)
+        timeout : float, optional
+            Maximum time to wait for a response in seconds
+        logger : logging.Logger instance, optional
+            Logger instance, if none is provided new instance is created
+        poll : float, optional
+            Polling interval of the transports without file descriptor
+        '''
+        self._serial = None
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.poll = poll
+        self._motor_speed = DEFAULT_MOTOR_PWM
+        self.scanning = [False, 0, 'normal']
+        self.motor_running = None
+        self.read_time = 0
+        self.error = None
+        self.skipped_bytes = 0
+        self.dropped_bytes = 0
+        self._buffer = bytearray()
+        self._readable = None
+        self._fileno = None
+        self._poller = None
+        if logger is None:
+            logger = logging.getLogger('rplidar')
+        self.logger = logger
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.disconnect()
+
+    async def connect(self):
+        '''Connects to the serial port with the name `self.port` and starts
+        receiving data on the running event loop'''
+        if self._serial is not None:
+            self.disconnect()
+        if hasattr(self.port, 'read'):
+            self._serial = self.port
+        else:
+            try:
+                self._serial = serial.Serial(
+                    self.port, self.baudrate,
+                    parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
+                    timeout=0)
+            except serial.SerialException as err:
+                raise RPLidarException('Failed to connect to the sensor '
+                                       'due to: %s' % err)
+        loop = asyncio.get_running_loop()
+        self._readable = asyncio.Event()
+        self.error = None
+        try:
+            self._fileno = self._serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            self._fileno = None
+        if self._fileno is not None:
+            loop.add_reader(self._fileno, self._on_readable)
+        else:
+            self._poller = loop.create_task(self._poll_loop())
+
+    def disconnect(self):
+        '''Stops receiving data and disconnects from the serial port'''
+        if self._serial is None:
+            return
+        if self._fileno is not None:
+            asyncio.get_running_loop().remove_reader(self._fileno)
+            self._fileno = None
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        self._serial.close()
+        self._serial = None
+
+    def _on_readable(self):
+        '''Moves bytes received by the serial port to the buffer'''
+        try:
+            data = self._serial.read(max(self._serial.inWaiting(), 1))
+        except (OSError, serial.SerialException, RPLidarException) as err:
+            self.logger.error('Failed to read from the sensor: %s', err)
+            self.error = err
+            if self._fileno is not None:
+                asyncio.get_running_loop().remove_reader(self._fileno)
+                self._fileno = None
+            self._readable.set()
+            return
+        if data:
+            self._buffer += data
+            self.read_time = time.time()
+            self._readable.set()
+
+    async def _poll_loop(self):
+        '''Polls transports without file descriptor'''
+        while self.error is None:
+            try:
+                waiting = self._serial.inWaiting()
+                if not waiting:
+                    # doesn't block, but raises once a capture is exhausted
+                    self._serial.read(0)
+            except (OSError, serial.SerialException,
+                    RPLidarException) as err:
+                self.logger.error('Failed to read from the sensor: %s', err)
+                self.error = err
+                self._readable.set()
+                break
+            if waiting:
+                self._on_readable()
+            await asyncio.sleep(self.poll)
+
+    async def _wait(self, size):
+        '''Waits until the buffer holds at least `size` bytes, returns False
+        if `timeout` expired first'''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while len(self._buffer) < size:
+            if self.error is not None:
+                raise RPLidarException('Failed to read from the sensor: %s'
+                                       % self.error)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._readable.clear()
+            try:
+                await asyncio.wait_for(self._readable.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def _read(self, size):
+        '''Reads `size` bytes, raises `RPLidarException` on timeout'''
+        if not await self._wait(size):
+            raise RPLidarException('Timeout waiting for %d bytes' % size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _send_payload_cmd(self, cmd, payload):
+        '''Sends `cmd` command with `payload` to the sensor'''
+        req = _payload_request(cmd, payload)
+        self._serial.write(req)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Command sent: %s', _showhex(req))
+
+    def _send_cmd(self, cmd):
+        '''Sends `cmd` command to the sensor'''
+        req = SYNC_BYTE + cmd
+        self._serial.write(req)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Command sent: %s', _showhex(req))
+
+    async def _read_descriptor(self):
+        '''Reads descriptor packet'''
+        descriptor = await self._read(DESCRIPTOR_LEN)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Received descriptor: %s', _showhex(descriptor))
+        return _parse_descriptor(descriptor)
+
+    def _set_dtr(self, value):
+        '''Sets DTR line which drives A1 motor, see `RPLidar._set_dtr`'''
+        try:
+            self._serial.setDTR(value)
+        except (OSError, serial.SerialException) as err:
+            self.logger.debug('Failed to set DTR: %s', err)
+
+    def _set_pwm(self, pwm):
+        self._send_payload_cmd(SET_PWM_BYTE, struct.pack('<H', pwm))
+
+    @property
+    def motor_speed(self):
+        return self._motor_speed
+
+    @motor_speed.setter
+    def motor_speed(self, pwm):
+        assert(0 <= pwm <= MAX_MOTOR_PWM)
+        self._motor_speed = pwm
+        if self.motor_running:
+            self._set_pwm(self._motor_speed)
+
+    async def start_motor(self):
+        '''Starts sensor motor'''
+        self.logger.info('Starting motor')
+        self._set_dtr(False)
+        self._set_pwm(self._motor_speed)
+        self.motor_running = True
+
+    async def stop_motor(self):
+        '''Stops sensor motor'''
+        self.logger.info('Stoping motor')
+        self._set_pwm(0)
+        await asyncio.sleep(.001)
+        self._set_dtr(True)
+        self.motor_running = False
+
+    async def get_info(self):
+        '''Get device information, see `RPLidar.get_info`'''
+        if self._buffer:
+            return ('Data in buffer, you can\'t have info ! '
+                    'Run clean_input() to emptied the buffer.')
+        self._send_cmd(GET_INFO_BYTE)
+        _check_descriptor(await self._read_descriptor(), INFO_LEN, True,
+                          INFO_TYPE)
+        return _parse_info(await self._read(INFO_LEN))
+
+    async def get_health(self):
+        '''Get device health state, see `RPLidar.get_health`'''
+        if self._buffer:
+            return ('Data in buffer, you can\'t have info ! '
+                    'Run clean_input() to emptied the buffer.')
+        self.logger.info('Asking for health')
+        self._send_cmd(GET_HEALTH_BYTE)
+        _check_descriptor(await self._read_descriptor(), HEALTH_LEN, True,
+                          HEALTH_TYPE)
+        return _parse_health(await self._read(HEALTH_LEN))
+
+    def clean_input(self):
+        '''Clean input buffer by dropping all received data'''
+        if self.scanning[0]:
+            return 'Cleanning not allowed during scanning process active !'
+        self._serial.flushInput()
+        del self._buffer[:]
+
+    async def stop(self):
+        '''Stops scanning process, disables laser diode and the measurement
+        system, moves sensor to the idle state.'''
+        self.logger.info('Stopping scanning')
+        self._send_cmd(STOP_BYTE)
+        await asyncio.sleep(.1)
+        self.scanning[0] = False
+        self.clean_input()
+
+    async def start(self, scan_type='normal'):
+        '''Start the scanning process, see `RPLidar.start`. Scan modes are
+        not discovered, only normal, force and express scans can be
+        started.'''
+        if self.scanning[0]:
+            return 'Scanning already running !'
+        status, error_code = await self.get_health()
+        self.logger.debug('Health status: %s [%d]', status, error_code)
+        if status == _HEALTH_STATUSES[2]:
+            self.logger.warning('Trying to reset sensor due to the error. '
+                                'Error code: %d', error_code)
+            await self.reset()
+            status, error_code = await self.get_health()
+            if status == _HEALTH_STATUSES[2]:
+                raise RPLidarException('RPLidar hardware failure. '
+                                       'Error code: %d' % error_code)
+        elif status == _HEALTH_STATUSES[1]:
+            self.logger.warning('Warning sensor status detected! '
+                                'Error code: %d', error_code)
+
+        cmd = _SCAN_TYPE[scan_type]['byte']
+        self.logger.info('starting scan process in %s mode', scan_type)
+        if scan_type == 'express':
+            self._send_payload_cmd(cmd, b'\x00\x00\x00\x00\x00')
+        else:
+            self._send_cmd(cmd)
+
+        dsize = _SCAN_TYPE[scan_type]['size']
+        _check_descriptor(await self._read_descriptor(), dsize, False,
+                          _SCAN_TYPE[scan_type]['response'])
+        self.scanning = [True, dsize, scan_type]
+
+    async def reset(self):
+        '''Resets sensor core, reverting it to a similar state as it has
+        just been powered up.'''
+        self.logger.info('Resetting the sensor')
+        self._send_cmd(RESET_BYTE)
+        await asyncio.sleep(2)
+        self.clean_input()
+
+    async def iter_measure_batches(self, scan_type='normal',
+                                   max_buf_meas=3000):
+        '''Asynchronously iterate over batches of measures, see
+        `RPLidar.iter_measure_batches`. Every batch holds all the measures
+        received since the previous one.'''
+        await self.start_motor()
+        if not self.scanning[0]:
+            await self.start(scan_type)
+        while True:
+            dsize = self.scanning[1]
+            if max_buf_meas and len(self._buffer) > max_buf_meas:
+                self.logger.warning(
+                    'Too many bytes in the input buffer: %d/%d. '
+                    'Cleaning buffer...',
+                    len(self._buffer), max_buf_meas)
+                # dropped without restarting the scan, decoders resync
+                self.dropped_bytes += len(self._buffer)
+                del self._buffer[:]
+
+            # like a serial read, wait for a packet worth of new bytes
+            await self._wait(len(self._buffer) + dsize)
+            # decoded from a view, which must be released before the
+            # buffer is trimmed
+            with memoryview(self._buffer) as raw:
+                measures, consumed, skipped = _BATCH_DECODERS[
+                    self.scanning[2]](raw)
+            if skipped:
+                self.skipped_bytes += skipped
+                self.logger.warning('Skipped %d corrupted bytes', skipped)
+            del self._buffer[:consumed]
+            measures['timestamp'] = self.read_time
+            yield measures
+
+    async def iter_frames(self, scan_type='normal', max_buf_meas=3000,
+                          bins=720):
+        '''Asynchronously iterate over full revolutions, see
+        `RPLidar.iter_frames`'''
+        frames = (ScanFrame(bins), ScanFrame(bins))
+        frame = None
+        revolution = 0
+        async for measures in self.iter_measure_batches(scan_type,
+                                                        max_buf_meas):
+            prev = 0
+            for start in np.flatnonzero(measures['new_scan']):
+                if frame is not None:
+                    frame.add(measures[prev:start])
+                    frame.finish()
+                    yield frame
+                frame = frames[revolution % 2]
+                frame.clear(revolution)
+                revolution += 1
+                prev = start
+            if frame is not None:
+                frame.add(measures[prev:])
+
+
+class AsyncMcuOutput(McuOutput):
+    '''`McuOutput` paced by a task of the event loop instead of the writer
+    thread. Serial writes and statistics files are blocking, so every tick
+    runs in a single worker thread of an executor, which keeps the loop
+    free and the writes in order.'''
+
+    async def run(self):
+        '''Flushes queued bytes every `period` until cancelled'''
+        loop = asyncio.get_running_loop()
+        last_report = time.time()
+        self._started = time.time()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='mcu-writer')
+        try:
+            while True:
+                await asyncio.sleep(self.period)
+                last_report = await loop.run_in_executor(
+                    executor, self._tick, last_report)
+        finally:
+            # queued behind a tick cancelled while running
+            await asyncio.shield(loop.run_in_executor(executor, self.flush))
+            executor.shutdown(wait=False)
+
+
+async def run(lidar_port, mcu_port=None, scan_type='normal'):
+    '''Runs collision avoidance pipeline: every batch of measures is slotted
+    into the CA zones and their bytes are sent to the MCU'''
+    obstacle_map = ObstacleGrid(1000., 8000., 4)
+    zones = ZoneClassifier()
+    mcu = writer = None
+    if mcu_port is not None:
+        mcu = AsyncMcuOutput(serial.Serial(mcu_port, 115200, timeout=0.1))
+        writer = asyncio.get_running_loop().create_task(mcu.run())
+    try:
+        async with AsyncRPLidar(lidar_port) as lidar:
+            try:
+                async for measures in lidar.iter_measure_batches(scan_type):
+                    zones.slot(measures, obstacle_map, mcu)
+                    if measures['new_scan'].any():
+                        obstacle_map.decay()
+            finally:
+                await lidar.stop()
+                await lidar.stop_motor()
+    finally:
+        if writer is not None:
+            # the writer sends the queued bytes once cancelled
+            writer.cancel()
+            try:
+                await writer
+            except asyncio.CancelledError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Collision avoidance pipeline on asyncio')
+    parser.add_argument('--lidar', default='/dev/ttyUSB0')
+    parser.add_argument('--mcu', help='MCU serial port, none by default')
+    parser.add_argument('--scan-type', default='normal',
+                        choices=('normal', 'force', 'express'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run(args.lidar, args.mcu, args.scan_type))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,655 @@
+# Benchmark of the decode -> classify -> emit pipeline of RplidarA2M8_RC.py
+# on fixed byte streams (synthetic, or recorded with RPLidar(record=...)).
+#
+#   python RplidarA2M8_Bench.py --save            # store baseline
+#   python RplidarA2M8_Bench.py                   # compare, exit 1 on regression
+#   python RplidarA2M8_Bench.py --capture run.rplcap --stages decode
+#
+# Every stage reports points/s, per call latency percentiles and bytes
+# allocated per revolution (sum over calls of the memory peak growth traced
+# during the call, i.e. transient allocations). To compare a new decoder or
+# classifier, add a stage running it on the same stream. The "baseline"
+# stages run frozen copies of the original per-point decoders and
+# classifier, next to the stages of the code that replaced them.
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from collections import namedtuple
+
+import RplidarA2M8_RC as rc
+from RplidarA2M8_RC import (idx_AngleDeg, idx_DistMm, obstacleMap_CenterRow,
+                            obstacleMap_CenterCol)
+from RplidarA2M8_Sim import (Room, descriptor, encode_scan, encode_express,
+                             encode_ultra, encode_dense)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_baseline.json')
+POINTS_PER_REV = 400
+# bytes per read of the batch stages, ~25 ms of data at 4000 points/s
+CHUNK = 500
+
+
+class NullSerial(object):
+    '''MCU port discarding everything'''
+
+    def write(self, data):
+        return len(data)
+
+
+# Streams
+# ------------------------------------------------
+
+def synthetic_streams(revolutions, seed=0):
+    '''Builds normal, express, ultra and dense byte streams of a synthetic
+    room'''
+    room = Room(obstacles=3, rng=np.random.RandomState(seed))
+    count = revolutions * POINTS_PER_REV
+    step = 360. / POINTS_PER_REV
+    angle = step * np.arange(1, count + 1)
+    new_scan = np.diff(np.floor(np.r_[0, angle] / 360.)) > 0
+    angle %= 360
+    distance = room.ranges(angle)
+    quality = np.full(count, 47, dtype=np.uint8)
+    normal = encode_scan(new_scan, quality, angle, distance)
+    packets = count // 32
+    express = encode_express(
+        new_scan[:packets * 32].reshape(packets, 32).any(axis=1),
+        (angle[::32][:packets] - step) % 360,
+        distance[:packets * 32].reshape(packets, 32))
+    capsules = []
+    for block, encode in ((96, encode_ultra), (40, encode_dense)):
+        packets = count // block
+        capsules.append(encode(
+            new_scan[:packets * block].reshape(packets, block).any(axis=1),
+            angle[::block][:packets],
+            distance[:packets * block].reshape(packets, block)))
+    return (normal, express) + tuple(capsules)
+
+
+def capture_stream(path):
+    '''Returns all the bytes read in a capture'''
+    replay = rc.ReplaySerial(path)
+    return replay._data
+
+
+def write_capture(path, stream, scan_type):
+    '''Writes capture of a scanning session streaming `stream`, which can be
+    replayed by RPLidar through ReplaySerial'''
+    scan = rc._SCAN_TYPE[scan_type]
+    records = [
+        (rc.CAPTURE_WRITE, b'pwm'),
+        (rc.CAPTURE_WRITE, rc.SYNC_BYTE + rc.GET_HEALTH_BYTE),
+        (rc.CAPTURE_READ, descriptor(rc.HEALTH_LEN, rc.HEALTH_TYPE)),
+        (rc.CAPTURE_READ, b'\x00\x00\x00'),
+        (rc.CAPTURE_WRITE, rc.SYNC_BYTE + scan['byte']),
+        (rc.CAPTURE_READ, descriptor(scan['size'], scan['response'], False)),
+    ]
+    records += [(rc.CAPTURE_READ, stream[i:i + CHUNK])
+                for i in range(0, len(stream), CHUNK)]
+    with open(path, 'wb') as f:
+        f.write(rc.CAPTURE_MAGIC)
+        for direction, data in records:
+            f.write(rc.CAPTURE_RECORD.pack(0, direction, len(data)) + data)
+
+
+def decode(stream):
+    '''Decodes normal stream into measures'''
+    return rc._process_scan_batch(stream)[0]
+
+
+# Baseline: frozen copies of the per-point decoders and of the if/elif
+# classifier of the original RplidarA2M8_RC.py (commit dff09f0), so that
+# the stages running them report the cost the rewrites are measured against.
+# They were only renamed and stripped of their commented out code, and use
+# the globals below, as the original did.
+# ------------------------------------------------
+
+measurement = None
+obstacleMap = None
+ser = None
+
+
+def baseline_b2i(byte):
+    '''Converts byte to integer (for Python 2 compatability)'''
+    return byte if int(sys.version[0]) == 3 else ord(byte)
+
+def baseline_process_scan(raw):
+    '''Processes input raw data and returns measurement data'''
+    new_scan = bool(baseline_b2i(raw[0]) & 0b1)
+    inversed_new_scan = bool((baseline_b2i(raw[0]) >> 1) & 0b1)
+    quality = baseline_b2i(raw[0]) >> 2
+    if new_scan == inversed_new_scan:
+        raise rc.RPLidarException('New scan flags mismatch')
+    check_bit = baseline_b2i(raw[1]) & 0b1
+    if check_bit != 1:
+        raise rc.RPLidarException('Check bit not equal to 1')
+    angle = ((baseline_b2i(raw[1]) >> 1) + (baseline_b2i(raw[2]) << 7)) / 64.
+    distance = (baseline_b2i(raw[3]) + (baseline_b2i(raw[4]) << 8)) / 4.
+    return new_scan, quality, angle, distance
+
+
+def baseline_process_express_scan(data, new_angle, trame):
+    new_scan = (new_angle < data.start_angle) & (trame == 1)
+    angle = (data.start_angle + (
+            (new_angle - data.start_angle) % 360
+            )/32*trame - data.angle[trame-1]) % 360
+    distance = data.distance[trame-1]
+    return new_scan, None, angle, distance
+
+
+class BaselineExpressPacket(namedtuple('express_packet',
+                                       'distance angle new_scan start_angle')):
+    sync1 = 0xa
+    sync2 = 0x5
+    sign = {0: 1, 1: -1}
+
+    @classmethod
+    def from_string(cls, data):
+        packet = bytearray(data)
+
+        if (packet[0] >> 4) != cls.sync1 or (packet[1] >> 4) != cls.sync2:
+            raise ValueError('try to parse corrupted data ({})'.format(packet))
+
+        checksum = 0
+        for b in packet[2:]:
+            checksum ^= b
+        if checksum != (packet[0] & 0b00001111) + ((
+                        packet[1] & 0b00001111) << 4):
+            raise ValueError('Invalid checksum ({})'.format(packet))
+
+        new_scan = packet[3] >> 7
+        start_angle = (packet[2] + ((packet[3] & 0b01111111) << 8)) / 64
+
+        d = a = ()
+        for i in range(0,80,5):
+            d += ((packet[i+4] >> 2) + (packet[i+5] << 6),)
+            a += (((packet[i+8] & 0b00001111) + ((
+                    packet[i+4] & 0b00000001) << 4))/8*cls.sign[(
+                     packet[i+4] & 0b00000010) >> 1],)
+            d += ((packet[i+6] >> 2) + (packet[i+7] << 6),)
+            a += (((packet[i+8] >> 4) + (
+                (packet[i+6] & 0b00000001) << 4))/8*cls.sign[(
+                    packet[i+6] & 0b00000010) >> 1],)
+        return cls(d, a, new_scan, start_angle)
+
+
+def baseline_CA_SlotFront():
+    # slot measurements into CA Front
+    if(((measurement[idx_AngleDeg] >350.0) and (measurement[idx_AngleDeg] < 359.99999)) or ((measurement[idx_AngleDeg] >0.0) and (measurement[idx_AngleDeg] < 10.0))):
+        # slot measurement into obstacleMap
+        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):
+            if(measurement[idx_DistMm]<1000):
+                obstacleMap[7][obstacleMap_CenterCol] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x15")
+            elif(measurement[idx_DistMm]<2000):
+                obstacleMap[6][obstacleMap_CenterCol] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x16")
+            elif(measurement[idx_DistMm]<3000):
+                obstacleMap[5][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<4000):
+                obstacleMap[4][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<5000):
+                obstacleMap[3][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<6000):
+                obstacleMap[2][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<7000):
+                obstacleMap[1][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<8000):
+                obstacleMap[0][obstacleMap_CenterCol] = measurement[idx_DistMm]
+
+
+def baseline_CA_SlotBack():
+    # slot measurements into CA Back
+    if((measurement[idx_AngleDeg] >172.0) and (measurement[idx_AngleDeg] < 188.0)):
+        # slot measurement into obstacleMap
+        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):
+            if(measurement[idx_DistMm]<1000):
+                obstacleMap[9][obstacleMap_CenterCol] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x51")
+            elif(measurement[idx_DistMm]<2000):
+                obstacleMap[10][obstacleMap_CenterCol] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x52")
+            elif (measurement[idx_DistMm]<3000):
+                obstacleMap[11][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<4000):
+                obstacleMap[12][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<5000):
+                obstacleMap[13][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<6000):
+                obstacleMap[14][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<7000):
+                obstacleMap[15][obstacleMap_CenterCol] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<8000):
+                obstacleMap[16][obstacleMap_CenterCol] = measurement[idx_DistMm]
+
+
+def baseline_CA_SlotLeft():
+    # slot measurements into CA Left
+    if((measurement[idx_AngleDeg] >260.0) and (measurement[idx_AngleDeg] < 280.0)) :
+        # slot measurement into obstacleMap
+        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):
+            if(measurement[idx_DistMm]<1000):
+                obstacleMap[obstacleMap_CenterRow][7] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x29")
+            elif(measurement[idx_DistMm]<2000):
+                obstacleMap[obstacleMap_CenterRow][6] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x2A")
+            elif (measurement[idx_DistMm]<3000):
+                obstacleMap[obstacleMap_CenterRow][5] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<4000):
+                obstacleMap[obstacleMap_CenterRow][4] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<5000):
+                obstacleMap[obstacleMap_CenterRow][3] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<6000):
+                obstacleMap[obstacleMap_CenterRow][2] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<7000):
+                obstacleMap[obstacleMap_CenterRow][1] = measurement[idx_DistMm]
+            elif (measurement[idx_DistMm]<8000):
+                obstacleMap[obstacleMap_CenterRow][0] = measurement[idx_DistMm]
+
+
+def baseline_CA_SlotRight():
+    # slot measurements into CA Right
+    if((measurement[idx_AngleDeg] >80.0) and (measurement[idx_AngleDeg] < 100.0)):
+        # slot measurement into obstacleMap
+        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):
+            if(measurement[idx_DistMm]<1000):
+                obstacleMap[obstacleMap_CenterRow][9] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x3D")
+            elif(measurement[idx_DistMm]<2000):
+                obstacleMap[obstacleMap_CenterRow][10] = measurement[idx_DistMm]
+                if ser is not None:
+                    ser.write(b"\x3E")
+            elif(measurement[idx_DistMm]<3000):
+                obstacleMap[obstacleMap_CenterRow][11] = measurement[idx_DistMm]
+            elif(measurement[idx_DistMm]<4000):
+                obstacleMap[obstacleMap_CenterRow][12] = measurement[idx_DistMm]
+            elif(measurement[idx_DistMm]<5000):
+                obstacleMap[obstacleMap_CenterRow][13] = measurement[idx_DistMm]
+            elif(measurement[idx_DistMm]<6000):
+                obstacleMap[obstacleMap_CenterRow][14] = measurement[idx_DistMm]
+            elif(measurement[idx_DistMm]<7000):
+                obstacleMap[obstacleMap_CenterRow][15] = measurement[idx_DistMm]
+            elif(measurement[idx_DistMm]<8000):
+                obstacleMap[obstacleMap_CenterRow][16] = measurement[idx_DistMm]
+
+
+# Stages: each one is a generator of calls, returning number of points
+# ------------------------------------------------
+
+def stage_process_scan(streams):
+    stream = streams['normal']
+    for i in range(0, len(stream) - 4, 5):
+        raw = stream[i:i + 5]
+        yield lambda raw=raw: (rc._process_scan(raw), 1)[1]
+
+
+def stage_baseline_process_scan(streams):
+    stream = streams['normal']
+    for i in range(0, len(stream) - 4, 5):
+        raw = stream[i:i + 5]
+        yield lambda raw=raw: (baseline_process_scan(raw), 1)[1]
+
+
+def stage_process_scan_batch(streams):
+    stream = streams['normal']
+    for i in range(0, len(stream), CHUNK):
+        raw = stream[i:i + CHUNK]
+        yield lambda raw=raw: len(rc._process_scan_batch(raw)[0])
+
+
+def stage_express_from_string(streams):
+    stream = streams['express']
+    size = rc._SCAN_TYPE['express']['size']
+
+    def call(old, new):
+        packet = rc.ExpressPacket.from_string(new)
+        for trame in range(1, 33):
+            rc._process_express_scan(old, packet.start_angle, trame)
+        return packet
+
+    state = [rc.ExpressPacket.from_string(stream[:size])]
+    for i in range(size, len(stream) - size + 1, size):
+        raw = stream[i:i + size]
+
+        def run(raw=raw):
+            state[0] = call(state[0], raw)
+            return 32
+        yield run
+
+
+def stage_baseline_express_from_string(streams):
+    stream = streams['express']
+    size = rc._SCAN_TYPE['express']['size']
+
+    def call(old, new):
+        packet = BaselineExpressPacket.from_string(new)
+        for trame in range(1, 33):
+            baseline_process_express_scan(old, packet.start_angle, trame)
+        return packet
+
+    state = [BaselineExpressPacket.from_string(stream[:size])]
+    for i in range(size, len(stream) - size + 1, size):
+        raw = stream[i:i + size]
+
+        def run(raw=raw):
+            state[0] = call(state[0], raw)
+            return 32
+        yield run
+
+
+def _capsule_batch_stage(streams, scan_type):
+    stream = streams[scan_type]
+    chunk = 6 * rc._SCAN_TYPE[scan_type]['size']
+    decoder = rc._BATCH_DECODERS[scan_type]
+    pending = [b'']
+    for i in range(0, len(stream), chunk):
+        raw = stream[i:i + chunk]
+
+        def run(raw=raw):
+            data = pending[0] + raw
+            measures, consumed, _ = decoder(data)
+            pending[0] = data[consumed:]
+            return len(measures)
+        yield run
+
+
+def stage_process_express_batch(streams):
+    return _capsule_batch_stage(streams, 'express')
+
+
+def stage_process_ultra_batch(streams):
+    return _capsule_batch_stage(streams, 'ultra')
+
+
+def stage_process_dense_batch(streams):
+    return _capsule_batch_stage(streams, 'dense')
+
+
+def _replay_lidar(streams):
+    '''Returns RPLidar replaying the normal stream'''
+    fd, path = tempfile.mkstemp(suffix='.rplcap')
+    os.close(fd)
+    write_capture(path, streams['normal'], 'normal')
+    lidar = rc.RPLidar(rc.ReplaySerial(path))
+    os.remove(path)
+    return lidar
+
+
+def _lidar_stage(streams, method):
+    iterator = getattr(_replay_lidar(streams), method)()
+
+    def run():
+        try:
+            item = next(iterator)
+        except rc.RPLidarException:
+            return 0
+        return item.count if method == 'iter_frames' else len(item)
+    for _ in range(streams['revolutions'] - 1):
+        yield run
+
+
+def stage_iter_scans(streams):
+    return _lidar_stage(streams, 'iter_scans')
+
+
+def stage_iter_frames(streams):
+    return _lidar_stage(streams, 'iter_frames')
+
+
+def _setup_ca():
+    rc.obstacleMap = rc.ObstacleGrid(1000., 8000., rc.obstacleMap_Hold)
+    rc.caZones = rc.ZoneClassifier()
+    rc.mcu = NullSerial()
+    rc.mcuProtocol = 'bytes'
+
+
+def stage_baseline_ca_slot_sectors(streams):
+    global obstacleMap, ser
+    obstacleMap = np.zeros((17, 17), int)
+    ser = NullSerial()
+    for measure in decode(streams['normal']).tolist():
+        def run(measure=measure):
+            global measurement
+            measurement = (measure[0], measure[1], measure[2], measure[4])
+            baseline_CA_SlotFront()
+            baseline_CA_SlotLeft()
+            baseline_CA_SlotRight()
+            baseline_CA_SlotBack()
+            return 1
+        yield run
+
+
+def stage_ca_slot_sectors(streams):
+    _setup_ca()
+    for measure in decode(streams['normal']).tolist():
+        def run(measure=measure):
+            rc.measurement = (measure[0], measure[1], measure[2], measure[4])
+            rc.CA_SlotFront()
+            rc.CA_SlotLeft()
+            rc.CA_SlotRight()
+            rc.CA_SlotBack()
+            return 1
+        yield run
+
+
+def stage_ca_slot(streams):
+    _setup_ca()
+    for measure in decode(streams['normal']).tolist():
+        def run(measure=measure):
+            rc.measurement = (measure[0], measure[1], measure[2], measure[4])
+            rc.CA_Slot()
+            return 1
+        yield run
+
+
+def stage_zone_classifier(streams):
+    _setup_ca()
+    measures = decode(streams['normal'])
+    for rev in np.array_split(measures, streams['revolutions']):
+        def run(rev=rev):
+            rc.caZones.slot(rev, rc.obstacleMap, rc.mcu)
+            rc.obstacleMap.decay()
+            return len(rev)
+        yield run
+
+
+def stage_main_gate(streams):
+    # main loop classifying the measure arriving every 25 ms
+    _setup_ca()
+    iterator = _replay_lidar(streams).iter_measures()
+    timer = [time.time()]
+
+    def run():
+        try:
+            rc.measurement = next(iterator)
+        except (rc.RPLidarException, StopIteration):
+            return 0
+        now = time.time()
+        if now - timer[0] > 0.025:
+            rc.CA_Slot()
+            rc.obstacleMap.decay()
+            timer[0] = now
+        return 1
+    for _ in range(len(decode(streams['normal']))):
+        yield run
+
+
+def stage_main_windows(streams):
+    # main loop classifying every measure, one window per revolution
+    _setup_ca()
+    iterator = _replay_lidar(streams).iter_windows()
+
+    def run():
+        try:
+            measures = next(iterator)
+        except (rc.RPLidarException, StopIteration):
+            return 0
+        rc.caZones.slot(measures, rc.obstacleMap, rc.mcu)
+        rc.obstacleMap.decay()
+        return len(measures)
+    for _ in range(streams['revolutions'] - 1):
+        yield run
+
+
+def stage_main_sectors(streams):
+    # main loop classifying every sector as soon as it was swept
+    _setup_ca()
+    iterator = _replay_lidar(streams).iter_measure_batches()
+    sweep = rc.SectorSweep(rc.caZones)
+
+    def run():
+        try:
+            measures = next(iterator)
+        except (rc.RPLidarException, StopIteration):
+            return 0
+        for _, swept in sweep.split(measures):
+            rc.caZones.slot(swept, rc.obstacleMap, rc.mcu)
+        if measures['new_scan'].any():
+            rc.obstacleMap.decay()
+        return len(measures)
+    for _ in range(len(streams['normal']) // CHUNK):
+        yield run
+
+
+STAGES = [
+    ('decode/normal/baseline _process_scan', stage_baseline_process_scan),
+    ('decode/normal/_process_scan', stage_process_scan),
+    ('decode/normal/_process_scan_batch', stage_process_scan_batch),
+    ('decode/express/baseline ExpressPacket.from_string',
+     stage_baseline_express_from_string),
+    ('decode/express/ExpressPacket.from_string', stage_express_from_string),
+    ('decode/express/_process_express_batch', stage_process_express_batch),
+    ('decode/ultra/_process_ultra_batch', stage_process_ultra_batch),
+    ('decode/dense/_process_dense_batch', stage_process_dense_batch),
+    ('scans/iter_scans', stage_iter_scans),
+    ('scans/iter_frames', stage_iter_frames),
+    ('classify/baseline CA_SlotFront+Left+Right+Back',
+     stage_baseline_ca_slot_sectors),
+    ('classify/CA_SlotFront+Left+Right+Back', stage_ca_slot_sectors),
+    ('classify/CA_Slot', stage_ca_slot),
+    ('classify/ZoneClassifier.slot', stage_zone_classifier),
+    ('main/iter_measures+25ms gate', stage_main_gate),
+    ('main/iter_windows+ZoneClassifier.slot', stage_main_windows),
+    ('main/iter_measure_batches+SectorSweep', stage_main_sectors),
+]
+
+
+# Runner
+# ------------------------------------------------
+
+def time_stage(stage, streams):
+    '''Runs stage once, returns number of points and latency of each call'''
+    calls = list(stage(streams))
+    latency = np.empty(len(calls))
+    points = 0
+    for i, call in enumerate(calls):
+        start = time.perf_counter()
+        points += call()
+        latency[i] = time.perf_counter() - start
+    return points, latency
+
+
+def run_stage(stage, streams, repeat=3):
+    '''Runs stage, returns report of its fastest run'''
+    points, latency = min((time_stage(stage, streams) for _ in range(repeat)),
+                          key=lambda run: run[1].sum())
+    total = latency.sum()
+
+    # second pass with allocation tracing, which slows everything down
+    calls = list(stage(streams))
+    allocated = 0
+    tracemalloc.start()
+    for call in calls:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call()
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    return {
+        'points_per_sec': points / total if total else 0.,
+        'p50_us': float(np.percentile(latency, 50) * 1e6),
+        'p99_us': float(np.percentile(latency, 99) * 1e6),
+        'max_us': float(latency.max() * 1e6),
+        'alloc_kib_per_rev': allocated / 1024. / streams['revolutions'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the RplidarA2M8_RC.py pipeline')
+    parser.add_argument('--revolutions', type=int, default=50,
+                        help='revolutions of the synthetic stream')
+    parser.add_argument('--capture', help='use normal scan bytes of a '
+                        'capture instead of the synthetic stream')
+    parser.add_argument('--stages', default='',
+                        help='regular expression selecting stages')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each stage, the fastest is reported')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed points/s drop against the baseline')
+    args = parser.parse_args()
+
+    normal, express, ultra, dense = synthetic_streams(args.revolutions)
+    streams = {'normal': normal, 'express': express, 'ultra': ultra,
+               'dense': dense, 'revolutions': args.revolutions}
+    if args.capture:
+        streams['normal'] = capture_stream(args.capture)
+        streams['revolutions'] = max(int(decode(streams['normal'])
+                                         ['new_scan'].sum()), 1)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('{:50} {:>12} {:>9} {:>9} {:>10} {:>11}'.format(
+        'stage', 'points/s', 'p50 us', 'p99 us', 'max us', 'KiB/rev'))
+    for name, stage in STAGES:
+        if not re.search(args.stages, name):
+            continue
+        report = run_stage(stage, streams, args.repeat)
+        results[name] = report
+        flag = ''
+        if name in baseline:
+            ratio = report['points_per_sec'] / baseline[name]['points_per_sec']
+            flag = ' {:+.0%}'.format(ratio - 1)
+            if ratio < 1 - args.tolerance:
+                regressions.append(name)
+                flag += ' REGRESSION'
+        print('{:50} {points_per_sec:12.0f} {p50_us:9.1f} {p99_us:9.1f} '
+              '{max_us:10.1f} {alloc_kib_per_rev:11.1f}{flag}'.format(
+                  name, flag=flag, **report))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
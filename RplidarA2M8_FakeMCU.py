@@ -0,0 +1,42 @@
+# Fake Arduino MCU on a pseudo-terminal, decodes and prints the obstacle
+# frames sent by RplidarA2M8_RC.py (mcuProtocol = 'frame').
+# Set arduinoPort in RplidarA2M8_RC.py to the printed device to use it.
+
+import os
+import tty
+
+from RplidarA2M8_RC import CA_SECTORS, decode_obstacle_frames
+
+
+def describe(frame):
+    # names of the occupied zones, e.g. Front1 Back8
+    zones = []
+    for i, sector in enumerate(CA_SECTORS):
+        for zone in range(8):
+            if frame.mask & (1 << (8 * i + zone)):
+                zones.append('{}{}'.format(sector[0], zone + 1))
+    return ' '.join(zones) or '-'
+
+
+def main():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print('Fake MCU listening on {}'.format(os.ttyname(slave)))
+    data = b''
+    lastSeq = None
+    lost = 0
+    while True:
+        data += os.read(master, 4096)
+        frames, consumed = decode_obstacle_frames(data)
+        data = data[consumed:]
+        for frame in frames:
+            if lastSeq is not None:
+                lost += (frame.seq - lastSeq - 1) & 0xFF
+            lastSeq = frame.seq
+            print('seq: {} / t: {} ms / lost: {} / zones: {} / nearest: {}'
+                  .format(frame.seq, frame.timestamp, lost, describe(frame),
+                          frame.nearest))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+# Multi-process collision avoidance pipeline: acquisition, classification
+# and MCU output run in separate processes, so decoding and zone
+# classification of RplidarA2M8_RC.py use separate cores. Stages exchange
+# revolutions and results through rings in shared memory (SharedRing)
+# coordinated by sequence numbers, without pickling or copying. Revolutions
+# are filtered with a mask (see PointFilter.mask), in place. A failure of
+# any stage stops the whole pipeline.
+#
+#   python RplidarA2M8_MP.py --lidar /dev/ttyUSB0 --mcu /dev/ttyACM0
+
+import argparse
+import logging
+import multiprocessing
+import signal
+import time
+import numpy as np
+import serial
+
+from multiprocessing import shared_memory
+
+from RplidarA2M8_RC import (CA_SECTORS, MEASURE_DTYPE, McuOutput,
+                            ObstacleGrid, PointFilter, RPLidar,
+                            RPLidarException, ZoneClassifier, ZoneTracker,
+                            caTracker_Confirm, caTracker_Release,
+                            lidarFilter_Isolation,
+                            lidarFilter_MedianTolerance,
+                            lidarFilter_MinQuality, obstacleMap_CenterRow,
+                            obstacleMap_Hold)
+
+# Classification result of a revolution: occupancy mask and nearest
+# distances (see ZoneClassifier.occupancy), zone bytes of the detections
+# and receive time of the oldest measure behind them
+RESULT_DTYPE = np.dtype([
+    ('mask', np.uint64),
+    ('nearest', np.uint16, (len(CA_SECTORS),)),
+    ('received', np.float64),
+    ('codes', np.uint8, (256,)),
+    ('ncodes', np.uint16),
+])
+# sleep between two polls of a ring by its readers
+POLL_INTERVAL = 0.0005
+
+
+class SharedRing(object):
+    '''Ring of `slots` records of `capacity` items of `dtype` in shared
+    memory, with a single writer and any number of readers in other
+    processes.
+
+    Every slot is stamped with the sequence number of the record it holds
+    (-1 while it is being written) and the ring header holds the sequence
+    number of the latest published record. Readers work on views of the
+    slots, without copying them, and check the stamp again once done to
+    detect records overwritten meanwhile (see `get` and `valid`).'''
+
+    def __init__(self, slots, capacity, dtype, name=None, create=True):
+        '''Create or attach ring.
+
+        Parameters
+        ----------
+        slots : int
+            Number of records kept in the ring
+        capacity : int
+            Maximum number of items per record
+        dtype : numpy.dtype
+            Items type
+        name : str, optional
+            Name of the shared memory block, random when creating
+        create : bool
+            Create new shared memory block instead of attaching existing one
+        '''
+        self.slots = slots
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self._slot_dtype = np.dtype([('seq', np.int64), ('count', np.int64),
+                                     ('data', self.dtype, (capacity,))])
+        size = 8 + slots * self._slot_dtype.itemsize
+        self._shm = shared_memory.SharedMemory(name, create, size)
+        self.name = self._shm.name
+        self._owner = create
+        self._header = np.ndarray(1, np.int64, self._shm.buf)
+        ring = np.ndarray(slots, self._slot_dtype, self._shm.buf, 8)
+        self._seq, self._count, self._data = (ring['seq'], ring['count'],
+                                              ring['data'])
+        if create:
+            self._header[0] = -1
+            self._seq[:] = -1
+        self._next = int(self._header[0]) + 1
+
+    def __reduce__(self):
+        # processes started with spawn attach to the block by its name
+        return (SharedRing, (self.slots, self.capacity, self.dtype,
+                             self.name, False))
+
+    @property
+    def latest(self):
+        '''Sequence number of the latest published record, -1 if none'''
+        return int(self._header[0])
+
+    def claim(self):
+        '''Returns the slot items array to write the next record into'''
+        i = self._next % self.slots
+        self._seq[i] = -1
+        return self._data[i]
+
+    def publish(self, count):
+        '''Publishes the record written into the claimed slot, made of its
+        first `count` items. Returns its sequence number.'''
+        seq = self._next
+        i = seq % self.slots
+        self._count[i] = count
+        self._seq[i] = seq
+        self._header[0] = seq
+        self._next += 1
+        return seq
+
+    def get(self, seq):
+        '''Returns view of the items of record `seq`, None if the record is
+        not published yet or already overwritten'''
+        i = seq % self.slots
+        if self._seq[i] != seq:
+            return None
+        return self._data[i, :self._count[i]]
+
+    def valid(self, seq):
+        '''Returns whether record `seq` is still in place'''
+        return self._seq[seq % self.slots] == seq
+
+    def close(self):
+        '''Detaches from the ring, releasing it if it was created here'''
+        self._header = self._seq = self._count = self._data = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class CodeBuffer(object):
+    '''Serial-like collector of zone bytes written by `ZoneClassifier.slot`'''
+
+    def __init__(self):
+        self.codes = bytearray()
+
+    def write(self, data):
+        self.codes += data
+        return len(data)
+
+
+def _ignore_sigint():
+    '''Leaves Ctrl-C to the parent process, which stops the pipeline'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _wait(ring, seq, stop):
+    '''Waits until record `seq` is published, returns False once stopped'''
+    while ring.latest < seq:
+        if stop.is_set():
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def acquisition(lidar_port, frames, stop, scan_type='normal'):
+    '''Acquisition process: decodes measures of every revolution straight
+    into a slot of the `frames` ring, publishing it on the next new scan
+    flag. Measures beyond the ring capacity are dropped.'''
+    _ignore_sigint()
+    logger = logging.getLogger('acquisition')
+    lidar = None
+    try:
+        lidar = RPLidar(lidar_port, discover=scan_type not in (
+            'normal', 'force', 'express'))
+        slot = frames.claim()
+        count = 0
+        started = False
+        for measures in lidar.iter_measure_batches(scan_type):
+            prev = 0
+            for start in np.flatnonzero(measures['new_scan']):
+                if started:
+                    count = _fill(slot, count, measures[prev:start])
+                    frames.publish(count)
+                    slot = frames.claim()
+                    count = 0
+                started = True
+                prev = start
+            if started:
+                count = _fill(slot, count, measures[prev:])
+            if stop.is_set():
+                break
+    except RPLidarException as err:
+        logger.error('Acquisition failed: %s', err)
+    finally:
+        try:
+            if lidar is not None:
+                lidar.stop()
+                lidar.stop_motor()
+                lidar.disconnect()
+        finally:
+            stop.set()
+
+
+def _fill(slot, count, measures):
+    '''Appends measures to the slot items, returns new count'''
+    end = min(count + len(measures), len(slot))
+    slot[count:end] = measures[:end - count]
+    return end
+
+
+def classification(frames, results, stop):
+    '''Classification process: tracks the CA zones hit by every revolution
+    of the `frames` ring (see `ZoneClassifier.track`) and publishes the
+    result into the `results` ring. When it falls behind, it skips to the
+    latest revolution.'''
+    _ignore_sigint()
+    logger = logging.getLogger('classification')
+    try:
+        _classify_frames(frames, results, stop, logger)
+    finally:
+        stop.set()
+
+
+def _classify_frames(frames, results, stop, logger):
+    '''Body of the classification process'''
+    zones = ZoneClassifier()
+    tracker = ZoneTracker(zones.shape, caTracker_Confirm, caTracker_Release)
+    point_filter = PointFilter(
+        lidarFilter_MinQuality, median_tolerance=lidarFilter_MedianTolerance,
+        isolation=lidarFilter_Isolation, logger=logger)
+    obstacle_map = ObstacleGrid(1000., obstacleMap_CenterRow * 1000.,
+                                obstacleMap_Hold)
+    codes = CodeBuffer()
+    seq = frames.latest + 1
+    skipped = 0
+    while _wait(frames, seq, stop):
+        if frames.latest - seq >= frames.slots - 1:
+            skipped += frames.latest - seq
+            seq = frames.latest
+        measures = frames.get(seq)
+        if measures is None:
+            seq += 1
+            continue
+        hit, nearest = zones.zone_hits(measures, point_filter.mask(measures))
+        received = float(measures['timestamp'].min()) if len(measures) else 0
+        if not frames.valid(seq):
+            # overwritten while being classified
+            skipped += 1
+            seq += 1
+            continue
+        del codes.codes[:]
+        zones.update_tracker(tracker, hit, nearest, obstacle_map, codes)
+        mask, nearest = zones.occupancy(obstacle_map)
+        result = results.claim()[0]
+        result['mask'] = mask
+        result['nearest'] = nearest
+        result['received'] = received
+        unique = np.unique(np.frombuffer(codes.codes, dtype=np.uint8))
+        result['codes'][:len(unique)] = unique
+        result['ncodes'] = len(unique)
+        results.publish(1)
+        seq += 1
+    if skipped:
+        logger.warning('Skipped %d revolutions', skipped)
+
+
+def output(results, mcu_port, stop, protocol='bytes'):
+    '''MCU output process: owns the MCU serial port and sends every result
+    of the `results` ring'''
+    _ignore_sigint()
+    logger = logging.getLogger('output')
+    mcu = None
+    try:
+        mcu = McuOutput(serial.Serial(mcu_port, 115200, timeout=0.1))
+        mcu.start()
+        seq = results.latest + 1
+        while _wait(results, seq, stop):
+            seq = max(seq, results.latest)
+            result = results.get(seq)
+            if result is None:
+                continue
+            result = result[0]
+            codes = result['codes'][:result['ncodes']].tobytes()
+            mask = int(result['mask'])
+            nearest = tuple(result['nearest'].tolist())
+            received = float(result['received'])
+            if not results.valid(seq):
+                # overwritten while being copied, the next one is newer
+                seq += 1
+                continue
+            if protocol == 'bytes':
+                if codes:
+                    mcu.write(codes, received)
+            else:
+                mcu.send_frame(mask, nearest, received)
+            seq += 1
+    except (OSError, serial.SerialException) as err:
+        logger.error('Output failed: %s', err)
+    finally:
+        try:
+            if mcu is not None:
+                mcu.stop()
+        finally:
+            stop.set()
+
+
+def run(lidar_port, mcu_port=None, protocol='bytes', scan_type='normal',
+        slots=8, capacity=4096):
+    '''Runs the pipeline until interrupted or acquisition fails.
+
+    Parameters
+    ----------
+    lidar_port : str
+        Sensor serial port
+    mcu_port : str, optional
+        MCU serial port, results are only computed if None
+    protocol : bytes or frame
+        MCU protocol, see `mcuProtocol` in RplidarA2M8_RC.py
+    scan_type : normal, force, express, ultra, dense or auto, see
+        `RPLidar.start`
+    slots : int
+        Number of revolutions kept in the frames ring
+    capacity : int
+        Maximum number of measures per revolution
+    '''
+    frames = SharedRing(slots, capacity, MEASURE_DTYPE)
+    results = SharedRing(4, 1, RESULT_DTYPE)
+    stop = multiprocessing.Event()
+    processes = [
+        multiprocessing.Process(target=acquisition, name='acquisition',
+                                args=(lidar_port, frames, stop, scan_type)),
+        multiprocessing.Process(target=classification, name='classification',
+                                args=(frames, results, stop)),
+    ]
+    if mcu_port is not None:
+        processes.append(multiprocessing.Process(
+            target=output, name='output',
+            args=(results, mcu_port, stop, protocol)))
+    for process in processes:
+        process.start()
+    try:
+        while not stop.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        for process in processes:
+            process.join()
+        frames.close()
+        results.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Multi-process collision avoidance pipeline')
+    parser.add_argument('--lidar', default='/dev/ttyUSB0')
+    parser.add_argument('--mcu', help='MCU serial port, none by default')
+    parser.add_argument('--protocol', default='bytes',
+                        choices=('bytes', 'frame'))
+    parser.add_argument('--scan-type', default='normal',
+                        choices=('normal', 'force', 'express', 'ultra',
+                                 'dense', 'auto'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    run(args.lidar, args.mcu, args.protocol, args.scan_type)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
 # hardware: RPlidar A2 M8
 
+import bisect
+import json
 import logging
+import os
 import sys
 import time
 import codecs
+import io
+import select
 import serial
+import signal
 import struct
+import threading
 import numpy as np
 
-from collections import namedtuple
+from collections import namedtuple, deque
 
 # globals
 # ------------------------------------------------
@@ -17,11 +24,55 @@ lidarPort = '/dev/ttyUSB0'
 #lidarPort = '/dev/ttyUSB1'
 arduinoPort = '/dev/ttyACM0'
 #arduinoPort = '/dev/ttyACM1'
+# capture file to record the lidar serial traffic to, and capture to replay
+# instead of the sensor (see RecordingSerial and ReplaySerial)
+lidarRecord = None
+lidarReplay = None
+# bytes of the latest lidar serial traffic kept in memory (see TraceRing),
+# None to disable, and capture file they are dumped to on a crash or on
+# SIGUSR1
+lidarTrace = None
+lidarTraceFile = 'rplidar_trace.rplcap'
+# scan mode: 'normal', 'force', 'express', 'ultra', 'dense', 'auto' for the
+# fastest mode the sensor reports, or the name of one of them (e.g.
+# 'Boost'). The modes are only queried for the last four (see
+# RPLidar.get_scan_modes).
+lidarScanType = 'normal'
+# several sensors: (port, x mm forward, y mm right, yaw degrees clockwise)
+# of every sensor mounted on the robot, None to only use lidarPort
+lidarMounts = None
+#lidarMounts = [('/dev/ttyUSB0', 300., 0., 0.), ('/dev/ttyUSB1', -300., 0., 180.)]
+# MCU protocol: 'bytes' sends one byte per detected zone, 'frame' sends the
+# whole obstacle map once per cycle (see encode_obstacle_frame)
+mcuProtocol = 'bytes'
+# file the MCU output statistics (incl. detection latency) are dumped to
+# every stats period, None to only log them
+mcuStatsFile = None
 
 obstacleMap_CenterRow = 8
 obstacleMap_CenterCol = 8
 obstacleMap_Row_Len = 17
 obstacleMap_Col_Len  = 17
+# number of cycles an obstacle stays on the map after its last detection
+obstacleMap_Hold = 4
+# revolutions hitting a CA zone before it is reported, and missing it
+# before it is cleared (see ZoneTracker)
+caTracker_Confirm = 2
+caTracker_Release = 3
+# point filter of the measures before CA classification (see PointFilter),
+# minimum quality, relative tolerance to the median of neighbours and
+# relative distance of isolated points. Applied to every revolution, window
+# or sector, and in the gated loop to the measures received between two
+# ticks, the latest one passing is classified.
+lidarFilter_MinQuality = 10
+lidarFilter_MedianTolerance = 0.2
+lidarFilter_Isolation = 0.1
+# adaptive rotation speed (see ScanController): revolutions per second to
+# hold, None to keep the motor at DEFAULT_MOTOR_PWM, and angular
+# resolution in degrees below which express mode is used. Applies to every
+# sensor of lidarMounts and to the single sensor, whatever the loop.
+lidarTarget_Rps = None
+lidarTarget_Resolution = None
 # measurement[0] # bool new scan?
 idx_NewScan = 0
 # measurement[1] # int quality of laser
@@ -35,6 +86,16 @@ idx_DistMm = 3
 lidarTimer_Prev = 0
 lidarTimer_Now = 0
 lidarTimer_Treshold = 0
+# host receive time of the current measurement (see RPLidar.read_time)
+measurementTime = 0
+# measures classified together by the main loop: None (default) only
+# classifies the measure arriving every lidarTimer_Treshold. Opt-in
+# evaluation of every measure (see RPLidar.iter_windows): 0 for one window
+# per revolution, closed by the new scan flag, N for windows of N
+# measures, 'sector' to classify every CA sector as soon as it was swept
+# (see SectorSweep). The obstacle map decays once per window (per
+# revolution with 'sector').
+caWindow = None
 
 
 SYNC_BYTE = b'\xA5'
@@ -50,7 +111,27 @@ _SCAN_TYPE = {
     'normal': {'byte': b'\x20', 'response': 129, 'size': 5},
     'force': {'byte': b'\x21', 'response': 129, 'size': 5},
     'express': {'byte': b'\x82', 'response': 130, 'size': 84},
+    # started with the working mode of a scan mode reported by the sensor
+    # (see RPLidar.get_scan_modes)
+    'ultra': {'byte': b'\x82', 'response': 132, 'size': 132},
+    'dense': {'byte': b'\x82', 'response': 133, 'size': 84},
 }
+# scan type of the scan modes answers
+_ANS_SCAN_TYPE = {129: 'normal', 130: 'express', 132: 'ultra', 133: 'dense'}
+
+# nominal measures per second of the scan modes
+SCAN_SAMPLE_RATES = {'normal': 2000, 'force': 2000, 'express': 4000,
+                     'ultra': 8000, 'dense': 8000}
+
+# Lidar configuration query and the entries describing scan modes
+GET_LIDAR_CONF_BYTE = b'\x84'
+LIDAR_CONF_TYPE = 0x20
+CONF_SCAN_MODE_COUNT = 0x70
+CONF_SCAN_MODE_US_PER_SAMPLE = 0x71
+CONF_SCAN_MODE_MAX_DISTANCE = 0x74
+CONF_SCAN_MODE_ANS_TYPE = 0x75
+CONF_SCAN_MODE_TYPICAL = 0x7C
+CONF_SCAN_MODE_NAME = 0x7F
 
 DESCRIPTOR_LEN = 7
 INFO_LEN = 20
@@ -70,6 +151,32 @@ _HEALTH_STATUSES = {
     2: 'Error',
 }
 
+# Capture files of the serial traffic (see RecordingSerial)
+CAPTURE_MAGIC = b'RPLCAP1\n'
+CAPTURE_RECORD = struct.Struct('<dBH')
+CAPTURE_READ = 0
+CAPTURE_WRITE = 1
+
+# Layout of the measures decoded in bulk by `_process_scan_batch`
+MEASURE_DTYPE = np.dtype([
+    ('new_scan', np.bool_),
+    ('quality', np.uint8),
+    ('angle', np.float32),
+    ('angle_q6', np.uint16),
+    ('distance', np.float32),
+    ('timestamp', np.float64),
+])
+# `timestamp` is the host time (time.time()) at which the bytes completing
+# the measure were read from the serial port, 0 if unknown.
+# Angle quantization of the sensor (1/64 degree) and full turn in it, angles
+# in `angle_q6` field are wrapped to [0, ANGLE_Q6_TURN)
+ANGLE_Q6_SCALE = 64
+ANGLE_Q6_TURN = 360 * ANGLE_Q6_SCALE
+# Number of consecutive valid packets required to resync on corrupted data
+RESYNC_PACKETS = 3
+# Size of the input buffer of RPLidar, reused for every read and handed to
+# the decoders as views
+RX_BUFFER_SIZE = 16384
 
 class RPLidarException(Exception):
     '''Basic exception class for RPLidar'''
@@ -82,6 +189,54 @@ def _showhex(signal):
     '''Converts string bytes to hex representation (useful for debugging)'''
     return [format(_b2i(b), '#02x') for b in signal]
 
+def _payload_request(cmd, payload):
+    '''Builds request of `cmd` command with `payload` and its checksum'''
+    req = bytearray(SYNC_BYTE + cmd)
+    req.append(len(payload))
+    req += payload
+    checksum = 0
+    for v in req:
+        checksum ^= v
+    req.append(checksum)
+    return bytes(req)
+
+def _parse_descriptor(descriptor):
+    '''Parses response descriptor, returns data size, single response flag
+    and data type'''
+    if len(descriptor) != DESCRIPTOR_LEN:
+        raise RPLidarException('Descriptor length mismatch')
+    elif not descriptor.startswith(SYNC_BYTE + SYNC_BYTE2):
+        raise RPLidarException('Incorrect descriptor starting bytes')
+    is_single = _b2i(descriptor[-2]) == 0
+    return _b2i(descriptor[2]), is_single, _b2i(descriptor[-1])
+
+def _check_descriptor(descriptor, dsize, is_single, dtype):
+    '''Checks that parsed descriptor announces the expected response'''
+    if descriptor[0] != dsize:
+        raise RPLidarException('Wrong get_info reply length')
+    if descriptor[1] != is_single:
+        raise RPLidarException('Not a single response mode' if is_single
+                               else 'Not a multiple response mode')
+    if descriptor[2] != dtype:
+        raise RPLidarException('Wrong response data type')
+
+def _parse_info(raw):
+    '''Parses device information response'''
+    serialnumber = codecs.encode(raw[4:], 'hex').upper()
+    serialnumber = codecs.decode(serialnumber, 'ascii')
+    return {
+        'model': _b2i(raw[0]),
+        'firmware': (_b2i(raw[2]), _b2i(raw[1])),
+        'hardware': _b2i(raw[3]),
+        'serialnumber': serialnumber,
+    }
+
+def _parse_health(raw):
+    '''Parses device health response, returns status and error code'''
+    status = _HEALTH_STATUSES[_b2i(raw[0])]
+    error_code = (_b2i(raw[1]) << 8) + _b2i(raw[2])
+    return status, error_code
+
 def _process_scan(raw):
     '''Processes input raw data and returns measurement data'''
     new_scan = bool(_b2i(raw[0]) & 0b1)
@@ -97,6 +252,378 @@ def _process_scan(raw):
     return new_scan, quality, angle, distance
 
 
+def _scan_packet_flags(buf):
+    '''Returns boolean mask of the offsets in `buf` at which a normal scan
+    packet can start, i.e. start flags are inversed and check bit is set'''
+    b0 = buf[:-4]
+    b1 = buf[1:-3]
+    return ((b0 ^ (b0 >> 1)) & b1 & 0b1).astype(np.bool_)
+
+
+def _capsule_packet_flags(buf, size):
+    '''Returns boolean mask of the offsets in `buf` at which a capsuled
+    packet of `size` bytes (express, ultra or dense) with valid sync bits
+    and checksum starts'''
+    valid = np.zeros(max(len(buf) - size + 1, 0), dtype=np.bool_)
+    sync = (((buf[:len(valid)] >> 4) == ExpressPacket.sync1) &
+            ((buf[1:len(valid) + 1] >> 4) == ExpressPacket.sync2))
+    candidates = np.flatnonzero(sync)
+    if len(candidates):
+        packets = buf[candidates[:, None] + np.arange(size)]
+        checksum = np.bitwise_xor.reduce(packets[:, 2:], axis=1)
+        valid[candidates] = checksum == ((packets[:, 0] & 0b00001111) +
+                                         ((packets[:, 1] & 0b00001111) << 4))
+    return valid
+
+
+def _express_packet_flags(buf):
+    '''Returns boolean mask of the offsets in `buf` at which an express scan
+    packet with valid sync bits and checksum starts'''
+    return _capsule_packet_flags(buf, _SCAN_TYPE['express']['size'])
+
+
+def _confirmed_packets(valid, size, confirm):
+    '''Returns boolean mask of the offsets starting `confirm` consecutive
+    valid packets of `size` bytes'''
+    span = max(len(valid) - (confirm - 1) * size, 0)
+    confirmed = valid[:span].copy()
+    for i in range(1, confirm):
+        confirmed &= valid[i * size:span + i * size]
+    return confirmed
+
+
+def _frame_packets(valid, size, confirm=1):
+    '''Finds packets boundaries in a chunk of raw data.
+
+    Follows `size` bytes stride while packets are valid. On invalid packet
+    scans forward for the offset starting `confirm` consecutive valid ones.
+
+    Parameters
+    ----------
+    valid : numpy.ndarray
+        Boolean mask of the offsets at which a valid packet starts
+    size : int
+        Packet size in bytes
+    confirm : int
+        Number of consecutive valid packets required to resync
+
+    Returns
+    -------
+    starts : numpy.ndarray
+        Offsets of the valid packets
+    consumed : int
+        Number of bytes processed
+    skipped : int
+        Number of bytes dropped while resynchronizing
+    '''
+    confirmed = None
+    runs = []
+    skipped = 0
+    pos = 0
+    while pos < len(valid):
+        if valid[pos]:
+            idx = np.arange(pos, len(valid), size)
+            ok = valid[idx]
+            end = len(idx) if ok.all() else int(ok.argmin())
+            runs.append(idx[:end])
+            pos += end * size
+            continue
+        if confirmed is None:
+            confirmed = _confirmed_packets(valid, size, confirm)
+        hits = np.flatnonzero(confirmed[pos:])
+        if not len(hits):
+            # offsets before the last packets can't start a valid run anymore
+            end = max(pos, len(confirmed))
+            skipped += end - pos
+            pos = end
+            break
+        skipped += int(hits[0])
+        pos += int(hits[0])
+    starts = np.concatenate(runs) if runs else np.empty(0, dtype=np.intp)
+    return starts, pos, skipped
+
+
+def _process_scan_batch(raw):
+    '''Processes a chunk of raw normal scan responses at once.
+
+    Chunk may start and end in the middle of a packet. Packets boundaries
+    are found from the start flags and check bit invariants, corrupted data
+    is skipped until `RESYNC_PACKETS` consecutive valid packets are found.
+
+    Parameters
+    ----------
+    raw : bytes, bytearray or memoryview
+        Raw bytes as read from the serial port
+
+    Returns
+    -------
+    measures : numpy.ndarray
+        Structured array of `MEASURE_DTYPE`
+    consumed : int
+        Number of bytes processed. Remaining bytes belong to incomplete
+        packet and should be prepended to the next chunk.
+    skipped : int
+        Number of bytes dropped while resynchronizing
+    '''
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    starts, consumed, skipped = _frame_packets(
+        _scan_packet_flags(buf), _SCAN_TYPE['normal']['size'], RESYNC_PACKETS)
+    b0 = buf[starts]
+    measures = np.empty(len(starts), dtype=MEASURE_DTYPE)
+    measures['new_scan'] = b0 & 0b1
+    measures['quality'] = b0 >> 2
+    angle_q6 = ((buf[starts + 1] >> 1) |
+                (buf[starts + 2].astype(np.uint16) << 7))
+    measures['angle'] = angle_q6 / 64.
+    measures['angle_q6'] = angle_q6 % ANGLE_Q6_TURN
+    measures['distance'] = (buf[starts + 3] |
+                            (buf[starts + 4].astype(np.uint16) << 8)) / 4.
+    measures['timestamp'] = 0
+    return measures, consumed, skipped
+
+
+def _unpack_express_cabins(packets):
+    '''Unpacks cabins of express scan packets.
+
+    Parameters
+    ----------
+    packets : numpy.ndarray
+        (N, 84) array of raw express packets
+
+    Returns
+    -------
+    start_angle : numpy.ndarray
+        (N,) start angles in degrees
+    distance : numpy.ndarray
+        (N, 32) distances in millimeters
+    angle : numpy.ndarray
+        (N, 32) angle compensations in degrees
+    '''
+    start_angle = (packets[:, 2] +
+                   ((packets[:, 3] & 0b01111111).astype(np.uint16) << 8)) / 64
+    cabins = packets[:, 4:].reshape(len(packets), 16, 5).astype(np.uint16)
+    first, second = cabins[:, :, 0], cabins[:, :, 2]
+    distance = np.empty((len(packets), 32), dtype=np.uint16)
+    distance[:, 0::2] = (first >> 2) + (cabins[:, :, 1] << 6)
+    distance[:, 1::2] = (second >> 2) + (cabins[:, :, 3] << 6)
+    angle = np.empty((len(packets), 32))
+    angle[:, 0::2] = ((cabins[:, :, 4] & 0b00001111) + ((first & 0b1) << 4))
+    angle[:, 1::2] = ((cabins[:, :, 4] >> 4) + ((second & 0b1) << 4))
+    angle[:, 0::2] *= np.where(first & 0b10, -1, 1)
+    angle[:, 1::2] *= np.where(second & 0b10, -1, 1)
+    angle /= 8
+    return start_angle, distance, angle
+
+
+def _process_express_batch(raw):
+    '''Processes a chunk of raw express scan responses at once.
+
+    Measures angles of a packet are interpolated up to the start angle of
+    the next one, so the last packet of the chunk is left unconsumed until
+    its successor arrives. Corrupted packets are skipped.
+
+    Parameters
+    ----------
+    raw : bytes, bytearray or memoryview
+        Raw bytes as read from the serial port
+
+    Returns
+    -------
+    measures : numpy.ndarray
+        Structured array of `MEASURE_DTYPE`, 32 measures per packet.
+        Quality is not reported in express mode and is set to 0.
+    consumed : int
+        Number of bytes processed
+    skipped : int
+        Number of bytes dropped while resynchronizing
+    '''
+    packets, followed, consumed, skipped = _frame_capsules(
+        raw, _SCAN_TYPE['express']['size'])
+    if len(packets) < 2:
+        return np.empty(0, dtype=MEASURE_DTYPE), consumed, skipped
+    start_angle, distance, angle = _unpack_express_cabins(packets)
+    old_angle, new_angle = start_angle[:-1, None], start_angle[1:, None]
+    trame = np.arange(1, 33)
+    measures = np.zeros((len(packets) - 1, 32), dtype=MEASURE_DTYPE)
+    measures['new_scan'][:, 0] = new_angle[:, 0] < old_angle[:, 0]
+    measures['angle'] = (old_angle + ((new_angle - old_angle) % 360) / 32 *
+                         trame - angle[:-1]) % 360
+    measures['angle_q6'] = (measures['angle'] *
+                            ANGLE_Q6_SCALE).astype(np.uint16) % ANGLE_Q6_TURN
+    measures['distance'] = distance[:-1]
+    return measures[followed].ravel(), consumed, skipped
+
+
+def _frame_capsules(raw, size):
+    '''Frames the capsuled packets of `size` bytes in a chunk of raw data.
+    Measures of a capsule are interpolated up to the start angle of the
+    next one, so the last packet is left unconsumed until its successor
+    arrives, and packets followed by skipped bytes are not decoded.
+
+    Returns
+    -------
+    packets : numpy.ndarray
+        (N, size) array of the valid packets, the last one included
+    followed : numpy.ndarray
+        (N - 1,) boolean mask of the packets right followed by the next one
+    consumed : int
+        Number of bytes processed, up to the last packet
+    skipped : int
+        Number of bytes dropped while resynchronizing
+    '''
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    starts, consumed, skipped = _frame_packets(
+        _capsule_packet_flags(buf, size), size)
+    if len(starts):
+        # bytes skipped after the last packet are scanned again with the
+        # next chunk, count them then
+        skipped -= max(consumed - int(starts[-1]) - size, 0)
+        consumed = int(starts[-1])
+    return (buf[starts[:, None] + np.arange(size)],
+            np.diff(starts) == size, consumed, skipped)
+
+
+def _capsule_start_angles(packets):
+    '''Returns start angles of ultra and dense capsules in 1/256 degree'''
+    start = packets[:, 2].astype(np.int64) | (packets[:, 3].astype(
+        np.int64) << 8)
+    return (start & 0x7FFF) << 2
+
+
+def _capsule_measures(angle_q16, increment, angle_q6, distance):
+    '''Builds measures of ultra and dense capsules from the interpolated
+    angles in 1/65536 degree, the angle increment between two measures, the
+    measured angles in 1/64 degree and the distances. The new scan flag is
+    set on the first measure past the zero angle.'''
+    angle_q6 = angle_q6 % ANGLE_Q6_TURN
+    measures = np.zeros(distance.shape, dtype=MEASURE_DTYPE)
+    measures['new_scan'] = (angle_q16 % (360 << 16)) < increment
+    measures['angle'] = angle_q6 / ANGLE_Q6_SCALE
+    measures['angle_q6'] = angle_q6
+    measures['distance'] = distance
+    return measures
+
+
+def _process_dense_batch(raw):
+    '''Processes a chunk of raw dense capsuled responses at once, see
+    `_process_express_batch`. Each packet holds the start angle and 40
+    distances in millimeters.
+
+    Returns
+    -------
+    measures : numpy.ndarray
+        Structured array of `MEASURE_DTYPE`, 40 measures per packet.
+        Quality is not reported in dense mode and is set to 0.
+    consumed : int
+        Number of bytes processed
+    skipped : int
+        Number of bytes dropped while resynchronizing
+    '''
+    packets, followed, consumed, skipped = _frame_capsules(
+        raw, _SCAN_TYPE['dense']['size'])
+    if len(packets) < 2:
+        return np.empty(0, dtype=MEASURE_DTYPE), consumed, skipped
+    start_q8 = _capsule_start_angles(packets)
+    diff_q8 = (start_q8[1:] - start_q8[:-1]) % (360 << 8)
+    increment = ((diff_q8 << 8) // 40)[:, None]
+    angle_q16 = (start_q8[:-1, None] << 8) + increment * np.arange(40)
+    distance = np.ascontiguousarray(packets[:-1, 4:]).view('<u2')
+    measures = _capsule_measures(angle_q16, increment, angle_q16 >> 10,
+                                 distance)
+    return measures[followed].ravel(), consumed, skipped
+
+
+# Segments of the variable bit scale of ultra capsules distances: first
+# scaled value, and decoded distance at it, the bit shift is the index
+_VBS_SCALED_BASES = np.array([0, 512, 1280, 1792, 3328])
+_VBS_TARGET_BASES = np.array([0, 1 << 9, 1 << 11, 1 << 12, 1 << 14])
+
+
+def _varbitscale(scaled):
+    '''Decodes variable bit scaled distances of ultra capsules, returns
+    distances in millimeters and their bit shifts'''
+    level = np.searchsorted(_VBS_SCALED_BASES, scaled, side='right') - 1
+    return (_VBS_TARGET_BASES[level] +
+            ((scaled - _VBS_SCALED_BASES[level]) << level)), level
+
+
+def _ultra_angle_offsets(distance):
+    '''Returns the angle offsets in 1/65536 degree between the raw angles
+    of ultra capsules and the measures, which depend on the distance'''
+    dist_q2 = distance << 2
+    k2 = 98361 // np.maximum(dist_q2, 200)
+    offset = np.where(dist_q2 >= 200,
+                      int(8 * 3.1415926535 * (1 << 16) / 180) - (k2 << 6) -
+                      k2 * k2 * k2 // 98304,
+                      int(7.5 * 3.1415926535 * (1 << 16) / 180))
+    return np.trunc(offset * 180 / 3.14159265).astype(np.int64)
+
+
+def _signed_10bit(value):
+    '''Converts 10 bits two's complement values to signed integers'''
+    return value - ((value & 0x200) << 1)
+
+
+def _process_ultra_batch(raw):
+    '''Processes a chunk of raw ultra capsuled responses at once, see
+    `_process_express_batch`. Each packet holds the start angle and 32
+    cabins of 3 measures: a variable bit scaled distance and two distances
+    predicted from it and from the major distance of the next cabin.
+
+    Returns
+    -------
+    measures : numpy.ndarray
+        Structured array of `MEASURE_DTYPE`, 96 measures per packet.
+        Quality is not reported in ultra mode and is set to 0.
+    consumed : int
+        Number of bytes processed
+    skipped : int
+        Number of bytes dropped while resynchronizing
+    '''
+    packets, followed, consumed, skipped = _frame_capsules(
+        raw, _SCAN_TYPE['ultra']['size'])
+    if len(packets) < 2:
+        return np.empty(0, dtype=MEASURE_DTYPE), consumed, skipped
+    cabins = np.ascontiguousarray(packets[:, 4:]).view('<u4').astype(
+        np.int64)
+    major, level = _varbitscale(cabins & 0xFFF)
+    # major distance of the next cabin, the first one of the next packet
+    # for the last cabin
+    next_major = np.concatenate((major[:-1, 1:], major[1:, :1]), axis=1)
+    next_level = np.concatenate((level[:-1, 1:], level[1:, :1]), axis=1)
+    major, level, cabins = major[:-1], level[:-1], cabins[:-1]
+    predict1 = _signed_10bit((cabins >> 12) & 0x3FF)
+    predict2 = _signed_10bit((cabins >> 22) & 0x3FF)
+    fallback = (major == 0) & (next_major != 0)
+    base1 = np.where(fallback, next_major, major)
+    level1 = np.where(fallback, next_level, level)
+    distance = np.empty(cabins.shape + (3,), dtype=np.int64)
+    distance[..., 0] = major
+    # extreme predictions flag invalid measures
+    distance[..., 1] = np.where((predict1 == -512) | (predict1 == 511), 0,
+                                (predict1 << level1) + base1)
+    distance[..., 2] = np.where((predict2 == -512) | (predict2 == 511), 0,
+                                (predict2 << next_level) + next_major)
+    distance = distance.reshape(len(cabins), 96).clip(0)
+    start_q8 = _capsule_start_angles(packets)
+    diff_q8 = (start_q8[1:] - start_q8[:-1]) % (360 << 8)
+    increment = ((diff_q8 << 3) // 3)[:, None]
+    angle_q16 = (start_q8[:-1, None] << 8) + increment * np.arange(96)
+    angle_q6 = (angle_q16 - _ultra_angle_offsets(distance)) >> 10
+    measures = _capsule_measures(angle_q16, increment, angle_q6, distance)
+    return measures[followed].ravel(), consumed, skipped
+
+
+# Bulk decoders of the scan types (see `iter_measure_batches`)
+_BATCH_DECODERS = {
+    'normal': _process_scan_batch,
+    'force': _process_scan_batch,
+    'express': _process_express_batch,
+    'ultra': _process_ultra_batch,
+    'dense': _process_dense_batch,
+}
+
+
 def _process_express_scan(data, new_angle, trame):
     new_scan = (new_angle < data.start_angle) & (trame == 1)
     angle = (data.start_angle + (
@@ -106,25 +633,75 @@ def _process_express_scan(data, new_angle, trame):
     return new_scan, None, angle, distance
 
 
+_TRIG_TABLES = {}
+
+
+def trig_table(scale=ANGLE_Q6_SCALE):
+    '''Returns cosine and sine of all the angles quantized to 1/`scale`
+    degree. Tables are computed once per quantization and cached.'''
+    if scale not in _TRIG_TABLES:
+        theta = np.radians(np.arange(360 * scale) / float(scale))
+        _TRIG_TABLES[scale] = (np.cos(theta).astype(np.float32),
+                               np.sin(theta).astype(np.float32))
+    return _TRIG_TABLES[scale]
+
+
+def polar_to_xy(angle_q6, distance):
+    '''Converts measures to Cartesian coordinates with table lookups instead
+    of trigonometric calls.
+
+    Parameters
+    ----------
+    angle_q6 : numpy.ndarray
+        Angles in 1/64 degree, as in `angle_q6` field of the measures
+    distance : numpy.ndarray
+        Distances in mm
+
+    Returns
+    -------
+    x, y : numpy.ndarray
+        Coordinates in mm, x forward and y to the right of the sensor
+    '''
+    cos, sin = trig_table()
+    return distance * cos[angle_q6], distance * sin[angle_q6]
+
+
 class RPLidar(object):
     '''Class for communicating with RPLidar rangefinder scanners'''
 
-    def __init__(self, port, baudrate=115200, timeout=1, logger=None):
+    def __init__(self, port, baudrate=115200, timeout=1, logger=None,
+                 record=None, trace=None, discover=False):
         '''Initilize RPLidar object for communicating with the sensor.
 
         Parameters
         ----------
-        port : str
-            Serial port name to which sensor is connected
+        port : str or serial-like object
+            Serial port name to which sensor is connected, or an already
+            opened transport such as `ReplaySerial`
         baudrate : int, optional
             Baudrate for serial connection (the default is 115200)
         timeout : float, optional
             Serial port connection timeout in seconds (the default is 1)
         logger : logging.Logger instance, optional
             Logger instance, if none is provided new instance is created
+        record : str, optional
+            Path of the capture file to record all the serial traffic to,
+            see `RecordingSerial`
+        trace : TraceRing, optional
+            Ring keeping the latest serial traffic in memory, to be dumped
+            with `dump_trace` after a failure
+        discover : bool, optional
+            Query the scan modes supported by the sensor on connection, see
+            `get_scan_modes`. Off by default, captures recorded without the
+            queries wouldn't replay.
         '''
         self._serial = None
         self.port = port
+        self.record = record
+        self.trace = trace
+        self.discover = discover
+        self.scan_modes = []
+        self.scan_mode = None
         self.baudrate = baudrate
         self.timeout = timeout
         self._motor_speed = DEFAULT_MOTOR_PWM
@@ -132,6 +709,17 @@ class RPLidar(object):
         self.express_trame = 32
         self.express_data = False
         self.motor_running = None
+        self.read_time = 0
+        self._rx = bytearray(RX_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx)
+        self._rx_start = self._rx_end = 0
+        self._rx_file = None
+        self.skipped_bytes = 0
+        self.dropped_bytes = 0
+        self.ring = None
+        self.reader_error = None
+        self._reader = None
+        self._reader_stop = threading.Event()
         if logger is None:
             logger = logging.getLogger('rplidar')
         self.logger = logger
@@ -142,21 +730,49 @@ class RPLidar(object):
         connected to another serial port disconnects from it first.'''
         if self._serial is not None:
             self.disconnect()
-        try:
-            self._serial = serial.Serial(
-                self.port, self.baudrate,
-                parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
-                timeout=self.timeout)
-        except serial.SerialException as err:
-            raise RPLidarException('Failed to connect to the sensor '
-                                   'due to: %s' % err)
+        if hasattr(self.port, 'read'):
+            self._serial = self.port
+        else:
+            try:
+                self._serial = serial.Serial(
+                    self.port, self.baudrate,
+                    parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
+                    timeout=self.timeout)
+            except serial.SerialException as err:
+                raise RPLidarException('Failed to connect to the sensor '
+                                       'due to: %s' % err)
+        if self.record is not None:
+            self._serial = RecordingSerial(self._serial, self.record)
+        self._rx_start = self._rx_end = 0
+        self._rx_file = None
+        if isinstance(self._serial, serial.Serial):
+            try:
+                # pyserial reads into new bytes objects, read the port
+                # straight into the input buffer instead
+                self._rx_file = io.FileIO(self._serial.fileno(), 'rb',
+                                          closefd=False)
+            except (AttributeError, OSError, ValueError):
+                pass
+        if self.discover:
+            self.scan_modes = self._discover_scan_modes()
 
     def disconnect(self):
         '''Disconnects from the serial port'''
         if self._serial is None:
             return
+        if self._rx_file is not None:
+            self._rx_file.close()
+            self._rx_file = None
         self._serial.close()
 
+    def _set_dtr(self, value):
+        '''Sets DTR line which drives A1 motor. Ports without modem lines
+        (e.g. pseudo-terminals of a simulated sensor) are tolerated.'''
+        try:
+            self._serial.setDTR(value)
+        except (OSError, serial.SerialException) as err:
+            self.logger.debug('Failed to set DTR: %s', err)
+
     def _set_pwm(self, pwm):
         payload = struct.pack("<H", pwm)
         self._send_payload_cmd(SET_PWM_BYTE, payload)
@@ -176,7 +792,7 @@ class RPLidar(object):
         '''Starts sensor motor'''
         self.logger.info('Starting motor')
         # For A1
-        self._serial.setDTR(False)
+        self._set_dtr(False)
 
         # For A2
         self._set_pwm(self._motor_speed)
@@ -189,46 +805,195 @@ class RPLidar(object):
         self._set_pwm(0)
         time.sleep(.001)
         # For A1
-        self._serial.setDTR(True)
+        self._set_dtr(True)
         self.motor_running = False
 
     def _send_payload_cmd(self, cmd, payload):
         '''Sends `cmd` command with `payload` to the sensor'''
-        size = struct.pack('B', len(payload))
-        req = SYNC_BYTE + cmd + size + payload
-        checksum = 0
-        for v in struct.unpack('B'*len(req), req):
-            checksum ^= v
-        req += struct.pack('B', checksum)
+        req = _payload_request(cmd, payload)
         self._serial.write(req)
-        self.logger.debug('Command sent: %s' % _showhex(req))
+        if self.trace is not None:
+            self.trace.add(CAPTURE_WRITE, req)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Command sent: %s', _showhex(req))
 
     def _send_cmd(self, cmd):
         '''Sends `cmd` command to the sensor'''
         req = SYNC_BYTE + cmd
         self._serial.write(req)
-        self.logger.debug('Command sent: %s' % _showhex(req))
+        if self.trace is not None:
+            self.trace.add(CAPTURE_WRITE, req)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Command sent: %s', _showhex(req))
+
+    def dump_trace(self, path):
+        '''Dumps the serial traffic kept by `trace` into capture file
+        `path`, see `TraceRing.dump`'''
+        if self.trace is None:
+            return
+        self.trace.dump(path)
+        self.logger.info('Serial trace dumped to %s', path)
+
+    def _waiting(self):
+        '''Returns number of bytes received and not consumed yet, in the
+        input buffer and in the serial port'''
+        return self._rx_end - self._rx_start + self._serial.inWaiting()
+
+    def _readinto(self, view, min_size):
+        '''Reads bytes available in the serial port into `view`, blocking
+        until at least `min_size` bytes arrived or serial timeout expired.
+        Returns number of bytes read.'''
+        if self._rx_file is None:
+            # transports without file descriptor (see ReplaySerial) and
+            # wrappers (see RecordingSerial) read the usual way
+            size = min(max(min_size, self._serial.inWaiting()), len(view))
+            return self._serial.readinto(view[:size]) or 0
+        timeout = self._serial.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        count = 0
+        ready = False
+        while True:
+            try:
+                n = self._rx_file.readinto(view[count:])
+            except OSError as err:
+                raise RPLidarException('Failed to read from the sensor '
+                                       'due to: %s' % err)
+            if ready and not n:
+                # same as pyserial: readable but no data
+                raise RPLidarException('Device disconnected or multiple '
+                                       'access on port')
+            count += n or 0
+            if count >= min_size or count == len(view):
+                return count
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return count
+            ready = bool(select.select([self._rx_file], [], [],
+                                       remaining)[0])
+
+    def _fill(self, min_size):
+        '''Reads all the bytes available in the serial port into the input
+        buffer, blocking until it holds at least `min_size` bytes or serial
+        timeout expired. Returns number of bytes in the buffer.'''
+        size = self._rx_end - self._rx_start
+        if self._rx_start:
+            # move the unconsumed tail (a partial packet) to the front
+            self._rx_view[:size] = self._rx_view[self._rx_start:self._rx_end]
+            self._rx_start, self._rx_end = 0, size
+        if size < min_size:
+            n = self._readinto(self._rx_view[size:], min_size - size)
+            self.read_time = time.time()
+            if self.trace is not None and n:
+                self.trace.add(CAPTURE_READ, self._rx_view[size:size + n],
+                               self.read_time)
+            self._rx_end += n
+        return self._rx_end
+
+    def _consume(self, size):
+        '''Returns view of the next `size` bytes of the input buffer (or
+        less, if not available) and consumes them. The view is only valid
+        until the next read.'''
+        start = self._rx_start
+        self._rx_start = min(start + size, self._rx_end)
+        return self._rx_view[start:self._rx_start]
 
     def _read_descriptor(self):
         '''Reads descriptor packet'''
-        descriptor = self._serial.read(DESCRIPTOR_LEN)
-        self.logger.debug('Received descriptor: %s', _showhex(descriptor))
-        if len(descriptor) != DESCRIPTOR_LEN:
-            raise RPLidarException('Descriptor length mismatch')
-        elif not descriptor.startswith(SYNC_BYTE + SYNC_BYTE2):
-            raise RPLidarException('Incorrect descriptor starting bytes')
-        is_single = _b2i(descriptor[-2]) == 0
-        return _b2i(descriptor[2]), is_single, _b2i(descriptor[-1])
+        if self._rx_end - self._rx_start < DESCRIPTOR_LEN:
+            self._fill(DESCRIPTOR_LEN)
+        descriptor = self._consume(DESCRIPTOR_LEN).tobytes()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Received descriptor: %s',
+                              _showhex(descriptor))
+        return _parse_descriptor(descriptor)
+
+    def _read_packet(self, dsize):
+        '''Reads packet with length of `dsize` bytes, returns view of the
+        input buffer valid until the next read'''
+        while self._rx_end - self._rx_start < dsize:
+            self._fill(dsize)
+        return self._consume(dsize)
+
+    def _resync(self, dsize):
+        '''Skips input bytes up to the first offset starting valid packets
+        of the current scan mode (`RESYNC_PACKETS` consecutive ones in
+        normal mode, as in `_process_scan_batch`). Returns number of bytes
+        skipped.'''
+        if self.scanning[2] in ('normal', 'force'):
+            flags, confirm = _scan_packet_flags, RESYNC_PACKETS
+        else:
+            def flags(buf):
+                return _capsule_packet_flags(buf, dsize)
+            confirm = 1
+        total = 0
+        while True:
+            need = (confirm + 1) * dsize
+            while self._rx_end - self._rx_start < need:
+                self._fill(need)
+            buf = np.frombuffer(self._rx_view[self._rx_start:self._rx_end],
+                                dtype=np.uint8)
+            confirmed = _confirmed_packets(flags(buf), dsize, confirm)
+            hits = np.flatnonzero(confirmed)
+            # offsets before the last packets are checked once more arrived
+            skipped = int(hits[0]) if len(hits) else len(confirmed)
+            self._rx_start += skipped
+            total += skipped
+            if len(hits):
+                break
+        self.skipped_bytes += total
+        if total:
+            self.logger.warning('Resynchronized after %d corrupted bytes',
+                                total)
+        return total
+
+    def _read_valid_packet(self, dsize, decode):
+        '''Reads packet with length of `dsize` bytes and decodes it with
+        `decode`. Corrupted packets are skipped by resynchronizing on the
+        stream (see `_resync`) instead of raising.
+
+        Returns
+        -------
+        packet
+            Output of `decode`
+        skipped : int
+            Number of bytes skipped before the packet
+        '''
+        skipped = 0
+        while True:
+            packet = self._read_packet(dsize)
+            try:
+                return decode(packet), skipped
+            except (RPLidarException, ValueError):
+                self._rx_start -= dsize
+                skipped += self._resync(dsize)
+
+    def _drop_input(self):
+        '''Drops all the bytes received without stopping the scan, packets
+        boundary is found again by resynchronization. Returns number of
+        bytes dropped.'''
+        dropped = self._waiting()
+        self._serial.flushInput()
+        self._rx_start = self._rx_end = 0
+        self.express_trame = 32
+        self.express_data = False
+        self.dropped_bytes += dropped
+        return dropped
 
     def _read_response(self, dsize):
         '''Reads response packet with length of `dsize` bytes'''
-        self.logger.debug('Trying to read response: %d bytes', dsize)
-        while self._serial.inWaiting() < dsize:
-            time.sleep(0.001)
-        data = self._serial.read(dsize)
-        self.logger.debug('Received data: %s', _showhex(data))
+        data = self._read_packet(dsize).tobytes()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Received data: %s', _showhex(data))
         return data
 
+    def _read_available(self, min_size):
+        '''Reads all the bytes available in the input buffer, blocking until
+        at least `min_size` bytes arrived or serial timeout expired'''
+        self._fill(min_size)
+        return self._consume(self._rx_end - self._rx_start).tobytes()
+
     def get_info(self):
         '''Get device information
 
@@ -237,27 +1002,12 @@ class RPLidar(object):
         dict
             Dictionary with the sensor information
         '''
-        if self._serial.inWaiting() > 0:
+        if self._waiting() > 0:
             return ('Data in buffer, you can\'t have info ! '
                     'Run clean_input() to emptied the buffer.')
         self._send_cmd(GET_INFO_BYTE)
-        dsize, is_single, dtype = self._read_descriptor()
-        if dsize != INFO_LEN:
-            raise RPLidarException('Wrong get_info reply length')
-        if not is_single:
-            raise RPLidarException('Not a single response mode')
-        if dtype != INFO_TYPE:
-            raise RPLidarException('Wrong response data type')
-        raw = self._read_response(dsize)
-        serialnumber = codecs.encode(raw[4:], 'hex').upper()
-        serialnumber = codecs.decode(serialnumber, 'ascii')
-        data = {
-            'model': _b2i(raw[0]),
-            'firmware': (_b2i(raw[2]), _b2i(raw[1])),
-            'hardware': _b2i(raw[3]),
-            'serialnumber': serialnumber,
-        }
-        return data
+        _check_descriptor(self._read_descriptor(), INFO_LEN, True, INFO_TYPE)
+        return _parse_info(self._read_response(INFO_LEN))
 
     def get_health(self):
         '''Get device health state. When the core system detects some
@@ -274,28 +1024,127 @@ class RPLidar(object):
         error_code : int
             The related error code that caused a warning/error.
         '''
-        if self._serial.inWaiting() > 0:
+        if self._waiting() > 0:
             return ('Data in buffer, you can\'t have info ! '
                     'Run clean_input() to emptied the buffer.')
         self.logger.info('Asking for health')
         self._send_cmd(GET_HEALTH_BYTE)
+        _check_descriptor(self._read_descriptor(), HEALTH_LEN, True,
+                          HEALTH_TYPE)
+        return _parse_health(self._read_response(HEALTH_LEN))
+
+    def get_lidar_conf(self, conf_type, payload=b''):
+        '''Get lidar configuration entry
+
+        Parameters
+        ----------
+        conf_type : int
+            Configuration entry, one of CONF_* constants
+        payload : bytes, optional
+            Entry argument, such as the scan mode id
+
+        Returns
+        -------
+        bytes
+            Entry data
+        '''
+        self._send_payload_cmd(GET_LIDAR_CONF_BYTE,
+                               struct.pack('<I', conf_type) + payload)
         dsize, is_single, dtype = self._read_descriptor()
-        if dsize != HEALTH_LEN:
-            raise RPLidarException('Wrong get_info reply length')
-        if not is_single:
-            raise RPLidarException('Not a single response mode')
-        if dtype != HEALTH_TYPE:
+        if not is_single or dtype != LIDAR_CONF_TYPE or dsize < 4:
             raise RPLidarException('Wrong response data type')
         raw = self._read_response(dsize)
-        status = _HEALTH_STATUSES[_b2i(raw[0])]
-        error_code = (_b2i(raw[1]) << 8) + _b2i(raw[2])
-        return status, error_code
+        if struct.unpack('<I', raw[:4])[0] != conf_type:
+            raise RPLidarException('Wrong configuration entry')
+        return raw[4:]
+
+    def get_scan_modes(self):
+        '''Get the scan modes supported by the sensor
+
+        Returns
+        -------
+        list
+            `ScanMode` of every mode, by id
+        '''
+        count, = struct.unpack(
+            '<H', self.get_lidar_conf(CONF_SCAN_MODE_COUNT)[:2])
+        modes = []
+        for mode in range(count):
+            arg = struct.pack('<H', mode)
+            us_per_sample, = struct.unpack('<I', self.get_lidar_conf(
+                CONF_SCAN_MODE_US_PER_SAMPLE, arg)[:4])
+            max_distance, = struct.unpack('<I', self.get_lidar_conf(
+                CONF_SCAN_MODE_MAX_DISTANCE, arg)[:4])
+            ans_type = _b2i(self.get_lidar_conf(
+                CONF_SCAN_MODE_ANS_TYPE, arg)[0])
+            name = self.get_lidar_conf(CONF_SCAN_MODE_NAME, arg)
+            modes.append(ScanMode(
+                mode, name.split(b'\x00')[0].decode('ascii', 'replace'),
+                us_per_sample / 256., max_distance / 256., ans_type))
+        return modes
+
+    def _discover_scan_modes(self):
+        '''Returns the scan modes supported by the sensor, empty list if
+        the firmware doesn't answer the configuration queries'''
+        try:
+            modes = self.get_scan_modes()
+        except (RPLidarException, struct.error, IndexError) as err:
+            self.logger.info('Scan modes discovery failed: %s', err)
+            self._serial.flushInput()
+            self._rx_start = self._rx_end = 0
+            return []
+        for mode in modes:
+            self.logger.info('Scan mode %d %s: %.1f us/sample, %.1f m, %s',
+                             mode.id, mode.name, mode.us_per_sample,
+                             mode.max_distance,
+                             _ANS_SCAN_TYPE.get(mode.ans_type, 'unsupported'))
+        return modes
+
+    def fastest_scan_mode(self):
+        '''Returns the discovered scan mode with the shortest sample
+        duration among the ones that can be decoded, None if none was
+        discovered'''
+        modes = [mode for mode in self.scan_modes
+                 if mode.ans_type in _ANS_SCAN_TYPE]
+        if not modes:
+            return None
+        return min(modes, key=lambda mode: mode.us_per_sample)
+
+    def _resolve_scan_mode(self, scan_type):
+        '''Returns scan type and discovered scan mode to start `scan_type`
+        with, see `start`'''
+        if scan_type == 'auto':
+            mode = self.fastest_scan_mode()
+            if mode is None:
+                self.logger.warning('No scan mode discovered, '
+                                    'falling back to normal mode')
+                return 'normal', None
+            return _ANS_SCAN_TYPE[mode.ans_type], mode
+        if scan_type in ('ultra', 'dense'):
+            response = _SCAN_TYPE[scan_type]['response']
+            modes = [mode for mode in self.scan_modes
+                     if mode.ans_type == response]
+            if not modes:
+                raise RPLidarException('No %s scan mode discovered, see '
+                                       'get_scan_modes' % scan_type)
+            return scan_type, min(modes, key=lambda mode: mode.us_per_sample)
+        if scan_type in _SCAN_TYPE:
+            return scan_type, None
+        for mode in self.scan_modes:
+            if mode.name == scan_type:
+                if mode.ans_type not in _ANS_SCAN_TYPE:
+                    raise RPLidarException(
+                        'Scan mode %s answer type 0x%02X is not supported'
+                        % (mode.name, mode.ans_type))
+                return _ANS_SCAN_TYPE[mode.ans_type], mode
+        raise RPLidarException('Unknown scan mode %s' % scan_type)
 
     def clean_input(self):
         '''Clean input buffer by reading all available data'''
         if self.scanning[0]:
             return 'Cleanning not allowed during scanning process active !'
         self._serial.flushInput()
+        self._rx_start = self._rx_end = 0
         self.express_trame = 32
         self.express_data = False
 
@@ -313,7 +1162,10 @@ class RPLidar(object):
 
         Parameters
         ----------
-        scan : normal, force or express.
+        scan : normal, force, express, ultra, dense, auto or the name of
+            a discovered scan mode. 'auto' starts the fastest discovered
+            mode (see `fastest_scan_mode`), ultra and dense the fastest
+            discovered mode of that type.
         '''
         if self.scanning[0]:
             return 'Scanning already running !'
@@ -333,22 +1185,23 @@ class RPLidar(object):
             self.logger.warning('Warning sensor status detected! '
                                 'Error code: %d', error_code)
 
+        scan_type, mode = self._resolve_scan_mode(scan_type)
         cmd = _SCAN_TYPE[scan_type]['byte']
         self.logger.info('starting scan process in %s mode' % scan_type)
 
-        if scan_type == 'express':
-            self._send_payload_cmd(cmd, b'\x00\x00\x00\x00\x00')
+        if cmd == _SCAN_TYPE['express']['byte']:
+            # working mode 0 is the legacy express scan
+            working_mode = mode.id if scan_type != 'express' else 0
+            self._send_payload_cmd(cmd, struct.pack('<BHH', working_mode,
+                                                    0, 0))
         else:
             self._send_cmd(cmd)
 
-        dsize, is_single, dtype = self._read_descriptor()
-        if dsize != _SCAN_TYPE[scan_type]['size']:
-            raise RPLidarException('Wrong get_info reply length')
-        if is_single:
-            raise RPLidarException('Not a multiple response mode')
-        if dtype != _SCAN_TYPE[scan_type]['response']:
-            raise RPLidarException('Wrong response data type')
+        dsize = _SCAN_TYPE[scan_type]['size']
+        _check_descriptor(self._read_descriptor(), dsize, False,
+                          _SCAN_TYPE[scan_type]['response'])
         self.scanning = [True, dsize, scan_type]
+        self.scan_mode = mode
 
     def reset(self):
         '''Resets sensor core, reverting it to a similar state as it has
@@ -363,11 +1216,17 @@ class RPLidar(object):
         otherwise data will be accumulated inside buffer and consumer will get
         data with increasing lag.
 
+        Corrupted packets are skipped by resynchronizing on the stream
+        instead of raising `RPLidarException`, skipped bytes are counted in
+        `skipped_bytes`.
+
         Parameters
         ----------
         max_buf_meas : int or False if you want unlimited buffer
             Maximum number of bytes to be stored inside the buffer. Once
-            numbe exceeds this limit buffer will be emptied out.
+            numbe exceeds this limit buffer will be emptied out, without
+            restarting the scan. Dropped bytes are counted in
+            `dropped_bytes`.
 
         Yields
         ------
@@ -384,6 +1243,7 @@ class RPLidar(object):
         self.start_motor()
         if not self.scanning[0]:
             self.start(scan_type)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         while True:
             dsize = self.scanning[1]
             if max_buf_meas:
@@ -393,33 +1253,52 @@ class RPLidar(object):
                         'Too many bytes in the input buffer: %d/%d. '
                         'Cleaning buffer...',
                         data_in_buf, max_buf_meas)
-                    self.stop()
-                    self.start(self.scanning[2])
+                    self._drop_input()
+                    self._resync(dsize)
 
             if self.scanning[2] == 'normal':
-                raw = self._read_response(dsize)
-                yield _process_scan(raw)
+                yield self._read_valid_packet(dsize, _process_scan)[0]
+            if self.scanning[2] in ('ultra', 'dense'):
+                # capsules are only decoded in bulk
+                measures = self._read_batch(dsize)
+                for measure in measures[['new_scan', 'quality', 'angle',
+                                         'distance']].tolist():
+                    yield measure
             if self.scanning[2] == 'express':
                 if self.express_trame == 32:
                     self.express_trame = 0
+                    # level checked once per packet, not per measure
+                    debug = self.logger.isEnabledFor(logging.DEBUG)
                     if not self.express_data:
-                        self.logger.debug('reading first time bytes')
-                        self.express_data = ExpressPacket.from_string(
-                                            self._read_response(dsize))
+                        if debug:
+                            self.logger.debug('reading first time bytes')
+                        self.express_data = self._read_valid_packet(
+                            dsize, ExpressPacket.from_string)[0]
 
                     self.express_old_data = self.express_data
-                    self.logger.debug('set old_data with start_angle %f',
-                                      self.express_old_data.start_angle)
-                    self.express_data = ExpressPacket.from_string(
-                                        self._read_response(dsize))
-                    self.logger.debug('set new_data with start_angle %f',
-                                      self.express_data.start_angle)
+                    if debug:
+                        self.logger.debug(
+                            'set old_data with start_angle %f',
+                            self.express_old_data.start_angle)
+                    self.express_data, skipped = self._read_valid_packet(
+                        dsize, ExpressPacket.from_string)
+                    while skipped:
+                        # angles can't be interpolated over lost packets
+                        self.express_old_data = self.express_data
+                        self.express_data, skipped = self._read_valid_packet(
+                            dsize, ExpressPacket.from_string)
+                    if debug:
+                        self.logger.debug(
+                            'set new_data with start_angle %f',
+                            self.express_data.start_angle)
 
                 self.express_trame += 1
-                self.logger.debug('process scan of frame %d with angle : '
-                                  '%f and angle new : %f', self.express_trame,
-                                  self.express_old_data.start_angle,
-                                  self.express_data.start_angle)
+                if debug:
+                    self.logger.debug(
+                        'process scan of frame %d with angle : %f and '
+                        'angle new : %f', self.express_trame,
+                        self.express_old_data.start_angle,
+                        self.express_data.start_angle)
                 yield _process_express_scan(self.express_old_data,
                                             self.express_data.start_angle,
                                             self.express_trame)
@@ -454,6 +1333,206 @@ class RPLidar(object):
             if distance > 0:
                 scan_list.append((quality, angle, distance))
 
+    def iter_measure_batches(self, scan_type='normal', max_buf_meas=3000):
+        '''Iterate over batches of measures. Every read takes all the bytes
+        waiting in the serial buffer and decodes them with NumPy at once,
+        which is much cheaper per measure than `iter_measures`. Bytes are
+        read into a reusable input buffer and decoded from views of it,
+        without copies. Corrupted packets are skipped instead of raising
+        `RPLidarException` and counted in `skipped_bytes`.
+
+        Parameters
+        ----------
+        scan_type : normal, force, express, ultra, dense or auto, see `start`
+        max_buf_meas : int or False if you want unlimited buffer
+            Maximum number of bytes to be stored inside the buffer. Once
+            numbe exceeds this limit buffer will be emptied out, without
+            restarting the scan.
+
+        Yields
+        ------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE` with `new_scan`, `quality`,
+            `angle` and `distance` fields. For values description please
+            refer to `iter_measures` method's documentation. `timestamp` of
+            all the measures is the time of the read. Empty if no data
+            arrived before the serial timeout.
+        '''
+        self.start_motor()
+        if not self.scanning[0]:
+            self.start(scan_type)
+        while True:
+            dsize = self.scanning[1]
+            if max_buf_meas:
+                data_in_buf = self._serial.inWaiting()
+                if data_in_buf > max_buf_meas:
+                    self.logger.warning(
+                        'Too many bytes in the input buffer: %d/%d. '
+                        'Cleaning buffer...',
+                        data_in_buf, max_buf_meas)
+                    self._drop_input()
+                    self._resync(dsize)
+
+            yield self._read_batch(dsize)
+
+    def _read_batch(self, dsize):
+        '''Reads the bytes waiting in the serial buffer, at least a packet
+        of `dsize` bytes, and decodes them at once with the decoder of the
+        current scan mode, see `iter_measure_batches`'''
+        # unconsumed bytes of the previous read (partial packet) are kept in
+        # front of the buffer, like a serial read wait for a packet worth of
+        # new bytes. Mode switches (see ScanController) go through stop(),
+        # which empties the buffer.
+        end = self._fill(self._rx_end - self._rx_start + dsize)
+        raw = self._rx_view[self._rx_start:end]
+        measures, consumed, skipped = _BATCH_DECODERS[self.scanning[2]](raw)
+        if skipped:
+            self.skipped_bytes += skipped
+            self.logger.warning('Skipped %d corrupted bytes', skipped)
+        measures['timestamp'] = self.read_time
+        self._rx_start += consumed
+        return measures
+
+    def iter_windows(self, scan_type='normal', max_buf_meas=3000,
+                     samples=None):
+        '''Iterate over windows of consecutive measures, so that consumers
+        can classify all of them at once (see `ZoneClassifier.slot`)
+        instead of sampling some. A window is closed by the new scan flag,
+        i.e. one window per revolution, or after `samples` measures.
+
+        Parameters
+        ----------
+        scan_type : normal, force, express, ultra, dense or auto, see `start`
+        max_buf_meas : int or False if you want unlimited buffer
+            Maximum number of bytes to be stored inside the buffer. Once
+            numbe exceeds this limit buffer will be emptied out.
+        samples : int, optional
+            Number of measures per window, windows follow new scan flags
+            if None or 0
+
+        Yields
+        ------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE` with all the measures of
+            the window
+        '''
+        pending = []
+        count = 0
+        for measures in self.iter_measure_batches(scan_type, max_buf_meas):
+            if samples:
+                ends = np.arange(samples - count, len(measures) + 1, samples)
+            else:
+                ends = np.flatnonzero(measures['new_scan'])
+            prev = 0
+            for end in ends:
+                if end > prev:
+                    pending.append(measures[prev:end])
+                if pending:
+                    yield (pending[0] if len(pending) == 1
+                           else np.concatenate(pending))
+                pending = []
+                prev = end
+            if prev < len(measures):
+                pending.append(measures[prev:])
+            count = sum(len(chunk) for chunk in pending)
+
+    def iter_frames(self, scan_type='normal', max_buf_meas=3000, bins=720):
+        '''Iterate over full revolutions binned into fixed angular resolution.
+        Two `ScanFrame` buffers are allocated once and filled in turn, so
+        yielded frame stays unchanged until the next-but-one frame is
+        requested. Measures preceding the first new scan flag are dropped.
+
+        Parameters
+        ----------
+        scan_type : normal, force, express, ultra, dense or auto, see `start`
+        max_buf_meas : int or False if you want unlimited buffer
+            Maximum number of bytes to be stored inside the buffer. Once
+            numbe exceeds this limit buffer will be emptied out.
+        bins : int
+            Number of angular bins per revolution
+
+        Yields
+        ------
+        frame : ScanFrame
+            Frame of the completed revolution
+        '''
+        frames = (ScanFrame(bins), ScanFrame(bins))
+        frame = None
+        revolution = 0
+        for measures in self.iter_measure_batches(scan_type, max_buf_meas):
+            prev = 0
+            for start in np.flatnonzero(measures['new_scan']):
+                if frame is not None:
+                    frame.add(measures[prev:start])
+                    frame.finish()
+                    yield frame
+                frame = frames[revolution % 2]
+                frame.clear(revolution)
+                revolution += 1
+                prev = start
+            if frame is not None:
+                frame.add(measures[prev:])
+
+    def start_reader(self, scan_type='normal', capacity=8192,
+                     max_buf_meas=3000, controller=None):
+        '''Starts background thread which reads and decodes measures into a
+        ring buffer, so that slow consumers never stall the serial port.
+        Instead of cleaning the buffer on overflow, overruns are counted in
+        `MeasureRing.serial_overruns`.
+
+        Parameters
+        ----------
+        scan_type : normal, force, express, ultra, dense or auto, see `start`
+        capacity : int
+            Number of the latest measures kept in the ring buffer
+        max_buf_meas : int or False
+            Number of bytes in the serial input buffer above which reader is
+            considered to be late
+        controller : ScanController, optional
+            Controller fed with every batch of measures by the reader
+
+        Returns
+        -------
+        MeasureRing
+            Ring buffer filled by the reader thread
+        '''
+        if self._reader is not None:
+            return self.ring
+        self.ring = MeasureRing(capacity)
+        self.reader_error = None
+        self._reader_stop.clear()
+        self._reader = threading.Thread(
+            target=self._reader_loop,
+            args=(scan_type, max_buf_meas, controller),
+            name='rplidar-reader')
+        self._reader.daemon = True
+        self._reader.start()
+        return self.ring
+
+    def stop_reader(self):
+        '''Stops background reader thread. Sensor keeps scanning, call
+        `stop` to stop it.'''
+        if self._reader is None:
+            return
+        self._reader_stop.set()
+        self._reader.join()
+        self._reader = None
+
+    def _reader_loop(self, scan_type, max_buf_meas, controller=None):
+        '''Body of the reader thread'''
+        try:
+            for measures in self.iter_measure_batches(scan_type, False):
+                if max_buf_meas and self._serial.inWaiting() > max_buf_meas:
+                    self.ring.serial_overruns += 1
+                self.ring.write(measures)
+                if controller is not None:
+                    controller.update(measures)
+                if self._reader_stop.is_set():
+                    break
+        except Exception as err:
+            self.logger.error('Reader thread failed: %s', err)
+            self.reader_error = err
+
 
 class ExpressPacket(namedtuple('express_packet',
                                'distance angle new_scan start_angle')):
@@ -463,6 +1542,8 @@ class ExpressPacket(namedtuple('express_packet',
 
     @classmethod
     def from_string(cls, data):
+        # single packet, decoded in plain Python: NumPy calls cost more than
+        # the whole packet here (batches go through _unpack_express_cabins)
         packet = bytearray(data)
 
         if (packet[0] >> 4) != cls.sync1 or (packet[1] >> 4) != cls.sync2:
@@ -478,219 +1559,1896 @@ class ExpressPacket(namedtuple('express_packet',
         new_scan = packet[3] >> 7
         start_angle = (packet[2] + ((packet[3] & 0b01111111) << 8)) / 64
 
-        d = a = ()
-        for i in range(0,80,5):
-            d += ((packet[i+4] >> 2) + (packet[i+5] << 6),)
-            a += (((packet[i+8] & 0b00001111) + ((
-                    packet[i+4] & 0b00000001) << 4))/8*cls.sign[(
-                     packet[i+4] & 0b00000010) >> 1],)
-            d += ((packet[i+6] >> 2) + (packet[i+7] << 6),)
-            a += (((packet[i+8] >> 4) + (
-                (packet[i+6] & 0b00000001) << 4))/8*cls.sign[(
-                    packet[i+6] & 0b00000010) >> 1],)
-        return cls(d, a, new_scan, start_angle)
+        d = []
+        a = []
+        for i in range(4, 84, 5):
+            first, second, comp = packet[i], packet[i + 2], packet[i + 4]
+            d.append((first >> 2) + (packet[i + 1] << 6))
+            d.append((second >> 2) + (packet[i + 3] << 6))
+            a.append(((comp & 0b00001111) + ((first & 0b1) << 4)) /
+                     (-8. if first & 0b10 else 8.))
+            a.append(((comp >> 4) + ((second & 0b1) << 4)) /
+                     (-8. if second & 0b10 else 8.))
+        return cls(tuple(d), tuple(a), new_scan, start_angle)
+
+
+# Scan mode reported by the sensor: working mode id, name, sample duration
+# in microseconds, max distance in meters and answer type, i.e. the
+# `_SCAN_TYPE` response of its packets (see RPLidar.get_scan_modes)
+ScanMode = namedtuple('scan_mode',
+                      'id name us_per_sample max_distance ans_type')
+
+
+class MeasureRing(object):
+    '''Preallocated ring buffer of decoded measures. It has a single writer
+    (reader thread) and any number of consumers which never block it: they
+    copy data out and retry if it was overwritten meanwhile.
+
+    Writes are published seqlock style: `reserved` is advanced before the
+    slots are overwritten and `written` once they are in place, so a copy
+    is valid if none of its measures is older than `reserved - capacity`
+    once it is done.
+
+    Counters of the ring are only updated by the writer: `dropped` counts
+    measures beyond the capacity of a single write, `serial_overruns` the
+    serial input buffer overflows (see `RPLidar.start_reader`). Consumers
+    reading every measure keep their own counts, see `RingReader`.'''
+
+    def __init__(self, capacity=8192):
+        '''Initilize ring buffer.
+
+        Parameters
+        ----------
+        capacity : int
+            Number of measures stored in the buffer
+        '''
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=MEASURE_DTYPE)
+        self._scans = deque(maxlen=16)
+        self.written = 0
+        self.reserved = 0
+        self.dropped = 0
+        self.serial_overruns = 0
+
+    def write(self, measures):
+        '''Appends measures to the buffer, overwriting the oldest ones.
+        Measures beyond the capacity are dropped, counted in `dropped` and
+        still in `written`.'''
+        total = len(measures)
+        measures = measures[-self.capacity:]
+        self.dropped += total - len(measures)
+        # readers of the slots about to be overwritten must retry
+        self.reserved = self.written + total
+        base = self.reserved - len(measures)
+        start = base % self.capacity
+        first = min(len(measures), self.capacity - start)
+        self._data[start:start + first] = measures[:first]
+        self._data[:len(measures) - first] = measures[first:]
+        # publish measures, then the revolutions, only once they are in
+        # place
+        self.written = self.reserved
+        for i in np.flatnonzero(measures['new_scan']):
+            self._scans.append(base + int(i))
+
+    def _copy(self, begin, end):
+        '''Copies measures with absolute indices [begin, end). Returns None
+        if some of them were overwritten during the copy.'''
+        idx = np.arange(begin, end) % self.capacity
+        out = self._data[idx]
+        # also covers a write in progress, see `write`
+        if self.reserved - self.capacity > begin:
+            return None
+        return out
+
+    def latest(self, count):
+        '''Returns copy of the latest `count` measures (or less if there are
+        not enough of them yet)'''
+        while True:
+            end = self.written
+            begin = max(end - min(count, self.capacity), 0)
+            out = self._copy(begin, end)
+            if out is not None:
+                return out
+
+    @property
+    def last_scan(self):
+        '''Absolute index of the latest new scan measure, -1 if none'''
+        scans = self._scans
+        return scans[-1] if scans else -1
+
+    def latest_scan(self):
+        '''Returns copy of the latest full revolution or None if there is no
+        complete revolution in the buffer'''
+        while True:
+            scans = list(self._scans)
+            if len(scans) < 2 or scans[-1] - scans[-2] > self.capacity:
+                return None
+            out = self._copy(scans[-2], scans[-1])
+            if out is not None:
+                return out
+
+
+class RingReader(object):
+    '''Consumer of a `MeasureRing` reading every measure once, in order.
+    Every consumer thread has its own reader, whose counters are only
+    updated by that thread:
+
+    - lost: measures overwritten (or dropped by the writer) before they
+      could be read
+    - torn: copies retried because the writer overwrote them meanwhile'''
+
+    def __init__(self, ring, cursor=0):
+        '''Initilize reader.
+
+        Parameters
+        ----------
+        ring : MeasureRing
+            Ring buffer to read
+        cursor : int
+            Absolute index of the first measure to read: 0 for the first
+            one ever written, `ring.written` to only read the next ones
+        '''
+        self.ring = ring
+        self.cursor = cursor
+        self.lost = 0
+        self.torn = 0
+
+    def read(self):
+        '''Returns all the measures written since the previous read, as a
+        structured array of `MEASURE_DTYPE`'''
+        ring = self.ring
+        cursor = self.cursor
+        while True:
+            end = ring.written
+            begin = max(cursor, end - ring.capacity)
+            out = ring._copy(begin, end)
+            if out is not None:
+                break
+            self.torn += 1
+            cursor = max(begin, ring.reserved - ring.capacity)
+        self.lost += begin - self.cursor
+        self.cursor = end
+        return out
+
+
+class PointFilter(object):
+    '''Filtering stage between decoding and zone classification, run over
+    a revolution (or any run of consecutive measures) at once:
+
+    - quality: drops measures weaker than `min_quality`
+    - median: drops measures farther than `median_tolerance` (relative)
+      from the median distance of their `median_window` neighbours, e.g.
+      mixed pixels between an edge and the background
+    - isolation: drops measures with both angular neighbours farther than
+      `isolation` times their distance (at least `min_gap` mm), e.g.
+      specular glitches
+
+    Runs are circular by default, as a revolution: the first and last
+    measures are neighbours. Every pass is O(n). Dropped measures are
+    counted per filter and logged every `stats_period` seconds, each
+    measure must be filtered once for the counts to add up.'''
+
+    def __init__(self, min_quality=10, median_window=5, median_tolerance=0.2,
+                 isolation=0.1, min_gap=50., stats_period=10, logger=None):
+        '''Initilize filter. Setting `min_quality`, `median_window` or
+        `isolation` to 0 disables the corresponding pass. Quality pass is
+        skipped for measures without any quality, as in express mode.'''
+        self.min_quality = min_quality
+        self.median_window = median_window
+        self.median_tolerance = median_tolerance
+        self.isolation = isolation
+        self.min_gap = min_gap
+        self.stats_period = stats_period
+        if logger is None:
+            logger = logging.getLogger('rplidar')
+        self.logger = logger
+        self.passed = 0
+        self.dropped_invalid = 0
+        self.dropped_quality = 0
+        self.dropped_median = 0
+        self.dropped_isolated = 0
+        self._last_report = time.time()
+
+    def apply(self, measures, wrap=True):
+        '''Returns the measures passing all the filters.
+
+        Parameters
+        ----------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE`, in angular order
+        wrap : bool
+            Whether the run is a whole revolution, otherwise the measures
+            at its ends only have neighbours on one side
+
+        Returns
+        -------
+        numpy.ndarray
+            Copy of the kept measures
+        '''
+        return measures[self.mask(measures, wrap)]
+
+    def mask(self, measures, wrap=True):
+        '''Same as `apply`, returns the mask of the kept measures instead
+        of a copy of them.'''
+        keep = measures['distance'] > 0
+        self.dropped_invalid += len(keep) - int(keep.sum())
+        if self.min_quality and measures['quality'].any():
+            ok = measures['quality'] >= self.min_quality
+            self.dropped_quality += int((keep & ~ok).sum())
+            keep &= ok
+        index = np.flatnonzero(keep)
+        distance = measures['distance'][index]
+
+        half = self.median_window // 2
+        if half and len(index) > 2 * half:
+            # ends of an open run are compared with their mirrored
+            # neighbours
+            padded = np.pad(distance, half, mode='wrap' if wrap else 'reflect')
+            windows = np.lib.stride_tricks.sliding_window_view(
+                padded, self.median_window)
+            median = np.median(windows, axis=1)
+            ok = np.abs(distance - median) <= self.median_tolerance * median
+            self.dropped_median += len(ok) - int(ok.sum())
+            index = index[ok]
+            distance = distance[ok]
+
+        if self.isolation and len(index) > 2:
+            x, y = polar_to_xy(measures['angle_q6'][index], distance)
+            gap = np.hypot(x - np.roll(x, 1), y - np.roll(y, 1))
+            if not wrap:
+                gap[0] = np.inf
+            limit = np.maximum(self.isolation * distance, self.min_gap)
+            near_prev = gap <= limit
+            near_next = np.roll(gap, -1) <= limit
+            ok = near_prev | near_next
+            self.dropped_isolated += len(ok) - int(ok.sum())
+            index = index[ok]
+
+        self.passed += len(index)
+        if (self.stats_period and
+                time.time() - self._last_report > self.stats_period):
+            self._last_report = time.time()
+            self.logger.info('Point filter: %(passed)d passed, dropped '
+                             '%(invalid)d invalid, %(quality)d quality, '
+                             '%(median)d median, %(isolated)d isolated',
+                             self.stats())
+        keep = np.zeros(len(measures), dtype=np.bool_)
+        keep[index] = True
+        return keep
+
+    def stats(self):
+        '''Returns number of measures passed and dropped by every filter'''
+        return {
+            'passed': self.passed,
+            'invalid': self.dropped_invalid,
+            'quality': self.dropped_quality,
+            'median': self.dropped_median,
+            'isolated': self.dropped_isolated,
+        }
+
+
+class ScanController(object):
+    '''Adapts motor speed and scan mode of a sensor to a target rotation
+    rate. Rotation rate and points per revolution are measured from the new
+    scan flags of the decoded measures; every `settle` revolutions the PWM
+    is corrected in proportion to the rate error (rotation rate is roughly
+    proportional to PWM), and the slowest mode whose sample rate reaches
+    the target angular resolution at the target rate is selected.
+
+    The target rate can follow robot speed with `set_speed`: a fast robot
+    needs fresh scans, a slow one benefits from finer resolution.'''
+
+    def __init__(self, lidar, target_rps=10., resolution=None, min_rps=5.,
+                 max_rps=15., gain=0.7, settle=3, modes=('normal', 'express'),
+                 logger=None):
+        '''Initilize controller.
+
+        Parameters
+        ----------
+        lidar : RPLidar
+            Controlled sensor
+        target_rps : float
+            Revolutions per second to hold
+        resolution : float, optional
+            Target angular resolution in degrees, the scan mode is left
+            unchanged if None
+        min_rps, max_rps : float
+            Rotation rates at rest and at full speed of the robot
+        gain : float
+            Fraction of the PWM correction applied at once
+        settle : int
+            Revolutions measured between two corrections
+        modes : tuple
+            Candidate scan modes, by order of preference
+        logger : logging.Logger instance, optional
+            Logger instance, if none is provided sensor's one is used
+        '''
+        self.lidar = lidar
+        self.target_rps = target_rps
+        self.resolution = resolution
+        self.min_rps = min_rps
+        self.max_rps = max_rps
+        self.gain = gain
+        self.settle = settle
+        self.modes = modes
+        self.logger = logger or lidar.logger
+        self.rps = 0.
+        self.points = 0.
+        self.adjustments = 0
+        self._revolutions = []
+        self._count = 0
+
+    def set_speed(self, speed, max_speed):
+        '''Sets target rate from robot speed, from `min_rps` at rest to
+        `max_rps` at `max_speed`'''
+        ratio = min(max(speed / float(max_speed), 0.), 1.)
+        self.target_rps = self.min_rps + (self.max_rps - self.min_rps) * ratio
+
+    def update(self, measures):
+        '''Measures rotation from a batch of measures, adjusting PWM and
+        scan mode once enough revolutions were seen.
+
+        Returns
+        -------
+        bool
+            True if PWM or scan mode were changed
+        '''
+        starts = np.flatnonzero(measures['new_scan'])
+        if not len(starts):
+            self._count += len(measures)
+            return False
+        counts = np.diff(np.r_[-self._count, starts])
+        self._count = len(measures) - int(starts[-1])
+        stamp = float(measures['timestamp'][0]) if len(measures) else 0
+        for count in counts.tolist():
+            self._revolutions.append((stamp, count))
+        if len(self._revolutions) <= self.settle:
+            return False
+        stamps, counts = zip(*self._revolutions)
+        # first revolution may be partial and stamps of one batch are equal
+        span = stamps[-1] - stamps[0]
+        self._revolutions = self._revolutions[-1:]
+        if span <= 0:
+            return False
+        self.rps = (len(stamps) - 1) / span
+        self.points = float(np.mean(counts[1:]))
+        return self._adjust()
+
+    def _adjust(self):
+        '''Corrects PWM and scan mode from measured `rps` and `points`'''
+        changed = False
+        pwm = self.lidar.motor_speed
+        ideal = pwm * self.target_rps / self.rps
+        new_pwm = int(round(pwm + self.gain * (ideal - pwm)))
+        new_pwm = min(max(new_pwm, 1), MAX_MOTOR_PWM)
+        if new_pwm != pwm:
+            self.lidar.motor_speed = new_pwm
+            changed = True
+
+        mode = self.lidar.scanning[2]
+        if self.resolution and mode in SCAN_SAMPLE_RATES:
+            # sample rates of the modes, scaled to the measured one
+            rate = self.rps * self.points / SCAN_SAMPLE_RATES[mode]
+            needed = 360. * self.target_rps / self.resolution
+            best = self.modes[-1]
+            for candidate in self.modes:
+                if rate * SCAN_SAMPLE_RATES[candidate] >= needed:
+                    best = candidate
+                    break
+            if best != mode:
+                self.logger.info('Switching scan mode %s -> %s', mode, best)
+                self.lidar.stop()
+                self.lidar.start(best)
+                self._revolutions = []
+                self._count = 0
+                changed = True
+        if changed:
+            self.adjustments += 1
+            self.logger.debug('%.2f rps, %.0f points per revolution, PWM %d',
+                              self.rps, self.points, self.lidar.motor_speed)
+        return changed
+
+
+MountPose = namedtuple('mount_pose', 'x y yaw')
+
+
+def mount_measures(measures, pose):
+    '''Moves measures from the sensor frame to the robot frame.
+
+    Parameters
+    ----------
+    measures : numpy.ndarray
+        Structured array of `MEASURE_DTYPE`
+    pose : MountPose
+        Sensor position in mm (x forward, y to the right of the robot
+        centre) and heading in degrees clockwise from the robot front
+
+    Returns
+    -------
+    numpy.ndarray
+        Copy of the valid (non 0 distance) measures with angles and
+        distances relative to the robot centre
+    '''
+    out = measures[measures['distance'] > 0]
+    yaw = int(round(pose.yaw * ANGLE_Q6_SCALE))
+    x, y = polar_to_xy((out['angle_q6'].astype(np.intp) + yaw) %
+                       ANGLE_Q6_TURN, out['distance'])
+    x += pose.x
+    y += pose.y
+    angle = np.degrees(np.arctan2(y, x)) % 360
+    out['distance'] = np.hypot(x, y)
+    out['angle'] = angle
+    out['angle_q6'] = (angle * ANGLE_Q6_SCALE).astype(np.uint16) % ANGLE_Q6_TURN
+    return out
+
+
+class LidarManager(object):
+    '''Drives several sensors concurrently and fuses their revolutions in
+    the robot frame. Every sensor is read and decoded by its own reader
+    thread (see `RPLidar.start_reader`), so a slow or dead sensor doesn't
+    hold back the others.'''
+
+    def __init__(self, mounts, scan_type='normal', capacity=8192,
+                 max_age=0.2, point_filter=None, target_rps=None,
+                 resolution=None, logger=None):
+        '''Initilize manager, connecting to all the sensors.
+
+        Parameters
+        ----------
+        mounts : sequence
+            (port, x, y, yaw) of every sensor, see `MountPose`. Port may be
+            an opened transport as for `RPLidar`.
+        scan_type : normal, force, express, ultra, dense or auto, see `start`
+        capacity : int
+            Measures kept in the ring buffer of every sensor
+        max_age : float
+            Revolutions received more than `max_age` seconds ago are left
+            out of the fusion, and fusion doesn't wait longer than that for
+            late sensors
+        point_filter : PointFilter, optional
+            Filter applied to the revolutions of every sensor before fusion
+        target_rps : float, optional
+            Rotation rate every sensor's `ScanController` holds, None to
+            keep motors at their default PWM
+        resolution : float, optional
+            Target angular resolution, see `ScanController`
+        logger : logging.Logger instance, optional
+            Logger instance, if none is provided new instance is created
+        '''
+        if logger is None:
+            logger = logging.getLogger('rplidar')
+        self.logger = logger
+        self.point_filter = point_filter
+        self.scan_type = scan_type
+        self.capacity = capacity
+        self.max_age = max_age
+        self.poses = [MountPose(x, y, yaw) for _, x, y, yaw in mounts]
+        discover = scan_type not in ('normal', 'force', 'express')
+        self.lidars = [RPLidar(port, logger=logger, discover=discover)
+                       for port, _, _, _ in mounts]
+        self.controllers = [None] * len(self.lidars)
+        if target_rps is not None:
+            self.controllers = [ScanController(lidar, target_rps, resolution)
+                                for lidar in self.lidars]
+        self.rings = []
+
+    def start(self):
+        '''Starts the reader threads of all the sensors'''
+        self.rings = [lidar.start_reader(self.scan_type, self.capacity,
+                                         controller=controller)
+                      for lidar, controller in zip(self.lidars,
+                                                   self.controllers)]
+
+    def stop(self):
+        '''Stops all the sensors and disconnects from them'''
+        for lidar in self.lidars:
+            lidar.stop_reader()
+            lidar.stop()
+            lidar.stop_motor()
+            lidar.disconnect()
+
+    def fuse(self):
+        '''Returns the latest revolutions of all the sensors, younger than
+        `max_age`, in the robot frame as a single array of `MEASURE_DTYPE`'''
+        now = time.time()
+        parts = []
+        for ring, pose in zip(self.rings, self.poses):
+            scan = ring.latest_scan()
+            if scan is None or not len(scan):
+                continue
+            if now - scan['timestamp'][-1] > self.max_age:
+                continue
+            if self.point_filter is not None:
+                scan = self.point_filter.apply(scan)
+            parts.append(mount_measures(scan, pose))
+        if not parts:
+            return np.empty(0, dtype=MEASURE_DTYPE)
+        return np.concatenate(parts)
+
+    def iter_revolutions(self, poll=0.005):
+        '''Iterate over fused revolutions. A fusion is yielded once every
+        sensor completed a new revolution, or `max_age` after the first
+        one did if some are late.
+
+        Yields
+        ------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE` in the robot frame
+        '''
+        if not self.rings:
+            self.start()
+        seen = [ring.last_scan for ring in self.rings]
+        first = None
+        while True:
+            for lidar in self.lidars:
+                if lidar.reader_error is not None:
+                    raise RPLidarException('Sensor %s failed: %s' % (
+                        lidar.port, lidar.reader_error))
+            last = [ring.last_scan for ring in self.rings]
+            new = sum(l != s for l, s in zip(last, seen))
+            if new and first is None:
+                first = time.time()
+            if new == len(last) or (
+                    new and time.time() - first > self.max_age):
+                seen = last
+                first = None
+                yield self.fuse()
+            else:
+                time.sleep(poll)
+
+
+class RecordingSerial(object):
+    '''Serial port wrapper which tees all the bytes read from and written to
+    the sensor into a capture file, along with their timestamps. Capture
+    file starts with `CAPTURE_MAGIC`, followed by records made of
+    `CAPTURE_RECORD` header (seconds since start, direction, size) and
+    data.'''
+
+    def __init__(self, ser, path):
+        '''Initilize recording wrapper.
+
+        Parameters
+        ----------
+        ser : serial.Serial
+            Opened serial port
+        path : str
+            Path of the capture file, overwritten if exists
+        '''
+        self._serial = ser
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._start = time.time()
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    def _record(self, direction, data):
+        '''Appends data to the capture'''
+        stamp = time.time() - self._start
+        for i in range(0, len(data), 0xFFFF):
+            chunk = data[i:i + 0xFFFF]
+            self._file.write(CAPTURE_RECORD.pack(stamp, direction, len(chunk)))
+            self._file.write(chunk)
+
+    def read(self, size=1):
+        data = self._serial.read(size)
+        if data:
+            self._record(CAPTURE_READ, data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self._record(CAPTURE_WRITE, data)
+        return self._serial.write(data)
+
+    def close(self):
+        self._serial.close()
+        self._file.close()
+
+
+class TraceRing(object):
+    '''Fixed-size in-memory trace of the latest bytes read from and written
+    to the sensor. Bytes are copied into a preallocated ring and records
+    (time, direction, offset, size) into a preallocated table, so that
+    tracing costs a copy per read and no allocation. The trace is dumped
+    on demand (e.g. on exception or signal) as a capture file, see
+    `RecordingSerial`.'''
+
+    RECORD_DTYPE = np.dtype([
+        ('stamp', np.float64),
+        ('direction', np.uint8),
+        ('start', np.int64),
+        ('size', np.int64),
+    ])
+
+    def __init__(self, size=65536, records=4096):
+        '''Initilize empty trace.
+
+        Parameters
+        ----------
+        size : int
+            Number of the latest bytes kept
+        records : int
+            Number of the latest reads and writes kept
+        '''
+        self.size = size
+        self._data = bytearray(size)
+        self._view = memoryview(self._data)
+        self._records = np.zeros(records, dtype=self.RECORD_DTYPE)
+        self.count = 0
+        self.written = 0
+
+    def add(self, direction, data, stamp=None):
+        '''Appends bytes read (`CAPTURE_READ`) or written
+        (`CAPTURE_WRITE`) at time `stamp`, now by default'''
+        if stamp is None:
+            stamp = time.time()
+        size = len(data)
+        if size > self.size:
+            data = data[size - self.size:]
+        pos = self.written % self.size
+        first = min(len(data), self.size - pos)
+        self._view[pos:pos + first] = data[:first]
+        if first < len(data):
+            self._view[:len(data) - first] = data[first:]
+        self._records[self.count % len(self._records)] = (
+            stamp, direction, self.written, len(data))
+        self.written += len(data)
+        self.count += 1
+
+    def dump(self, path):
+        '''Writes the records still in the ring into capture file `path`,
+        which can be replayed with `ReplaySerial`. Times are relative to
+        the oldest record.'''
+        records = self._records
+        if self.count > len(records):
+            i = self.count % len(records)
+            records = np.concatenate((records[i:], records[:i]))
+        else:
+            records = records[:self.count]
+        # bytes of the oldest records may be overwritten already
+        records = records[records['start'] >= self.written - self.size]
+        origin = records['stamp'][0] if len(records) else 0
+        with open(path, 'wb') as f:
+            f.write(CAPTURE_MAGIC)
+            for stamp, direction, start, size in records.tolist():
+                pos = start % self.size
+                data = bytes(self._view[pos:pos + size])
+                if len(data) < size:
+                    data += bytes(self._view[:size - len(data)])
+                for i in range(0, size, 0xFFFF):
+                    chunk = data[i:i + 0xFFFF]
+                    f.write(CAPTURE_RECORD.pack(stamp - origin, direction,
+                                                len(chunk)))
+                    f.write(chunk)
+
+
+class ReplaySerial(object):
+    '''Stands in for `serial.Serial`, feeding back the bytes read in a
+    capture made with `RecordingSerial`. Written bytes are only counted: the
+    host must issue the same commands as in the recorded session, and bytes
+    read after the n-th command become available once n commands were
+    written.
+
+    In realtime mode bytes become available at their recorded time.
+    Otherwise they are available as fast as they are read, each recorded
+    read at a time, so that buffer overflows of the recorded session don't
+    show up. Once the capture is exhausted, nothing is waiting anymore and
+    reads raise `RPLidarException`, so that bytes already read are still
+    decoded.'''
+
+    def __init__(self, path, realtime=False, timeout=1):
+        '''Load capture.
+
+        Parameters
+        ----------
+        path : str
+            Path of the capture file
+        realtime : bool
+            Replay at original timing instead of max speed
+        timeout : float
+            Read timeout in seconds, in realtime mode
+        '''
+        with open(path, 'rb') as f:
+            capture = f.read()
+        if not capture.startswith(CAPTURE_MAGIC):
+            raise RPLidarException('Not a capture file: %s' % path)
+        chunks, stamps, ends, commands = [], [], [], []
+        pos = len(CAPTURE_MAGIC)
+        size = 0
+        writes = 0
+        while pos + CAPTURE_RECORD.size <= len(capture):
+            stamp, direction, length = CAPTURE_RECORD.unpack_from(capture, pos)
+            pos += CAPTURE_RECORD.size
+            if direction == CAPTURE_READ:
+                chunks.append(capture[pos:pos + length])
+                size += len(chunks[-1])
+                stamps.append(stamp)
+                ends.append(size)
+                commands.append(writes)
+            else:
+                writes += 1
+            pos += length
+        self._data = b''.join(chunks)
+        self._view = memoryview(self._data)
+        self._stamps = np.array(stamps)
+        self._ends = np.array(ends, dtype=np.intp)
+        self._commands = np.array(commands, dtype=np.intp)
+        self._writes = 0
+        self._pos = 0
+        self.realtime = realtime
+        self.timeout = timeout
+        self._start = time.time()
+
+    def _available(self, whole=False):
+        '''Returns offset of the end of available data. At max speed only
+        the current record is reported unless `whole` is set.'''
+        # records answering commands which were not sent yet are held back
+        k = np.searchsorted(self._commands, self._writes, side='right')
+        if self.realtime:
+            k = min(k, np.searchsorted(self._stamps, time.time() - self._start,
+                                       side='right'))
+        elif not whole:
+            k = min(k, np.searchsorted(self._ends, self._pos,
+                                       side='right') + 1)
+        return max(int(self._ends[k - 1]) if k else 0, self._pos)
+
+    def inWaiting(self):
+        return self._available() - self._pos
 
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def _read_span(self, size):
+        '''Waits like a serial read for `size` bytes, returns offsets of
+        the bytes read. Raises `RPLidarException` if the capture is
+        exhausted, even for 0 bytes.'''
+        if self._pos >= len(self._data):
+            raise RPLidarException('End of capture')
+        deadline = time.time() + (self.timeout if self.realtime else 0)
+        while (self._available(True) - self._pos < size and
+               time.time() < deadline):
+            time.sleep(0.001)
+        start = self._pos
+        self._pos = min(self._available(True), self._pos + size)
+        return start, self._pos
+
+    def read(self, size=1):
+        start, end = self._read_span(size)
+        return self._data[start:end]
+
+    def readinto(self, buf):
+        start, end = self._read_span(len(buf))
+        buf[:end - start] = self._view[start:end]
+        return end - start
+
+    def write(self, data):
+        self._writes += 1
+        return len(data)
+
+    def setDTR(self, value):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ScanFrame(object):
+    '''Single revolution binned into fixed angular resolution. Every bin
+    keeps the nearest distance and the best quality of its measures.'''
+
+    def __init__(self, bins=720):
+        '''Initilize frame.
+
+        Parameters
+        ----------
+        bins : int
+            Number of angular bins per revolution
+        '''
+        self.bins = bins
+        self.angles = (np.arange(bins) + .5) * 360. / bins
+        self.distance = np.zeros(bins, dtype=np.float32)
+        self.quality = np.zeros(bins, dtype=np.uint8)
+        self.count = 0
+        self.revolution = -1
+        # receive time of the latest measure added
+        self.timestamp = 0
+
+    def clear(self, revolution):
+        '''Resets frame to be filled with measures of `revolution`'''
+        self.distance.fill(np.inf)
+        self.quality.fill(0)
+        self.count = 0
+        self.revolution = revolution
+        self.timestamp = 0
+
+    def add(self, measures):
+        '''Bins array of measures of `MEASURE_DTYPE` into the frame'''
+        measures = measures[measures['distance'] > 0]
+        idx = measures['angle_q6'].astype(np.intp) * self.bins
+        idx //= ANGLE_Q6_TURN
+        np.minimum.at(self.distance, idx, measures['distance'])
+        np.maximum.at(self.quality, idx, measures['quality'])
+        self.count += len(measures)
+        if len(measures):
+            self.timestamp = float(measures['timestamp'][-1])
+
+    def finish(self):
+        '''Marks bins without measures with 0 distance'''
+        self.distance[np.isinf(self.distance)] = 0
+
+
+class ObstacleGrid(object):
+    '''Cartesian obstacle grid centred on the sensor: front is row 0, right
+    is the last column. Like CA zones, cell n away from the centre covers
+    distances in ((n - 1) * resolution, n * resolution]. Instead of wiping
+    the grid every cycle, cells stay occupied for `hold` `decay` steps after
+    their last hit, and changed cells are tracked so that consumers only
+    re-read the dirty region. All the arrays are allocated once.'''
+
+    def __init__(self, resolution=1000., extent=8000., hold=1):
+        '''Initilize grid.
+
+        Parameters
+        ----------
+        resolution : float
+            Cell size in mm
+        extent : float
+            Grid half size in mm
+        hold : int
+            Number of decay steps cell stays occupied after its last hit
+        '''
+        self.resolution = float(resolution)
+        self.center = int(np.ceil(extent / self.resolution))
+        self.shape = (2 * self.center + 1, 2 * self.center + 1)
+        self.hold = hold
+        self.distance = np.zeros(self.shape, dtype=np.float32)
+        self.hits = np.zeros(self.shape, dtype=np.uint8)
+        self.dirty = np.zeros(self.shape, dtype=np.bool_)
+        self._alive = np.zeros(self.shape, dtype=np.bool_)
+        self._expired = np.zeros(self.shape, dtype=np.bool_)
+        self._box = None
+        # `mark_cell` writes through flat memoryviews, cheaper than numpy
+        # scalar indexing, and leaves the box to `pop_dirty`
+        self._views = (memoryview(self.distance).cast('B').cast('f'),
+                       memoryview(self.hits).cast('B'),
+                       memoryview(self.dirty).cast('B').cast('?'))
+        self._marked = False
+
+    def cells(self, angle, distance):
+        '''Maps polar measures to grid cells.
+
+        Parameters
+        ----------
+        angle : numpy.ndarray
+            Angles in degrees, clockwise from the front
+        distance : numpy.ndarray
+            Distances in mm
+
+        Returns
+        -------
+        rows, cols : numpy.ndarray
+            Cells of the measures
+        inside : numpy.ndarray
+            Mask of the measures falling inside the grid
+        '''
+        theta = np.radians(angle)
+        return self._cells(distance * np.cos(theta), distance * np.sin(theta))
+
+    def _cells(self, x, y):
+        '''Maps Cartesian coordinates (x forward, y right) to grid cells'''
+        # small offset keeps measures along the axes off the rounding noise
+        x = np.sign(x) * np.ceil(np.abs(x) / self.resolution - 1e-6)
+        y = np.sign(y) * np.ceil(np.abs(y) / self.resolution - 1e-6)
+        rows = (self.center - x).astype(np.intp)
+        cols = (self.center + y).astype(np.intp)
+        inside = ((rows >= 0) & (rows < self.shape[0]) &
+                  (cols >= 0) & (cols < self.shape[1]))
+        return rows, cols, inside
+
+    def update(self, angle, distance):
+        '''Marks cells hit by polar measures, ignoring invalid (0 distance)
+        ones and the ones outside of the grid'''
+        rows, cols, inside = self.cells(angle, distance)
+        inside &= distance > 0
+        self.mark(rows[inside], cols[inside], distance[inside])
+
+    def update_measures(self, measures):
+        '''Same as `update` for array of `MEASURE_DTYPE`, using the cached
+        trigonometric tables of the quantized angles'''
+        measures = measures[measures['distance'] > 0]
+        rows, cols, inside = self._cells(*polar_to_xy(measures['angle_q6'],
+                                                      measures['distance']))
+        self.mark(rows[inside], cols[inside], measures['distance'][inside])
+
+    def mark(self, rows, cols, distance):
+        '''Marks cells as occupied by obstacles at `distance`'''
+        if not len(rows):
+            return
+        self.distance[rows, cols] = distance
+        self.hits[rows, cols] = self.hold
+        self._touch(rows, cols)
+
+    def mark_cell(self, row, col, distance):
+        '''Same as `mark` for a single cell, with int indices'''
+        cell = row * self.shape[1] + col
+        views = self._views
+        views[0][cell] = distance
+        views[1][cell] = self.hold
+        views[2][cell] = True
+        self._marked = True
+
+    def release(self, rows, cols):
+        '''Clears cells right away, regardless of their hold'''
+        if not len(rows):
+            return
+        self.distance[rows, cols] = 0
+        self.hits[rows, cols] = 0
+        self._touch(rows, cols)
+
+    def decay(self):
+        '''Ages all the cells by one step, clearing the expired ones'''
+        np.greater(self.hits, 0, out=self._alive)
+        np.subtract(self.hits, 1, out=self.hits, where=self._alive)
+        np.equal(self.hits, 0, out=self._expired)
+        self._expired &= self._alive
+        if self._expired.any():
+            rows, cols = np.nonzero(self._expired)
+            self.distance[rows, cols] = 0
+            self._touch(rows, cols)
+
+    def clear(self):
+        '''Clears all the cells'''
+        rows, cols = np.nonzero(self.hits)
+        self.hits.fill(0)
+        self.distance.fill(0)
+        if len(rows):
+            self._touch(rows, cols)
+
+    def _touch(self, rows, cols):
+        '''Marks cells as dirty'''
+        self.dirty[rows, cols] = True
+        box = (int(rows.min()), int(rows.max()),
+               int(cols.min()), int(cols.max()))
+        if self._box is not None:
+            box = (min(box[0], self._box[0]), max(box[1], self._box[1]),
+                   min(box[2], self._box[2]), max(box[3], self._box[3]))
+        self._box = box
+
+    def pop_dirty(self):
+        '''Returns region changed since the previous call and resets
+        tracking.
+
+        Returns
+        -------
+        tuple of slices or None
+            Rows and columns slices of the bounding box of the changed cells,
+            None if nothing has changed. `dirty` mask holds the exact cells
+            until the call.
+        '''
+        if self._marked:
+            self._marked = False
+            rows, cols = np.nonzero(self.dirty)
+            if len(rows):
+                self._touch(rows, cols)
+        if self._box is None:
+            return None
+        region = (slice(self._box[0], self._box[1] + 1),
+                  slice(self._box[2], self._box[3] + 1))
+        self.dirty[region] = False
+        self._box = None
+        return region
+
+
+# Collision avoidance zones
+# ------------------------------------------------
+# sector: (name, MCU direction, min angle, max angle, map cell of zone 1,
+# map step to the next zone). Angle bounds are exclusive, sector wraps over
+# 0 degree (excluded) when min angle > max angle. MCU byte of a detection is
+# 10 * direction + zone, e.g. 21 (0x15) for Front zone 1.
+CA_SECTORS = (
+    ('Front', 2, 350.0, 10.0, (7, obstacleMap_CenterCol), (-1, 0)),
+    ('Left', 4, 260.0, 280.0, (obstacleMap_CenterRow, 7), (0, -1)),
+    ('Right', 6, 80.0, 100.0, (obstacleMap_CenterRow, 9), (0, 1)),
+    ('Back', 8, 172.0, 188.0, (9, obstacleMap_CenterCol), (1, 0)),
+)
+# range bands in mm: zone n covers [CA_RANGES[n-1], CA_RANGES[n]),
+# except zone 1 which excludes its lower bound
+CA_RANGES = (200, 1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000)
+# for now, in the interest of time, only zone 1 and 2 are sent to MCU
+CA_MCU_ZONES = 2
+
+# MCU obstacle frame: sync, frame length, sequence number, timestamp (ms,
+# wraps around), occupancy mask of 4 directions x 8 zones (bit
+# 8 * direction + zone - 1), optional nearest distance of every direction
+# (mm, 0 if none) and Fletcher-16 checksum of everything after sync.
+# All the fields are little endian.
+MCU_FRAME_SYNC = b'\xA5\x5A'
+MCU_FRAME_HEADER = struct.Struct('<2sBBHI')
+MCU_FRAME_CHECKSUM = struct.Struct('<H')
+
+ObstacleFrame = namedtuple('obstacle_frame', 'seq timestamp mask nearest')
+
+
+def _fletcher16(data):
+    '''Computes Fletcher-16 checksum of `data`'''
+    sum1 = sum2 = 0
+    for b in bytearray(data):
+        sum1 = (sum1 + b) % 255
+        sum2 = (sum2 + sum1) % 255
+    return sum1 + (sum2 << 8)
+
+
+def encode_obstacle_frame(seq, timestamp, mask, nearest=()):
+    '''Encodes MCU obstacle frame.
+
+    Parameters
+    ----------
+    seq : int
+        Sequence number, wraps around at 256
+    timestamp : int
+        Timestamp in milliseconds, wraps around at 65536
+    mask : int
+        Occupancy mask of the zones
+    nearest : sequence of int, optional
+        Nearest distance in mm of every direction
+
+    Returns
+    -------
+    bytes
+        Encoded frame, 12 bytes + 2 bytes per direction distance
+    '''
+    length = MCU_FRAME_HEADER.size + 2 * len(nearest) + MCU_FRAME_CHECKSUM.size
+    frame = MCU_FRAME_HEADER.pack(MCU_FRAME_SYNC, length, seq & 0xFF,
+                                  timestamp & 0xFFFF, mask)
+    frame += struct.pack('<%dH' % len(nearest),
+                         *[min(int(d), 0xFFFF) for d in nearest])
+    return frame + MCU_FRAME_CHECKSUM.pack(_fletcher16(frame[2:]))
+
+
+def decode_obstacle_frames(data):
+    '''Reference decoder of MCU obstacle frames. Bytes which don't belong to
+    a valid frame (e.g. single zone bytes) are skipped.
+
+    Parameters
+    ----------
+    data : bytes
+        Raw bytes received by the MCU
+
+    Returns
+    -------
+    frames : list of ObstacleFrame
+        Decoded frames
+    consumed : int
+        Number of bytes processed, remaining bytes are an incomplete frame
+    '''
+    frames = []
+    pos = 0
+    min_len = MCU_FRAME_HEADER.size + MCU_FRAME_CHECKSUM.size
+    while True:
+        start = data.find(MCU_FRAME_SYNC, pos)
+        if start < 0:
+            # keep last byte in case it is the first sync byte
+            if data[-1:] == MCU_FRAME_SYNC[:1] and len(data) - 1 >= pos:
+                return frames, len(data) - 1
+            return frames, len(data)
+        pos = start
+        if len(data) - pos < MCU_FRAME_HEADER.size:
+            return frames, pos
+        _, length, seq, timestamp, mask = MCU_FRAME_HEADER.unpack_from(
+            data, pos)
+        if length < min_len or (length - min_len) % 2:
+            pos += 1
+            continue
+        if len(data) - pos < length:
+            return frames, pos
+        frame = data[pos:pos + length]
+        checksum, = MCU_FRAME_CHECKSUM.unpack_from(frame, length - 2)
+        if checksum != _fletcher16(frame[2:-2]):
+            pos += 1
+            continue
+        nearest = struct.unpack_from('<%dH' % ((length - min_len) // 2),
+                                     frame, MCU_FRAME_HEADER.size)
+        frames.append(ObstacleFrame(seq, timestamp, mask, nearest))
+        pos += length
+
+
+class ZoneClassifier(object):
+    '''Classifies measures into collision avoidance sectors and range
+    zones. Zone tables are compiled into angle -> sector and distance ->
+    zone lookups, so the cost per measure doesn't depend on the number of
+    sectors.'''
+
+    # lookups are indexed by raw Q6 angle and Q2 distance
+    ANGLE_SCALE = 64
+    DIST_SCALE = 4
+
+    def __init__(self, sectors=CA_SECTORS, ranges=CA_RANGES,
+                 mcu_zones=CA_MCU_ZONES):
+        '''Compile zone tables.
+
+        Parameters
+        ----------
+        sectors : tuple
+            Sectors table, see `CA_SECTORS`
+        ranges : tuple
+            Range bands bounds in mm, see `CA_RANGES`
+        mcu_zones : int
+            Number of nearest zones reported to the MCU
+        '''
+        self.names = [sector[0] for sector in sectors]
+        self.mcu_zones = mcu_zones
+        zones = len(ranges) - 1
+
+        angle = np.arange(1 << 15) / float(self.ANGLE_SCALE)
+        self.angle_lut = np.full(len(angle), -1, dtype=np.int8)
+        for i, (_, _, lo, hi, _, _) in enumerate(sectors):
+            if lo < hi:
+                inside = (angle > lo) & (angle < hi)
+            else:
+                # 0 degree itself is in no sector, as in the original
+                # CA_SlotFront
+                inside = (((angle > lo) & (angle < 360)) |
+                          ((angle > 0) & (angle < hi)))
+            self.angle_lut[inside] = i
+
+        dist = np.arange(1 << 16) / float(self.DIST_SCALE)
+        zone = np.searchsorted(ranges, dist, side='right') - 1
+        zone[(dist <= ranges[0]) | (dist >= ranges[-1])] = -1
+        self.dist_lut = zone.astype(np.int8)
+
+        step = np.arange(zones)
+        self.rows = np.array([cell[0] + step * inc[0]
+                              for _, _, _, _, cell, inc in sectors])
+        self.cols = np.array([cell[1] + step * inc[1]
+                              for _, _, _, _, cell, inc in sectors])
+        self.codes = np.array([10 * direction + step + 1
+                               for _, direction, _, _, _, _ in sectors],
+                              dtype=np.uint8)
+        self.shape = self.codes.shape
+
+        # plain Python copies for `slot_measure`: bytes indexing returns an
+        # int, with sector and zone shifted by one so that -1 fits
+        self._angle_bytes = (self.angle_lut + 1).astype(np.uint8).tobytes()
+        self._dist_bytes = (self.dist_lut + 1).astype(np.uint8).tobytes()
+        self._rows = self.rows.tolist()
+        self._cols = self.cols.tolist()
+        self._codes = [[bytes((code,)) for code in row]
+                       for row in self.codes.tolist()]
+
+    def classify(self, angle, distance):
+        '''Classifies measures.
+
+        Parameters
+        ----------
+        angle : numpy.ndarray
+            Angles in degrees
+        distance : numpy.ndarray
+            Distances in mm
+
+        Returns
+        -------
+        sector : numpy.ndarray
+            Sector index of every measure
+        zone : numpy.ndarray
+            Zone index (0 for zone 1) of every measure
+        inside : numpy.ndarray
+            Mask of the measures falling into any zone
+        '''
+        a = np.minimum(angle * self.ANGLE_SCALE, len(self.angle_lut) - 1)
+        return self._classify(a.astype(np.intp), distance)
+
+    def _classify(self, angle_q6, distance):
+        '''Same as `classify` for angles in 1/64 degree'''
+        d = np.minimum(distance * self.DIST_SCALE, len(self.dist_lut) - 1)
+        sector = self.angle_lut[angle_q6]
+        zone = self.dist_lut[d.astype(np.intp)]
+        return sector, zone, (sector >= 0) & (zone >= 0)
+
+    def slot(self, measures, obstacle_map, ser=None, sector=None):
+        '''Slots measures into the obstacle map and sends their zone bytes
+        to the MCU.
+
+        Parameters
+        ----------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE`
+        obstacle_map : ObstacleGrid
+            Map cells of the detections are marked with their distance
+        ser : serial.Serial or McuOutput, optional
+            MCU serial port. `McuOutput` also gets the receive time of the
+            oldest measure behind the bytes, to measure detection latency.
+        sector : str, optional
+            Name of the only sector to check, all of them by default
+        '''
+        sectors, zones, inside = self._classify(measures['angle_q6'],
+                                                measures['distance'])
+        if sector is not None:
+            inside &= sectors == self.names.index(sector)
+        sectors, zones = sectors[inside], zones[inside]
+        obstacle_map.mark(self.rows[sectors, zones], self.cols[sectors, zones],
+                          measures['distance'][inside])
+        if ser is not None:
+            near = zones < self.mcu_zones
+            codes = self.codes[sectors[near], zones[near]]
+            if not len(codes):
+                return
+            if isinstance(ser, McuOutput):
+                received = measures['timestamp'][inside][near]
+                ser.write(codes.tobytes(), float(received.min()))
+            else:
+                ser.write(codes.tobytes())
+
+    def slot_measure(self, angle, distance, obstacle_map, ser=None,
+                     sector=None, received=0):
+        '''Same as `slot` for a single measure, without building any array:
+        the lookups are indexed directly, so the cost per measure stays
+        below the one of the original if/elif chains.
+
+        Parameters
+        ----------
+        angle : float
+            Angle in degrees
+        distance : float
+            Distance in mm
+        obstacle_map : ObstacleGrid
+            Map cell of the detection is marked with its distance
+        ser : serial.Serial or McuOutput, optional
+            MCU serial port
+        sector : str, optional
+            Name of the only sector to check, all of them by default
+        received : float
+            Receive time of the measure, passed to `McuOutput`
+        '''
+        # most measures are in no sector, checked first on the raw byte
+        i = self._angle_bytes[int(angle * 64) & 0x7fff]
+        if not i:
+            return
+        i -= 1
+        if sector is not None and self.names[i] != sector:
+            return
+        q = int(distance * 4)
+        if q > 0xffff:
+            return
+        zone = self._dist_bytes[q] - 1
+        if zone < 0:
+            return
+        obstacle_map.mark_cell(self._rows[i][zone], self._cols[i][zone],
+                               distance)
+        if ser is not None and zone < self.mcu_zones:
+            code = self._codes[i][zone]
+            if isinstance(ser, McuOutput):
+                ser.write(code, received)
+            else:
+                ser.write(code)
+
+    def zone_hits(self, measures, keep=None):
+        '''Returns mask of the zones hit by measures and distance of their
+        nearest measure (inf for the other zones), both shaped
+        (sectors, zones). Only the measures set in the `keep` mask count,
+        if given (see `PointFilter.mask`).'''
+        sectors, zones, inside = self._classify(measures['angle_q6'],
+                                                measures['distance'])
+        if keep is not None:
+            inside &= keep
+        nearest = np.full(self.shape, np.inf, dtype=np.float32)
+        np.minimum.at(nearest, (sectors[inside], zones[inside]),
+                      measures['distance'][inside])
+        return np.isfinite(nearest), nearest
+
+    def track(self, measures, tracker, obstacle_map, ser=None, sector=None):
+        '''Same as `slot` for a whole revolution (or window) of measures,
+        filtered by a `ZoneTracker`: only confirmed zones are on the
+        obstacle map, with their smoothed distance, and only zone bytes of
+        newly confirmed zones are sent (all the confirmed ones every
+        `tracker.refresh` updates, to keep them alive on the MCU).
+
+        Parameters
+        ----------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE`
+        tracker : ZoneTracker
+            Tracker of the zones of this classifier
+        obstacle_map : ObstacleGrid
+            Map cells of the confirmed zones are marked with their distance
+        ser : serial.Serial or McuOutput, optional
+            MCU serial port
+        sector : str, optional
+            Name of the only sector swept by the measures (see
+            SectorSweep), zones of the other sectors are left unchanged.
+            All of them by default.
+
+        Returns
+        -------
+        confirmed, released : numpy.ndarray
+            Masks of the zones confirmed and released by this update
+        '''
+        hit, nearest = self.zone_hits(measures)
+        received = measures['timestamp']
+        seen = None
+        if sector is not None:
+            seen = np.zeros(self.shape, dtype=np.bool_)
+            seen[self.names.index(sector)] = True
+        return self.update_tracker(
+            tracker, hit, nearest, obstacle_map, ser,
+            float(received.min()) if len(received) else 0, seen)
+
+    def update_tracker(self, tracker, hit, nearest, obstacle_map, ser=None,
+                       received=0, seen=None):
+        '''Second half of `track`, from the output of `zone_hits`.
+        `received` is the host receive time of the oldest measure and
+        `seen` the mask of the zones swept, see `ZoneTracker.update`.'''
+        confirmed, released = tracker.update(hit, nearest, seen)
+        obstacle_map.release(self.rows[released], self.cols[released])
+        obstacle_map.mark(self.rows[tracker.confirmed],
+                          self.cols[tracker.confirmed],
+                          tracker.distance[tracker.confirmed])
+        if ser is not None:
+            emit = confirmed
+            if tracker.refresh and tracker.updates % tracker.refresh == 0:
+                emit = tracker.confirmed
+            emit = emit.copy()
+            emit[:, self.mcu_zones:] = False
+            codes = self.codes[emit]
+            if not len(codes):
+                return confirmed, released
+            if isinstance(ser, McuOutput):
+                ser.write(codes.tobytes(), received)
+            else:
+                ser.write(codes.tobytes())
+        return confirmed, released
+
+    def occupancy(self, obstacle_map):
+        '''Summarizes obstacle map for the MCU obstacle frame.
+
+        Parameters
+        ----------
+        obstacle_map : ObstacleGrid
+            Obstacle map filled by `slot`
+
+        Returns
+        -------
+        mask : int
+            Occupancy mask, bit 8 * sector + zone is set for every occupied
+            zone
+        nearest : tuple
+            Distance of the nearest occupied zone of every sector (0 if none)
+        '''
+        cells = obstacle_map.distance[self.rows, self.cols]
+        occupied = cells > 0
+        bits = np.packbits(occupied.ravel(), bitorder='little')
+        mask = int.from_bytes(bits.tobytes(), 'little')
+        first = occupied.argmax(axis=1)
+        nearest = np.where(occupied.any(axis=1),
+                           cells[np.arange(len(cells)), first], 0)
+        return mask, tuple(nearest.tolist())
+
+
+class SectorSweep(object):
+    '''Splits the stream of measures at the end of every CA sector, so
+    that each sector is classified as soon as the sensor swept past it
+    (e.g. Front, 350-10 degrees, once the sweep passes 10 degrees) instead
+    of waiting for the end of the revolution.'''
+
+    def __init__(self, classifier):
+        '''Initilize splitter.
+
+        Parameters
+        ----------
+        classifier : ZoneClassifier
+            Classifier whose sectors are tracked
+        '''
+        self.classifier = classifier
+        # 0 degree is in no sector for classification, but it must not end
+        # the sector wrapping around it in the middle of its sweep
+        self._lut = classifier.angle_lut.copy()
+        if self._lut[1] == self._lut[ANGLE_Q6_TURN - 1]:
+            self._lut[0] = self._lut[1]
+        self._pending = [[] for _ in classifier.names]
+        self._last = -1
+
+    def split(self, measures):
+        '''Feeds a batch of measures in sweep order.
+
+        Parameters
+        ----------
+        measures : numpy.ndarray
+            Structured array of `MEASURE_DTYPE`, as yielded by
+            `RPLidar.iter_measure_batches`
+
+        Returns
+        -------
+        list
+            (sector name, measures) of every sector completed by this
+            batch, in sweep order. Sector is complete when the first
+            measure past its end arrives.
+        '''
+        completed = []
+        if not len(measures):
+            return completed
+        sector = self._lut[measures['angle_q6']]
+        bounds = np.flatnonzero(sector[1:] != sector[:-1]) + 1
+        if sector[0] != self._last:
+            bounds = np.r_[0, bounds]
+        starts = np.r_[0, bounds]
+        ends = np.r_[bounds, len(measures)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if start == end:
+                # first measure leaves the sector of the previous batch
+                self._complete(self._last, completed)
+                continue
+            current = int(sector[start])
+            if current >= 0:
+                self._pending[current].append(measures[start:end])
+            if end < len(measures):
+                self._complete(current, completed)
+        self._last = int(sector[-1])
+        return completed
+
+    def _complete(self, sector, completed):
+        '''Moves pending measures of `sector` to the completed ones'''
+        if sector < 0 or not self._pending[sector]:
+            return
+        chunks = self._pending[sector]
+        completed.append((self.classifier.names[sector],
+                          chunks[0] if len(chunks) == 1
+                          else np.concatenate(chunks)))
+        self._pending[sector] = []
+
+
+class ZoneTracker(object):
+    '''Temporal filter of the CA zones with hysteresis. A zone is confirmed
+    after `confirm` consecutive updates hitting it and released after
+    `release` consecutive updates missing it, so that a single noisy return
+    neither creates an obstacle nor a single missed one clears it. Distance
+    of the hit zones is smoothed with an exponential moving average. All
+    the zones are updated at once with array operations.'''
+
+    def __init__(self, shape, confirm=2, release=3, alpha=0.5, refresh=5):
+        '''Initilize tracker with all the zones free.
+
+        Parameters
+        ----------
+        shape : tuple
+            Zones shape, see `ZoneClassifier.shape`
+        confirm : int
+            Consecutive hits confirming a zone
+        release : int
+            Consecutive misses releasing a confirmed zone
+        alpha : float
+            Weight of the new distance in the moving average
+        refresh : int
+            Period in updates at which `ZoneClassifier.track` sends all the
+            confirmed zones again, 0 to only send changes
+        '''
+        self.confirm = confirm
+        self.release = release
+        self.alpha = alpha
+        self.refresh = refresh
+        self.hits = np.zeros(shape, dtype=np.uint8)
+        self.misses = np.zeros(shape, dtype=np.uint8)
+        self.confirmed = np.zeros(shape, dtype=np.bool_)
+        self.distance = np.zeros(shape, dtype=np.float32)
+        self.updates = 0
+        self.changes = 0
+
+    def update(self, hit, distance, seen=None):
+        '''Updates zones with the hits of a revolution.
+
+        Parameters
+        ----------
+        hit : numpy.ndarray
+            Mask of the zones hit
+        distance : numpy.ndarray
+            Distance of the nearest measure of every hit zone
+        seen : numpy.ndarray, optional
+            Mask of the zones swept by the update, e.g. the zones of a
+            single sector, the other ones are left unchanged. All the
+            zones by default.
+
+        Returns
+        -------
+        confirmed, released : numpy.ndarray
+            Masks of the zones which got confirmed and released
+        '''
+        if seen is None:
+            seen = np.ones(self.hits.shape, dtype=np.bool_)
+        hit = hit & seen
+        fresh = hit & (self.hits == 0) & ~self.confirmed
+        self.hits = np.where(seen, np.where(
+            hit, np.minimum(self.hits, 254) + 1, 0), self.hits
+                             ).astype(np.uint8)
+        self.misses = np.where(seen, np.where(
+            hit, 0, np.minimum(self.misses, 254) + 1), self.misses
+                               ).astype(np.uint8)
+        smoothed = self.alpha * distance + (1 - self.alpha) * self.distance
+        self.distance = np.where(fresh, distance, np.where(
+            hit, smoothed, self.distance)).astype(np.float32)
+
+        confirmed = ~self.confirmed & (self.hits >= self.confirm) & seen
+        released = self.confirmed & (self.misses >= self.release) & seen
+        self.confirmed ^= confirmed | released
+        # unconfirmed tracks restart from scratch on their next hit
+        self.distance[~self.confirmed & ~hit & seen] = 0
+        self.updates += 1
+        self.changes += int(confirmed.sum() + released.sum())
+        return confirmed, released
+
+
+class LatencyHistogram(object):
+    '''Histogram of latencies with logarithmic buckets, `BUCKETS_PER_OCTAVE`
+    per doubling from `MIN_LATENCY` up to ~10 s. Adding a sample is a
+    bisection over the bucket edges, cheap enough to stay enabled in
+    production. Percentiles are upper edges of the buckets, i.e. accurate
+    to ~20%.'''
+
+    MIN_LATENCY = 1e-5
+    BUCKETS_PER_OCTAVE = 4
+    BUCKETS = 80
+
+    def __init__(self):
+        '''Initilize empty histogram'''
+        self.edges = [self.MIN_LATENCY * 2 ** ((i + 1.) /
+                                               self.BUCKETS_PER_OCTAVE)
+                      for i in range(self.BUCKETS)]
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, latency):
+        '''Adds latency in seconds, the last bucket collects overflows'''
+        self.counts[bisect.bisect_left(self.edges, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def reset(self):
+        '''Removes all the samples'''
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def percentile(self, q):
+        '''Returns `q` percentile of the latencies in seconds (0 if empty)'''
+        if not self.count:
+            return 0.
+        rank = q / 100. * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.edges[min(i, self.BUCKETS - 1)], self.max)
+        return self.max
+
+    def summary(self):
+        '''Returns number of samples and mean, p50, p90, p99 and max
+        latencies in milliseconds'''
+        return {
+            'count': self.count,
+            'mean_ms': 1e3 * self.total / self.count if self.count else 0.,
+            'p50_ms': 1e3 * self.percentile(50),
+            'p90_ms': 1e3 * self.percentile(90),
+            'p99_ms': 1e3 * self.percentile(99),
+            'max_ms': 1e3 * self.max,
+        }
+
+
+class McuOutput(object):
+    '''Output channel of zone bytes to the MCU. It can be used in place of
+    the serial port: written bytes are queued and a background thread
+    sends them coalesced in a single write every `period` seconds. Each zone
+    byte is sent at most once per `refresh` seconds, which is enough as MCU
+    keeps detections alive on its own, so a new detection goes out
+    immediately while a persisting one is only refreshed.
+
+    Detection latency, from the host receive time of the measure to the
+    write of its byte or frame to the port, is kept in the `latency`
+    histogram, which is reported and reset every `stats_period`.'''
+
+    def __init__(self, ser, refresh=0.1, period=0.025, stats_period=10,
+                 logger=None, stats_file=None):
+        '''Initilize MCU output channel.
+
+        Parameters
+        ----------
+        ser : serial.Serial
+            MCU serial port
+        refresh : float
+            Minimum interval between two sends of the same zone byte
+        period : float
+            Interval between two writes to the serial port in seconds
+        stats_period : float or None
+            Interval between statistics log lines in seconds
+        logger : logging.Logger instance, optional
+            Logger instance, if none is provided new instance is created
+        stats_file : str, optional
+            Path of the JSON file statistics are written to every
+            `stats_period`
+        '''
+        self.ser = ser
+        self.refresh = refresh
+        self.period = period
+        self.stats_period = stats_period
+        self.stats_file = stats_file
+        if logger is None:
+            logger = logging.getLogger('mcu')
+        self.logger = logger
+        self.bytes_sent = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.max_queue_depth = 0
+        self.latency = LatencyHistogram()
+        self._last_sent = [float('-inf')] * 256
+        self._received = [0] * 256
+        self._pending = set()
+        self._frame = None
+        self._frame_received = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = time.time()
+
+    def write(self, data, received=0):
+        '''Queues zone bytes to be sent to the MCU.
+
+        Parameters
+        ----------
+        data : bytes
+            Zone bytes
+        received : float, optional
+            Host receive time of the oldest measure behind the bytes, 0 if
+            unknown
+        '''
+        now = time.time()
+        with self._lock:
+            for code in bytearray(data):
+                if (code in self._pending or
+                        now - self._last_sent[code] < self.refresh):
+                    self.coalesced += 1
+                else:
+                    self._pending.add(code)
+                    self._received[code] = received
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       len(self._pending))
+
+    def send_frame(self, mask, nearest=(), received=0):
+        '''Queues obstacle frame, replacing the one not sent yet.
+
+        Parameters
+        ----------
+        mask : int
+            Occupancy mask of the zones
+        nearest : sequence of int, optional
+            Nearest distance in mm of every direction
+        received : float, optional
+            Host receive time of the oldest measure behind the frame, 0 if
+            unknown
+        '''
+        timestamp = int(time.time() * 1000)
+        with self._lock:
+            if self._frame is not None:
+                self.coalesced += 1
+            if self._frame is None or not self._frame_received:
+                self._frame_received = received
+            self._frame = encode_obstacle_frame(self._seq, timestamp, mask,
+                                                nearest)
+            self._seq = (self._seq + 1) & 0xFF
+
+    def flush(self):
+        '''Sends all the queued zone bytes and frame in a single write'''
+        with self._lock:
+            codes, self._pending = self._pending, set()
+            frame, self._frame = self._frame, None
+            received = [self._received[code] for code in codes]
+            if frame is not None:
+                received.append(self._frame_received)
+        data = bytes(sorted(codes)) + (frame or b'')
+        if not data:
+            return
+        self.ser.write(data)
+        now = time.time()
+        for code in codes:
+            self._last_sent[code] = now
+        for t in received:
+            if t:
+                self.latency.add(now - t)
+        self.bytes_sent += len(data)
+        self.writes += 1
+
+    def start(self):
+        '''Starts the writer thread'''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._writer_loop,
+                                        name='mcu-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the writer thread sending queued bytes first'''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def stats(self):
+        '''Returns output channel statistics
+
+        Returns
+        -------
+        dict
+            Bytes sent per second, current and maximum number of queued zone
+            bytes, number of writes and of zone bytes dropped as duplicates,
+            and detection latency summary (see `LatencyHistogram.summary`)
+            since the previous report
+        '''
+        return {
+            'bytes_per_sec': self.bytes_sent / (time.time() - self._started),
+            'queue_depth': len(self._pending),
+            'max_queue_depth': self.max_queue_depth,
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'latency': self.latency.summary(),
+        }
+
+    def report(self):
+        '''Logs statistics, writes them to `stats_file` and resets latency
+        histogram'''
+        stats = self.stats()
+        self.logger.info('MCU output: %.1f B/s, queue %d (max %d), '
+                         '%d coalesced, latency p50 %.1f ms p99 %.1f ms '
+                         'max %.1f ms', stats['bytes_per_sec'],
+                         stats['queue_depth'], stats['max_queue_depth'],
+                         stats['coalesced'], stats['latency']['p50_ms'],
+                         stats['latency']['p99_ms'],
+                         stats['latency']['max_ms'])
+        if self.stats_file is not None:
+            stats['time'] = time.time()
+            tmp = self.stats_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp, self.stats_file)
+        self.latency.reset()
+
+    def _tick(self, last_report):
+        '''Flushes queued bytes and reports statistics if `stats_period`
+        elapsed since `last_report`. Returns time of the last report.'''
+        try:
+            self.flush()
+        except serial.SerialException as err:
+            self.logger.error('Failed to write to MCU: %s', err)
+        if (self.stats_period and
+                time.time() - last_report > self.stats_period):
+            last_report = time.time()
+            try:
+                self.report()
+            except OSError as err:
+                self.logger.error('Failed to write MCU stats: %s', err)
+        return last_report
+
+    def _writer_loop(self):
+        '''Body of the writer thread'''
+        last_report = time.time()
+        while not self._stop.wait(self.period):
+            last_report = self._tick(last_report)
+
+
+def Measurement_Row(measurement, received):
+    # measurement tuple as a row of MEASURE_DTYPE
+    return (measurement[idx_NewScan],
+            measurement[idx_QOL] or 0,
+            measurement[idx_AngleDeg],
+            int(measurement[idx_AngleDeg] * 64) % ANGLE_Q6_TURN,
+            measurement[idx_DistMm],
+            received)
+
+def CA_Filter(measures):
+    # point filter of the gated loop: `measures`, the measurements of
+    # lidarWindow received since the previous tick, are filtered at once,
+    # each one once. The latest one passing becomes the current measurement.
+    global measurement, measurementTime
+    kept = np.flatnonzero(lidarPointFilter.mask(measures, wrap=False))
+    if len(kept):
+        measurement, measurementTime = lidarWindow[kept[-1]]
+    del lidarWindow[:]
+    return len(kept) > 0
+
+def CA_Slot(sector=None):
+    # slot current measurement into CA zones, all sectors by default
+    caZones.slot_measure(measurement[idx_AngleDeg], measurement[idx_DistMm],
+                         obstacleMap, mcu if mcuProtocol == 'bytes' else None,
+                         sector, measurementTime)
+
+def CA_Track(measures, sector=None):
+    # classify a window of measures (or a swept sector), zones are only
+    # reported once confirmed by caTracker
+    confirmed, released = caZones.track(
+        measures, caTracker, obstacleMap,
+        mcu if mcuProtocol == 'bytes' else None, sector)
+    if mcu is not None and mcuProtocol == 'frame' and (
+            confirmed.any() or released.any() or (
+                caTracker.refresh and
+                caTracker.updates % caTracker.refresh == 0)):
+        received = measures['timestamp'].min() if len(measures) else 0
+        mcu.send_frame(*caZones.occupancy(obstacleMap), received=received)
 
 def CA_SlotFront():
-    # slot measurements into CA Front    
-    if(((measurement[idx_AngleDeg] >350.0) and (measurement[idx_AngleDeg] < 359.99999)) or ((measurement[idx_AngleDeg] >0.0) and (measurement[idx_AngleDeg] < 10.0))):
-        # slot measurement into obstacleMap
-        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):
-            if(measurement[idx_DistMm]<1000):
-                obstacleMap[7][obstacleMap_CenterCol] = measurement[idx_DistMm]                
-                if ser is not None:
-                    ser.write(b"\x15") # d21, dir (2) forward, zone 1 = 0x15
-                #print('Obstacle Front -> Dist: {} mm / QOL ---> {} '.format(measurement[idx_DistMm],measurement[idx_QOL]))
-            elif(measurement[idx_DistMm]<2000):
-                obstacleMap[6][obstacleMap_CenterCol] = measurement[idx_DistMm] 
-                if ser is not None:
-                    ser.write(b"\x16")  # d22, dir forward (2), zone 2 = 0x16
-                # debug code
-                #print('Obstacle Front -> Dist: {} mm / QOL ---> {} '.format(measurement[idx_DistMm],measurement[idx_QOL]))           
-                #print("Hello from RC")
-            elif(measurement[idx_DistMm]<3000):
-                obstacleMap[5][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x17")  # d23, dir forward (2), zone 3                              
-            elif (measurement[idx_DistMm]<4000):
-                obstacleMap[4][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x18")  # d24, dir forward (2), zone 4
-            elif (measurement[idx_DistMm]<5000):
-                obstacleMap[3][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x19")  # d25, dir forward (2), zone 5                
-            elif (measurement[idx_DistMm]<6000):
-                obstacleMap[2][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x1A")  # d26, dir forward (2), zone 6                
-            elif (measurement[idx_DistMm]<7000):                
-                obstacleMap[1][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x1B")  # d27, dir forward (2), zone 7
-            elif (measurement[idx_DistMm]<8000):                
-                obstacleMap[0][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x1C")  # d27, dir forward (2), zone 8
+    # slot measurements into CA Front
+    CA_Slot('Front')
 
 def CA_SlotFront_ShowRange():
     # debug code
     for i in range(obstacleMap_CenterRow-1,-1,-1) :
-        if(obstacleMap[i][obstacleMap_CenterCol]>0) :
+        if(obstacleMap.distance[i][obstacleMap_CenterCol]>0) :
             print('Obstacle at FRONT -> row: {}, col: {} / Dist: -> {} mm'.format(i,obstacleMap_CenterCol, measurement[idx_DistMm]))
 
 def CA_SlotFront_ShowQOL():
     # debug code
     for i in range(obstacleMap_CenterRow-1,-1,-1) :
-        if(obstacleMap[i][obstacleMap_CenterCol]>0) :
+        if(obstacleMap.distance[i][obstacleMap_CenterCol]>0) :
             print('Obstacle at FRONT ->  Dist: -> {} mm / QOL: -> {} '.format(measurement[idx_DistMm], measurement[idx_QOL]))
             
                     
 def CA_SlotBack():
     # slot measurements into CA Back
-    if((measurement[idx_AngleDeg] >172.0) and (measurement[idx_AngleDeg] < 188.0)):
-        # slot measurement into obstacleMap
-        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):                
-            if(measurement[idx_DistMm]<1000):
-                obstacleMap[9][obstacleMap_CenterCol] = measurement[idx_DistMm]                    
-                if ser is not None:
-                    ser.write(b"\x51") # d81, Back Zone 1
-            elif(measurement[idx_DistMm]<2000):
-                obstacleMap[10][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                if ser is not None:
-                    ser.write(b"\x52") # d82, Back Zone 2
-            elif (measurement[idx_DistMm]<3000):
-                obstacleMap[11][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x53") # d83, Back Zone 3                                
-            elif (measurement[idx_DistMm]<4000):
-                obstacleMap[12][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x54") # d84, Back Zone 4
-            elif (measurement[idx_DistMm]<5000):
-                obstacleMap[13][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x55") # d85, Back Zone 5
-            elif (measurement[idx_DistMm]<6000):                
-                obstacleMap[14][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x56") # d86, Back Zone 6
-            elif (measurement[idx_DistMm]<7000):
-                obstacleMap[15][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x57") # d87, Back Zone 7
-            elif (measurement[idx_DistMm]<8000):
-                obstacleMap[16][obstacleMap_CenterCol] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x58") # d88, Back Zone 8
-
-
+    CA_Slot('Back')
 
 def CA_SlotBack_ShowRange():
     for i in range(obstacleMap_CenterRow+1,17) :
-        if(obstacleMap[i][obstacleMap_CenterCol]>0) :
+        if(obstacleMap.distance[i][obstacleMap_CenterCol]>0) :
             print('Obstacle at BACK -> row: {}, col: {} / Dist: -> {} mm'.format(i,obstacleMap_CenterCol, measurement[idx_DistMm]))
 
 def CA_SlotBack_ShowQOL():
     for i in range(obstacleMap_CenterRow+1,17) :
-        if(obstacleMap[i][obstacleMap_CenterCol]>0) :
+        if(obstacleMap.distance[i][obstacleMap_CenterCol]>0) :
             print('Obstacle at Back ->  Dist: -> {} mm / QOL: -> {} '.format(measurement[idx_DistMm], measurement[idx_QOL]))
 
 def CA_SlotLeft():
     # slot measurements into CA Left
-    if((measurement[idx_AngleDeg] >260.0) and (measurement[idx_AngleDeg] < 280.0)) :
-        # slot measurement into obstacleMap
-        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):
-            if(measurement[idx_DistMm]<1000):                
-                obstacleMap[obstacleMap_CenterRow][7] = measurement[idx_DistMm]                    
-                if ser is not None:
-                    ser.write(b"\x29") #d41, direction 4, Zone1                        
-            elif(measurement[idx_DistMm]<2000):                
-                obstacleMap[obstacleMap_CenterRow][6] = measurement[idx_DistMm]
-                if ser is not None:
-                    ser.write(b"\x2A") #d42, direction 4, zone 2
-            elif (measurement[idx_DistMm]<3000):                
-                obstacleMap[obstacleMap_CenterRow][5] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x2B") #d43, direction 4, zone 3
-            elif (measurement[idx_DistMm]<4000):                
-                obstacleMap[obstacleMap_CenterRow][4] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x2C") #d44, direction 4, zone 4
-            elif (measurement[idx_DistMm]<5000):                
-                obstacleMap[obstacleMap_CenterRow][3] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x2D") #d45, direction 4, zone 5
-            elif (measurement[idx_DistMm]<6000):                
-                obstacleMap[obstacleMap_CenterRow][2] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x2E") #d46, direction 4, zone 6
-            elif (measurement[idx_DistMm]<7000):                
-                obstacleMap[obstacleMap_CenterRow][1] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x2F") #d47, direction 4, zone 7
-            elif (measurement[idx_DistMm]<8000):                
-                obstacleMap[obstacleMap_CenterRow][0] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x30") #d48, direction 4, zone 8
-                    
+    CA_Slot('Left')
+
 def CA_SlotLeft_ShowRange():
     for i in range(0,obstacleMap_CenterCol) :
-        if(obstacleMap[obstacleMap_CenterRow][i]>0) :
+        if(obstacleMap.distance[obstacleMap_CenterRow][i]>0) :
             print('Obstacle at LEFT -> row: {}, col: {} / Dist: -> {} mm'.format(obstacleMap_CenterRow,i,measurement[idx_DistMm]))
 
 def CA_SlotLeft_ShowQOL():
     for i in range(0,obstacleMap_CenterCol) :
-        if(obstacleMap[obstacleMap_CenterRow][i]>0) :
+        if(obstacleMap.distance[obstacleMap_CenterRow][i]>0) :
             print('Obstacle at LEFT ->  Dist: -> {} mm / QOL: -> {} '.format(measurement[idx_DistMm], measurement[idx_QOL])) 
             
 def CA_SlotRight():
     # slot measurements into CA Right
-    if((measurement[idx_AngleDeg] >80.0) and (measurement[idx_AngleDeg] < 100.0)):
-        # slot measurement into obstacleMap        
-        if((measurement[idx_DistMm]>200) and (measurement[idx_DistMm]<8000)):                
-            if(measurement[idx_DistMm]<1000):                
-                obstacleMap[obstacleMap_CenterRow][9] = measurement[idx_DistMm]
-                if ser is not None:
-                    ser.write(b"\x3D") #aka 61 -> dir Right, Zone 1            
-            elif(measurement[idx_DistMm]<2000):                
-                obstacleMap[obstacleMap_CenterRow][10] = measurement[idx_DistMm]                
-                if ser is not None:
-                    ser.write(b"\x3E") #aka 62 -> dir Right, Zone 2
-            elif(measurement[idx_DistMm]<3000):                
-                obstacleMap[obstacleMap_CenterRow][11] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x3F") #aka 63 -> dir Right, Zone 3
-            elif(measurement[idx_DistMm]<4000):                
-                obstacleMap[obstacleMap_CenterRow][12] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x40") #aka 64 -> dir Right, Zone 4
-            elif(measurement[idx_DistMm]<5000):                
-                obstacleMap[obstacleMap_CenterRow][13] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x41") #aka 65 -> dir Right, Zone 5
-            elif(measurement[idx_DistMm]<6000):                
-                obstacleMap[obstacleMap_CenterRow][14] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x42") #aka 66 -> dir Right, Zone 6
-            elif(measurement[idx_DistMm]<7000):                
-                obstacleMap[obstacleMap_CenterRow][15] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x43") #aka 67 -> dir Right, Zone 7
-            elif(measurement[idx_DistMm]<8000):                
-                obstacleMap[obstacleMap_CenterRow][16] = measurement[idx_DistMm]
-                #if ser is not None:
-                    #ser.write(b"\x44") #aka 68 -> dir Right, Zone 8
+    CA_Slot('Right')
 
 def CA_SlotRight_ShowRange():
     for i in range(obstacleMap_CenterCol,obstacleMap_Col_Len) :
-        if(obstacleMap[obstacleMap_CenterRow][i]>0) :                            
+        if(obstacleMap.distance[obstacleMap_CenterRow][i]>0) :                            
             print('Obstacle at RIGHT ->  Dist: -> {} mm / QOL: -> {} '.format(measurement[idx_DistMm], measurement[idx_QOL]))
 
 
 def CA_SlotRight_ShowQOL():
     for i in range(obstacleMap_CenterCol,obstacleMap_Col_Len) :
-        if(obstacleMap[obstacleMap_CenterRow][i]>0) :                            
+        if(obstacleMap.distance[obstacleMap_CenterRow][i]>0) :                            
             print('Obstacle at RIGHT ->  Dist: -> {} mm / QOL: -> {} '.format(measurement[idx_DistMm], measurement[idx_QOL]))
 
 
@@ -698,92 +3456,181 @@ def CA_SlotRight_ShowQOL():
 # Main()
 # ===========================================================================================================
 
-try:
-    ser = serial.Serial(arduinoPort,115200,timeout=0.1)    
-    ser.reset_input_buffer()
-except:
-    ser = None
-    print('\nArduino MCU\nunable to access serial port.')
-    #sys.exit()
-
-try:
-    lidar = RPLidar(lidarPort)
-except:
-    print('\nRplidarA2M8\nUnable to connect to Lidar port')
-    sys.exit()
-
-    
-#info = lidar.get_info()
-#print('\nRplidar A2M8\n{}'.format(info))
-
-#health = lidar.get_health()
-#print('\nRplidar A2M8\n{}'.format(health))
-#print('\nStarting Lidar now ...\n')
-
-#print('press enter to continue')
-#input()	
-
-##try:
-##    print('\nRPlidar A2M8\n...press enter key to continue ...\n...or ctrl-c to stop...')
-##    input()
-##except KeyboardInterrupt:
-##    print('\n ...Exiting now...\n')
-##    sys.exit()
-
-
-obstacleMap = np.zeros((obstacleMap_Row_Len,obstacleMap_Col_Len),int)
-
-##for i, scan in enumerate(lidar.iter_scans()):
-##    print('%d: Got %d measures' % (i, len(scan)))
-##    if i > 10:
-##        break
-
-##try:
-##    for measure in lidar.iter_measures(max_buf_meas=500):
-##        print('\n {}'.format(measure))
-##        #print(measure)
-##except KeyboardInterrupt:
-##        print('\n... Stopping ...\n')
-
-read_serial = ''
-MCUInput = ''
-
-lidarTimer_Treshold = 0.025 # 0.05 second
-lidarTimer_Prev = time.time()
-    
-for measurement in lidar.iter_measures(max_buf_meas=500):    
-    # ~~~~~~~~ chk FRONT start ~~~~~~~~~~~~~~~~~~~~
-    # Lidar only checks and sends the results to MCU. It does NOT make any kind of
-    # decision of whether to stop the robot or not.
-    # each cycle, each 'measurement' is checked for the zone.
-    # if it falls within any of the 8 zones, this module will send the data to MCU
-    # it is up to MCU to decide what to do with the data or to ignore it.
-    # in future, each of the 8 zones will send data to MCU and will send the 'row/col' coordinates
-    # so that MCU can fill in the entire MAP array
-    # for now, in the interest of time, we only send zone 1 and 2 (<2m>1m, and <1m)
-    # and instead of 'row/col' coord, we send in terms of 'dir (1 to 9) / Zone#'        
-
-    lidarTimer_Now = time.time()
-    if((lidarTimer_Now - lidarTimer_Prev) > lidarTimer_Treshold):
-        CA_SlotFront()        
-        CA_SlotFront_ShowRange()
-        #CA_SlotFront_ShowQOL()
-        
-        CA_SlotLeft()        
-        #CA_SlotLeft_ShowRange()
-        #CA_SlotLeft_ShowQOL()
-        
-        CA_SlotRight()
-        #CA_SlotRight_ShowRange()
-        #CA_SlotRight_ShowQOL()
-        
-        CA_SlotBack()
-        #CA_SlotBack_ShowRange()
-        #CA_SlotBack_ShowQOL()                
-        
-        # ~~~~~~~~ RESET obstacle map ~~~~~~~~~~~~~~~~~~~~
-        obstacleMap.fill(0)        
-        lidarTimer_Prev = lidarTimer_Now
-
-
-
+if __name__ == '__main__':
+    try:
+        ser = serial.Serial(arduinoPort,115200,timeout=0.1)    
+        ser.reset_input_buffer()
+    except:
+        ser = None
+        print('\nArduino MCU\nunable to access serial port.')
+        #sys.exit()
+
+    mcu = None
+    if ser is not None:
+        mcu = McuOutput(ser, stats_file=mcuStatsFile)
+        mcu.start()
+
+    try:
+        lidarPointFilter = PointFilter(
+            lidarFilter_MinQuality, median_tolerance=lidarFilter_MedianTolerance,
+            isolation=lidarFilter_Isolation)
+        if lidarMounts is not None:
+            lidar = LidarManager(lidarMounts, lidarScanType, point_filter=lidarPointFilter,
+                target_rps=lidarTarget_Rps, resolution=lidarTarget_Resolution)
+        else:
+            lidarTraceRing = None
+            if lidarTrace is not None:
+                lidarTraceRing = TraceRing(lidarTrace)
+            lidarDiscover = lidarScanType not in ('normal', 'force', 'express')
+            if lidarReplay is not None:
+                lidar = RPLidar(ReplaySerial(lidarReplay, realtime=True),
+                                record=lidarRecord, trace=lidarTraceRing,
+                                discover=lidarDiscover)
+            else:
+                lidar = RPLidar(lidarPort, record=lidarRecord,
+                                trace=lidarTraceRing, discover=lidarDiscover)
+    except:
+        print('\nRplidarA2M8\nUnable to connect to Lidar port')
+        sys.exit()
+
+    if getattr(lidar, 'trace', None) is not None:
+        # forensic dump of the latest serial traffic on crash or on demand
+        def TraceHook(*exc_info):
+            lidar.dump_trace(lidarTraceFile)
+            sys.__excepthook__(*exc_info)
+        sys.excepthook = TraceHook
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: lidar.dump_trace(lidarTraceFile))
+
+
+    #info = lidar.get_info()
+    #print('\nRplidar A2M8\n{}'.format(info))
+
+    #health = lidar.get_health()
+    #print('\nRplidar A2M8\n{}'.format(health))
+    #print('\nStarting Lidar now ...\n')
+
+    #print('press enter to continue')
+    #input()	
+
+    ##try:
+    ##    print('\nRPlidar A2M8\n...press enter key to continue ...\n...or ctrl-c to stop...')
+    ##    input()
+    ##except KeyboardInterrupt:
+    ##    print('\n ...Exiting now...\n')
+    ##    sys.exit()
+
+
+    obstacleMap = ObstacleGrid(1000., obstacleMap_CenterRow * 1000., obstacleMap_Hold)
+    caZones = ZoneClassifier()
+
+    ##for i, scan in enumerate(lidar.iter_scans()):
+    ##    print('%d: Got %d measures' % (i, len(scan)))
+    ##    if i > 10:
+    ##        break
+
+    ##try:
+    ##    for measure in lidar.iter_measures(max_buf_meas=500):
+    ##        print('\n {}'.format(measure))
+    ##        #print(measure)
+    ##except KeyboardInterrupt:
+    ##        print('\n... Stopping ...\n')
+
+    read_serial = ''
+    MCUInput = ''
+
+    lidarTimer_Treshold = 0.025 # 0.05 second
+    lidarTimer_Prev = time.time()
+
+    lidarController = None
+    if lidarMounts is None and lidarTarget_Rps is not None:
+        # LidarManager runs its own controller for every sensor
+        lidarController = ScanController(lidar, lidarTarget_Rps,
+                                         lidarTarget_Resolution)
+
+    # zones of the revolutions, windows and sectors are only reported once
+    # confirmed (see CA_Track)
+    caTracker = ZoneTracker(caZones.shape, caTracker_Confirm,
+                            caTracker_Release)
+
+    if lidarMounts is not None:
+        # all the sensors fused into the obstacle map once per revolution
+        try:
+            for measures in lidar.iter_revolutions():
+                CA_Track(measures)
+        finally:
+            lidar.stop()
+
+    if caWindow == 'sector':
+        # every sector is classified as soon as it was swept
+        caSweep = SectorSweep(caZones)
+        for measures in lidar.iter_measure_batches(lidarScanType,
+                                                   max_buf_meas=500):
+            if lidarController is not None:
+                lidarController.update(measures)
+            for sector, swept in caSweep.split(measures):
+                CA_Track(lidarPointFilter.apply(swept, wrap=False), sector)
+            if measures['new_scan'].any():
+                obstacleMap.decay()
+
+    elif caWindow is not None:
+        # every measure is classified, once per window. Windows of caWindow
+        # measures don't sweep whole sectors, their zones are tracked per
+        # swept sector.
+        caSweep = SectorSweep(caZones)
+        for measures in lidar.iter_windows(lidarScanType, max_buf_meas=500,
+                                           samples=caWindow):
+            if lidarController is not None:
+                lidarController.update(measures)
+            # windows of caWindow measures are not whole revolutions
+            measures = lidarPointFilter.apply(measures, wrap=not caWindow)
+            if caWindow:
+                for sector, swept in caSweep.split(measures):
+                    CA_Track(swept, sector)
+            else:
+                CA_Track(measures)
+            obstacleMap.decay()
+
+    # measurements received since the previous tick, with their receive
+    # time, filtered and handed to lidarController once per tick
+    lidarWindow = []
+
+    for measurement in lidar.iter_measures(lidarScanType, max_buf_meas=500):    
+        lidarWindow.append((measurement, lidar.read_time))
+        # ~~~~~~~~ chk FRONT start ~~~~~~~~~~~~~~~~~~~~
+        # Lidar only checks and sends the results to MCU. It does NOT make any kind of
+        # decision of whether to stop the robot or not.
+        # each cycle, each 'measurement' is checked for the zone.
+        # if it falls within any of the 8 zones, this module will send the data to MCU
+        # it is up to MCU to decide what to do with the data or to ignore it.
+        # in future, each of the 8 zones will send data to MCU and will send the 'row/col' coordinates
+        # so that MCU can fill in the entire MAP array
+        # for now, in the interest of time, we only send zone 1 and 2 (<2m>1m, and <1m)
+        # and instead of 'row/col' coord, we send in terms of 'dir (1 to 9) / Zone#'        
+
+        lidarTimer_Now = time.time()
+        if((lidarTimer_Now - lidarTimer_Prev) > lidarTimer_Treshold):
+            lidarMeasures = np.array([Measurement_Row(*pair) for pair in lidarWindow],
+                                     dtype=MEASURE_DTYPE)
+            if lidarController is not None:
+                lidarController.update(lidarMeasures)
+            if CA_Filter(lidarMeasures):
+                # one pass over all CA sectors (Front, Left, Right, Back)
+                CA_Slot()
+                CA_SlotFront_ShowRange()
+                #CA_SlotFront_ShowQOL()
+                #CA_SlotLeft_ShowRange()
+                #CA_SlotLeft_ShowQOL()
+                #CA_SlotRight_ShowRange()
+                #CA_SlotRight_ShowQOL()
+                #CA_SlotBack_ShowRange()
+                #CA_SlotBack_ShowQOL()                
+                if mcu is not None and mcuProtocol == 'frame':
+                    mcu.send_frame(*caZones.occupancy(obstacleMap),
+                                   received=measurementTime)
+
+            # ~~~~~~~~ AGE obstacle map ~~~~~~~~~~~~~~~~~~~~
+            # obstacles fade out obstacleMap_Hold cycles after last detection
+            obstacleMap.decay()
+            lidarTimer_Prev = lidarTimer_Now
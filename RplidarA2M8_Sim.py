@@ -0,0 +1,555 @@
+# Simulated RPlidar A2 M8 on a pseudo-terminal, for load testing without
+# hardware. Speaks the protocol implemented by RPLidar in RplidarA2M8_RC.py
+# and scans a synthetic room with moving obstacles. Reports its scan modes
+# (see SCAN_MODES) and streams them as normal, express, ultra or dense
+# capsuled packets.
+#
+#   python RplidarA2M8_Sim.py --rate 16000 --corruption 1e-5
+#
+# then point lidarPort in RplidarA2M8_RC.py to the printed device, or use
+# SimulatedRPLidar directly: RPLidar(SimulatedRPLidar().start().port)
+
+import argparse
+import fcntl
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import tty
+import numpy as np
+
+from RplidarA2M8_RC import (SYNC_BYTE, SYNC_BYTE2, GET_INFO_BYTE,
+                            GET_HEALTH_BYTE, STOP_BYTE, RESET_BYTE,
+                            SET_PWM_BYTE, DEFAULT_MOTOR_PWM, INFO_LEN,
+                            HEALTH_LEN, INFO_TYPE, HEALTH_TYPE, _SCAN_TYPE,
+                            SCAN_SAMPLE_RATES, GET_LIDAR_CONF_BYTE,
+                            LIDAR_CONF_TYPE, CONF_SCAN_MODE_COUNT,
+                            CONF_SCAN_MODE_US_PER_SAMPLE,
+                            CONF_SCAN_MODE_MAX_DISTANCE,
+                            CONF_SCAN_MODE_ANS_TYPE, CONF_SCAN_MODE_TYPICAL,
+                            CONF_SCAN_MODE_NAME, _ANS_SCAN_TYPE,
+                            ScanMode)
+
+# rotation frequency at DEFAULT_MOTOR_PWM
+NOMINAL_RPS = 10.
+MAX_RANGE = 12000.
+# scan modes reported by the simulated firmware, the first one is the
+# normal mode the sample rate of the simulator refers to
+SCAN_MODES = (
+    ScanMode(0, 'Standard', 500., 12., 129),
+    ScanMode(1, 'Express', 250., 12., 130),
+    ScanMode(2, 'Boost', 125., 12., 132),
+    ScanMode(3, 'Stability', 250., 12., 132),
+    ScanMode(4, 'Dense', 125., 12., 133),
+)
+# measures per packet of the scan types
+SCAN_BLOCKS = {'express': 32, 'ultra': 96, 'dense': 40}
+# Packets are encoded from the protocol specification, not with the helpers
+# of the decoders of RplidarA2M8_RC.py, so that a mistake in a decoder
+# doesn't cancel out in the simulation.
+# sync nibbles of the first two bytes of capsuled packets
+CAPSULE_SYNC1 = 0xA
+CAPSULE_SYNC2 = 0x5
+# segments of the variable bit scale of ultra capsules distances: first
+# scaled value, distance it stands for and bit shift, from the longest
+# distances
+VBS_SEGMENTS = ((3328, 1 << 14, 4), (1792, 1 << 12, 3), (1280, 1 << 11, 2),
+                (512, 1 << 9, 1), (0, 0, 0))
+
+
+def descriptor(size, dtype, single=True):
+    '''Builds response descriptor'''
+    mode = 0 if single else 1
+    return (SYNC_BYTE + SYNC_BYTE2 +
+            struct.pack('<IB', size | (mode << 30), dtype))
+
+
+def encode_scan(new_scan, quality, angle, distance):
+    '''Encodes normal scan packets, one per measure'''
+    angle_q6 = (angle * 64).astype(np.uint16) & 0x7FFF
+    dist_q2 = (distance * 4).astype(np.uint32).clip(0, 0xFFFF)
+    packets = np.empty((len(angle), 5), dtype=np.uint8)
+    packets[:, 0] = (quality << 2) | np.where(new_scan, 0b01, 0b10)
+    packets[:, 1] = ((angle_q6 & 0x7F) << 1) | 1
+    packets[:, 2] = angle_q6 >> 7
+    packets[:, 3] = dist_q2 & 0xFF
+    packets[:, 4] = dist_q2 >> 8
+    return packets.tobytes()
+
+
+def _capsules(new_scan, start_angle, size):
+    '''Allocates capsuled packets of `size` bytes with their start angles'''
+    angle_q6 = (start_angle * 64).astype(np.uint16) & 0x7FFF
+    packets = np.zeros((len(angle_q6), size), dtype=np.uint8)
+    packets[:, 2] = angle_q6 & 0xFF
+    packets[:, 3] = (angle_q6 >> 8) | (new_scan.astype(np.uint8) << 7)
+    return packets
+
+
+def _seal_capsules(packets):
+    '''Sets sync bits and checksum of capsuled packets, returns their bytes'''
+    checksum = np.bitwise_xor.reduce(packets[:, 2:], axis=1)
+    packets[:, 0] = (CAPSULE_SYNC1 << 4) | (checksum & 0x0F)
+    packets[:, 1] = (CAPSULE_SYNC2 << 4) | (checksum >> 4)
+    return packets.tobytes()
+
+
+def encode_express(new_scan, start_angle, distance):
+    '''Encodes express scan packets of 32 measures each, without angle
+    compensation.
+
+    Parameters
+    ----------
+    new_scan : numpy.ndarray
+        (N,) new scan flags
+    start_angle : numpy.ndarray
+        (N,) start angles in degrees
+    distance : numpy.ndarray
+        (N, 32) distances in mm
+    '''
+    packets = _capsules(new_scan, start_angle, 84)
+    dist = distance.astype(np.uint16).clip(0, 0x3FFF)
+    cabins = packets[:, 4:].reshape(len(packets), 16, 5)
+    cabins[:, :, 0] = (dist[:, 0::2] & 0x3F) << 2
+    cabins[:, :, 1] = dist[:, 0::2] >> 6
+    cabins[:, :, 2] = (dist[:, 1::2] & 0x3F) << 2
+    cabins[:, :, 3] = dist[:, 1::2] >> 6
+    return _seal_capsules(packets)
+
+
+def encode_dense(new_scan, start_angle, distance):
+    '''Encodes dense capsuled packets of 40 measures each.
+
+    Parameters
+    ----------
+    new_scan : numpy.ndarray
+        (N,) new scan flags
+    start_angle : numpy.ndarray
+        (N,) angles of the first measures in degrees
+    distance : numpy.ndarray
+        (N, 40) distances in mm
+    '''
+    packets = _capsules(new_scan, start_angle, 84)
+    dist = distance.clip(0, 0xFFFF).astype('<u2')
+    packets[:, 4:] = dist.view(np.uint8).reshape(len(packets), 80)
+    return _seal_capsules(packets)
+
+
+def _varbitscale_encode(distance):
+    '''Scales distances in mm to the 12 bits of ultra capsules, see
+    `VBS_SEGMENTS`. Returns scaled values, distances they stand for and
+    their bit shifts.'''
+    scaled = np.zeros(len(distance), dtype=np.int64)
+    major = np.zeros(len(distance), dtype=np.int64)
+    level = np.zeros(len(distance), dtype=np.int64)
+    done = np.zeros(len(distance), dtype=bool)
+    for scaled_base, target_base, shift in VBS_SEGMENTS:
+        segment = ~done & (distance >= target_base)
+        scaled[segment] = np.minimum(
+            scaled_base + ((distance[segment] - target_base) >> shift), 0xFFF)
+        major[segment] = target_base + ((scaled[segment] - scaled_base) << shift)
+        level[segment] = shift
+        done |= segment
+    return scaled, major, level
+
+
+def ultra_angle_offset(distance):
+    '''Returns the angle in degrees between the raw angle of an ultra
+    capsule and a measure at `distance` mm: 8 degrees less a term
+    decreasing with the distance, 7.5 degrees under 50 mm'''
+    distance = np.asarray(distance, dtype=np.float64)
+    k2 = np.floor(98361. / np.maximum(4 * distance, 200))
+    offset = np.radians(8.) - (64 * k2 + k2 ** 3 / 98304.) / 65536.
+    return np.where(distance >= 50, np.degrees(offset), 7.5)
+
+
+def _predict(distance, base, level):
+    '''Encodes 10 bits predictions of distances from `base`, extreme
+    values flag invalid ones'''
+    predict = np.round((distance - base) / (1 << level)).astype(np.int64)
+    predict = np.where(distance > 0, predict.clip(-511, 510), 511)
+    return predict & 0x3FF
+
+
+def encode_ultra(new_scan, start_angle, distance, next_distance=None):
+    '''Encodes ultra capsuled packets of 32 cabins of 3 measures each,
+    without angle compensation (see `ultra_angle_offset`).
+
+    Parameters
+    ----------
+    new_scan : numpy.ndarray
+        (N,) new scan flags
+    start_angle : numpy.ndarray
+        (N,) angles of the first measures in degrees
+    distance : numpy.ndarray
+        (N, 96) distances in mm
+    next_distance : float, optional
+        First distance of the next packet, the last cabin predicts from it.
+        Its own first distance is used if None.
+    '''
+    packets = _capsules(new_scan, start_angle, 132)
+    dist = distance.reshape(-1, 3).astype(np.int64).clip(0)
+    scaled, major, level = _varbitscale_encode(dist[:, 0])
+    following = dist[-1, 0] if next_distance is None else int(next_distance)
+    _, following_major, following_level = _varbitscale_encode(
+        np.array([following]))
+    next_major = np.r_[major[1:], following_major]
+    next_level = np.r_[level[1:], following_level]
+    fallback = (major == 0) & (next_major != 0)
+    predict1 = _predict(dist[:, 1], np.where(fallback, next_major, major),
+                        np.where(fallback, next_level, level))
+    predict2 = _predict(dist[:, 2], next_major, next_level)
+    cabins = (scaled | (predict1 << 12) | (predict2 << 22)).astype('<u4')
+    packets[:, 4:] = cabins.view(np.uint8).reshape(len(packets), 128)
+    return _seal_capsules(packets)
+
+
+class Room(object):
+    '''Rectangular room around the sensor with circular obstacles moving
+    and bouncing off the walls'''
+
+    def __init__(self, length=8000., width=6000., obstacles=3, speed=1000.,
+                 radius=250., noise=5., rng=None):
+        '''Initilize room.
+
+        Parameters
+        ----------
+        length, width : float
+            Room size in mm along x (front) and y (right), sensor at centre
+        obstacles : int
+            Number of moving obstacles
+        speed : float
+            Maximum obstacle speed in mm/s
+        radius : float
+            Obstacle radius in mm
+        noise : float
+            Standard deviation of the distance noise in mm
+        rng : numpy.random.RandomState, optional
+        '''
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.half = np.array([length / 2., width / 2.])
+        self.radius = radius
+        self.noise = noise
+        self.position = self.rng.uniform(-1, 1, (obstacles, 2)) * (
+            self.half - radius)
+        self.velocity = self.rng.uniform(-speed, speed, (obstacles, 2))
+
+    def move(self, dt):
+        '''Moves obstacles by `dt` seconds'''
+        self.position += self.velocity * dt
+        limit = self.half - self.radius
+        out = np.abs(self.position) > limit
+        self.velocity[out] *= -1
+        self.position = np.clip(self.position, -limit, limit)
+
+    def ranges(self, angle):
+        '''Returns distances in mm seen along `angle` degrees (clockwise from
+        the front), 0 when out of range'''
+        theta = np.radians(angle)
+        d = np.stack([np.cos(theta), np.sin(theta)], axis=-1)
+        with np.errstate(divide='ignore'):
+            walls = np.abs(self.half / d).min(axis=-1)
+        dist = walls
+        for c in self.position:
+            b = d.dot(c)
+            disc = b * b - c.dot(c) + self.radius ** 2
+            hit = (disc >= 0) & (b > 0)
+            t = b - np.sqrt(np.where(hit, disc, 0))
+            dist = np.where(hit & (t > 0), np.minimum(dist, t), dist)
+        dist = dist + self.rng.normal(0, self.noise, len(dist))
+        return np.where(dist < MAX_RANGE, dist.clip(0), 0)
+
+
+class SimulatedRPLidar(object):
+    '''RPLidar simulator on a pseudo-terminal'''
+
+    def __init__(self, sample_rate=4000, room=None, corruption=0.,
+                 dropout=0., tick=0.005, seed=None, logger=None,
+                 scan_modes=SCAN_MODES):
+        '''Initilize simulator.
+
+        Parameters
+        ----------
+        sample_rate : float
+            Measures per second in normal mode, whatever the motor speed
+            (other modes scale it by their sample duration, legacy commands
+            as `SCAN_SAMPLE_RATES` do)
+        room : Room, optional
+            Scanned room, a default one is created if None
+        corruption : float
+            Probability of every sent byte to be corrupted
+        dropout : float
+            Probability of every tick worth of data to be lost
+        tick : float
+            Streaming period in seconds
+        seed : int, optional
+            Random seed, for reproducible runs
+        logger : logging.Logger instance, optional
+        scan_modes : sequence of ScanMode
+            Scan modes reported to configuration queries, by id. None
+            simulates an older firmware ignoring the queries.
+        '''
+        self.rng = np.random.RandomState(seed)
+        self.room = room if room is not None else Room(rng=self.rng)
+        self.sample_rate = sample_rate
+        self.corruption = corruption
+        self.dropout = dropout
+        self.tick = tick
+        if logger is None:
+            logger = logging.getLogger('rplidar-sim')
+        self.logger = logger
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.port = os.ttyname(self._slave)
+        self.pwm = 0
+        self.scan_modes = scan_modes
+        self.scan_type = None
+        self.scan_mode = None
+        self.angle = 0.
+        self.sent_bytes = 0
+        self.overflow_bytes = 0
+        self.corrupted_bytes = 0
+        self.dropped_ticks = 0
+        self._input = b''
+        self._carry = 0.
+        self._pending = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''Starts simulator thread'''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='rplidar-sim')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stops simulator thread'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _send(self, data, raw=False):
+        '''Writes data to the host, dropping what doesn't fit into the pty
+        buffer like a real serial port would'''
+        if not raw and self.corruption:
+            data = bytearray(data)
+            buf = np.frombuffer(data, dtype=np.uint8)
+            hit = np.flatnonzero(self.rng.random_sample(len(buf)) <
+                                 self.corruption)
+            buf[hit] ^= self.rng.randint(1, 256, len(hit)).astype(np.uint8)
+            self.corrupted_bytes += len(hit)
+            data = bytes(data)
+        try:
+            sent = os.write(self.master, data)
+        except BlockingIOError:
+            sent = 0
+        self.sent_bytes += sent
+        self.overflow_bytes += len(data) - sent
+
+    def _run(self):
+        last = time.time()
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], self.tick)
+            if ready:
+                try:
+                    self._input += os.read(self.master, 4096)
+                except (BlockingIOError, OSError):
+                    pass
+                self._handle_commands()
+            now = time.time()
+            self.room.move(now - last)
+            if self.scan_type is not None and self.pwm > 0:
+                self._stream(now - last)
+            last = now
+
+    def _handle_commands(self):
+        '''Parses and answers the commands received from the host'''
+        while True:
+            start = self._input.find(SYNC_BYTE)
+            if start < 0:
+                self._input = b''
+                return
+            self._input = self._input[start:]
+            if len(self._input) < 2:
+                return
+            cmd = self._input[1:2]
+            payload = b''
+            if ord(cmd) & 0x80:
+                # SYNC, cmd, size, payload, checksum
+                if len(self._input) < 3 or len(self._input) < 4 + self._input[2]:
+                    return
+                payload = self._input[3:3 + self._input[2]]
+                self._input = self._input[4 + len(payload):]
+            else:
+                self._input = self._input[2:]
+            self._command(cmd, payload)
+
+    def _command(self, cmd, payload):
+        self.logger.debug('Command %r payload %r', cmd, payload)
+        if cmd == GET_INFO_BYTE:
+            info = struct.pack('<BBBB', 0x28, 24, 1, 5) + bytes(range(16))
+            self._send(descriptor(INFO_LEN, INFO_TYPE) + info[:INFO_LEN],
+                       raw=True)
+        elif cmd == GET_HEALTH_BYTE:
+            self._send(descriptor(HEALTH_LEN, HEALTH_TYPE) + b'\x00\x00\x00',
+                       raw=True)
+        elif cmd in (STOP_BYTE, RESET_BYTE):
+            self.scan_type = None
+        elif cmd == SET_PWM_BYTE:
+            self.pwm, = struct.unpack('<H', payload)
+        elif cmd == GET_LIDAR_CONF_BYTE:
+            if self.scan_modes:
+                conf_type, = struct.unpack('<I', payload[:4])
+                data = self._lidar_conf(conf_type, payload[4:])
+                self._send(descriptor(4 + len(data), LIDAR_CONF_TYPE) +
+                           payload[:4] + data, raw=True)
+        elif cmd == _SCAN_TYPE['express']['byte']:
+            # working mode 0 is the legacy express scan
+            working_mode = payload[0] if payload else 0
+            if not working_mode:
+                self._start_scan('express')
+            elif (self.scan_modes and working_mode < len(self.scan_modes) and
+                    self.scan_modes[working_mode].ans_type in _ANS_SCAN_TYPE):
+                mode = self.scan_modes[working_mode]
+                self._start_scan(_ANS_SCAN_TYPE[mode.ans_type], mode)
+        else:
+            for name, scan in _SCAN_TYPE.items():
+                if cmd == scan['byte']:
+                    self._start_scan(name)
+
+    def _start_scan(self, scan_type, mode=None):
+        self.scan_type = scan_type
+        self.scan_mode = mode
+        self._carry = 0.
+        self._pending = None
+        scan = _SCAN_TYPE[scan_type]
+        self._send(descriptor(scan['size'], scan['response'], single=False),
+                   raw=True)
+
+    def _lidar_conf(self, conf_type, arg):
+        '''Returns data of configuration entry `conf_type`, empty if
+        unknown'''
+        if conf_type == CONF_SCAN_MODE_COUNT:
+            return struct.pack('<H', len(self.scan_modes))
+        if conf_type == CONF_SCAN_MODE_TYPICAL:
+            typical = min(self.scan_modes,
+                          key=lambda mode: mode.us_per_sample)
+            return struct.pack('<H', typical.id)
+        mode_id, = struct.unpack('<H', arg[:2]) if len(arg) >= 2 else (0,)
+        if mode_id >= len(self.scan_modes):
+            return b''
+        mode = self.scan_modes[mode_id]
+        if conf_type == CONF_SCAN_MODE_US_PER_SAMPLE:
+            return struct.pack('<I', int(mode.us_per_sample * 256))
+        if conf_type == CONF_SCAN_MODE_MAX_DISTANCE:
+            return struct.pack('<I', int(mode.max_distance * 256))
+        if conf_type == CONF_SCAN_MODE_ANS_TYPE:
+            return struct.pack('<B', mode.ans_type)
+        if conf_type == CONF_SCAN_MODE_NAME:
+            return mode.name.encode('ascii') + b'\x00'
+        return b''
+
+    def _stream(self, dt):
+        '''Sends measures scanned during `dt` seconds'''
+        rps = NOMINAL_RPS * self.pwm / DEFAULT_MOTOR_PWM
+        if self.scan_mode is not None:
+            rate = (self.sample_rate * self.scan_modes[0].us_per_sample /
+                    self.scan_mode.us_per_sample)
+        else:
+            rate = (self.sample_rate * SCAN_SAMPLE_RATES[self.scan_type] /
+                    SCAN_SAMPLE_RATES['normal'])
+        block = SCAN_BLOCKS.get(self.scan_type, 1)
+        self._carry += rate * dt / block
+        count = int(self._carry)
+        self._carry -= count
+        if not count:
+            return
+        step = 360. * rps / rate
+        angle = self.angle + step * np.arange(1, count * block + 1)
+        self.angle = angle[-1] % 360
+        new_scan = np.diff(np.floor(np.r_[angle[0] - step, angle] / 360.)) > 0
+        angle %= 360
+        if self.scan_type == 'ultra':
+            # measures are reported at the raw angle minus an offset
+            # depending on their distance, see ultra_angle_offset
+            distance = self.room.ranges(angle - 7.5)
+            distance = self.room.ranges(angle - ultra_angle_offset(distance))
+        else:
+            distance = self.room.ranges(angle)
+        if self.rng.random_sample() < self.dropout:
+            self.dropped_ticks += 1
+            return
+        if self.scan_type == 'express':
+            new_scan = new_scan.reshape(count, block).any(axis=1)
+            start_angle = (angle[::block] - step) % 360
+            data = encode_express(new_scan, start_angle,
+                                  distance.reshape(count, block))
+        elif self.scan_type == 'dense':
+            data = encode_dense(new_scan.reshape(count, block).any(axis=1),
+                                angle[::block], distance.reshape(count, block))
+        elif self.scan_type == 'ultra':
+            # the last cabin of a packet predicts from the next packet, so
+            # the last packet is held back until the next tick
+            packets = (new_scan.reshape(count, block).any(axis=1),
+                       angle[::block], distance.reshape(count, block))
+            pending, self._pending = self._pending, tuple(
+                field[-1:] for field in packets)
+            if pending is not None:
+                packets = tuple(np.concatenate((old, new)) for old, new
+                                in zip(pending, packets))
+            data = encode_ultra(packets[0][:-1], packets[1][:-1],
+                                packets[2][:-1], packets[2][-1, 0])
+            if not len(data):
+                return
+        else:
+            quality = self.rng.randint(10, 48, len(angle)).astype(np.uint8)
+            quality[distance == 0] = 0
+            data = encode_scan(new_scan, quality, angle, distance)
+        self._send(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulated RPlidar A2 M8 on a pseudo-terminal')
+    parser.add_argument('--rate', type=float, default=4000,
+                        help='measures per second (default: 4000)')
+    parser.add_argument('--obstacles', type=int, default=3)
+    parser.add_argument('--corruption', type=float, default=0.,
+                        help='probability of a byte to be corrupted')
+    parser.add_argument('--dropout', type=float, default=0.,
+                        help='probability of a tick of data to be lost')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rng = np.random.RandomState(args.seed)
+    sim = SimulatedRPLidar(args.rate, Room(obstacles=args.obstacles, rng=rng),
+                           args.corruption, args.dropout, seed=args.seed)
+    sim.start()
+    print('Simulated RPLidar on {}'.format(sim.port))
+    try:
+        while True:
+            time.sleep(5)
+            print('sent: {} B / overflow: {} B / corrupted: {} B / '
+                  'dropped ticks: {}'.format(sim.sent_bytes,
+                                             sim.overflow_bytes,
+                                             sim.corrupted_bytes,
+                                             sim.dropped_ticks))
+    except KeyboardInterrupt:
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
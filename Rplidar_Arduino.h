@@ -18,6 +18,15 @@
                                          };
 
 
+  // obstacle frame protocol (see encode_obstacle_frame in RplidarA2M8_RC.py)
+  // sync A5 5A, length, seq, timestamp (2), mask (4), [nearest (2) x 4], fletcher16 (2)
+  const byte RplidarA2M8_Frame_MaxLen = 20;
+  byte RplidarA2M8_Frame[RplidarA2M8_Frame_MaxLen];
+  byte RplidarA2M8_Frame_Pos = 0;
+  byte RplidarA2M8_Frame_Seq = 0;
+  // nearest distance in mm per direction, from the last frame
+  unsigned int RplidarA2M8_ObsDir_Nearest[RplidarA2M8_ObsDir_Detected_RowLen] = {0,0,0,0};
+
   /*
     if(RplidarA2M8_ObsDir_Detected[0][0] > 0) // obstacle is detected at Direction "Front" and Zone 1
     if(RplidarA2M8_ObsDir_Detected[0][7] > 0) // obstacle is detected at Direction "Front" and Zone 8
@@ -28,6 +28,7 @@
   void loop() {
     
     //RplidarA2M8_Processing();
+    //RplidarA2M8_ReadFrame();
     debugRplidar_DistanceTest();
     
   }
@@ -43,6 +44,76 @@
 
   
   
+  void RplidarA2M8_ReadFrame() {
+  // same as RplidarA2M8_Processing, but reads whole obstacle map frames
+  // instead of single zone bytes
+
+    // decrement by 1
+    for(byte i = 0;i<RplidarA2M8_ObsDir_Detected_RowLen;++i) 
+    {
+      for(byte j=0;j<RplidarA2M8_ObsDir_Detected_ColLen;++j) {        
+        if(RplidarA2M8_ObsDir_Detected[i][j]>0) {
+            RplidarA2M8_ObsDir_Detected[i][j]--;
+        }
+      }
+    }
+
+    while(Serial.available()>0) {
+      byte inByte = Serial.read();
+
+      // wait for sync bytes A5 5A
+      if((RplidarA2M8_Frame_Pos == 0 && inByte != 0xA5) ||
+         (RplidarA2M8_Frame_Pos == 1 && inByte != 0x5A)) {
+        RplidarA2M8_Frame_Pos = (inByte == 0xA5) ? 1 : 0;
+        RplidarA2M8_Frame[0] = 0xA5;
+        continue;
+      }
+      RplidarA2M8_Frame[RplidarA2M8_Frame_Pos++] = inByte;
+
+      // byte 2 is the frame length: 12, or 20 with nearest distances
+      if(RplidarA2M8_Frame_Pos == 3 && inByte != 12 && inByte != RplidarA2M8_Frame_MaxLen) {
+        RplidarA2M8_Frame_Pos = 0;
+        continue;
+      }
+      if(RplidarA2M8_Frame_Pos < 3 || RplidarA2M8_Frame_Pos < RplidarA2M8_Frame[2]) {
+        continue;
+      }
+
+      // complete frame, check fletcher16 of everything after sync
+      byte len = RplidarA2M8_Frame[2];
+      byte sum1 = 0;
+      byte sum2 = 0;
+      for(byte i=2;i<len-2;++i) {
+        sum1 = (sum1 + RplidarA2M8_Frame[i]) % 255;
+        sum2 = (sum2 + sum1) % 255;
+      }
+      RplidarA2M8_Frame_Pos = 0;
+      if(sum1 != RplidarA2M8_Frame[len-2] || sum2 != RplidarA2M8_Frame[len-1]) {
+        continue;
+      }
+      RplidarA2M8_Frame_Seq = RplidarA2M8_Frame[3];
+
+      // occupancy mask: bit 8*direction + zone-1, little endian from byte 6
+      // the host tracks obstacles over time, so the mask is the whole state:
+      // cleared zones are removed at once and the decay above only clears
+      // everything if frames stop coming
+      for(byte i=0;i<RplidarA2M8_ObsDir_Detected_RowLen;++i) {
+        byte zones = RplidarA2M8_Frame[6+i];
+        for(byte j=0;j<RplidarA2M8_ObsDir_Detected_ColLen;++j) {
+          if(zones & (1 << j)) {
+            RplidarA2M8_ObsDir_Detected[i][j] = RplidarA2M8_ObsRemoval_Treshold;
+          } else {
+            RplidarA2M8_ObsDir_Detected[i][j] = 0;
+          }
+        }
+        RplidarA2M8_ObsDir_Nearest[i] = 0;
+        if(len == RplidarA2M8_Frame_MaxLen) {
+          RplidarA2M8_ObsDir_Nearest[i] = RplidarA2M8_Frame[10+2*i] | (RplidarA2M8_Frame[11+2*i] << 8);
+        }
+      }
+    }
+  }
+
   void RplidarA2M8_Processing() {
   // if obstacle is detected, it is immediately recorded
   // however, if obstacle is no longer detected, it needs to be "not recorded N times before it is 
@@ -0,0 +1,60 @@
+'''Fixed capsules, built by hand from the protocol specification, with
+their expected measures'''
+import numpy as np
+
+import RplidarA2M8_RC as rc
+
+# Dense: start angle 10 deg (640 = 0x280 in 1/64 deg), distances of 1000,
+# 2000 and 500 mm (0x3E8, 0x7D0, 0x1F4) for measures 0, 1 and 39, 0 for
+# the others. Checksum, xor of bytes 2 to 83:
+# 0x80 ^ 0x02 ^ 0xE8 ^ 0x03 ^ 0xD0 ^ 0x07 ^ 0xF4 ^ 0x01 = 0x4B
+DENSE_1 = (bytes([0xAB, 0x54, 0x80, 0x02, 0xE8, 0x03, 0xD0, 0x07]) +
+           bytes(74) + bytes([0xF4, 0x01]))
+# start angle 12 deg (0x300), no distances, checksum 0x03
+DENSE_2 = bytes([0xA3, 0x50, 0x00, 0x03]) + bytes(80)
+
+# Ultra: start angle 20 deg (0x500), 32 cabins of 3 measures
+# - cabin 0: major 1000 mm, scaled 512 + (1000 - 512) >> 1 = 756 = 0x2F4,
+#   prediction 1 of +10 << 1 = 1020 mm, prediction 2 of -5 (0x3FB) << 2
+#   from the major of cabin 1 = 2980 mm: 0xFEC0A2F4
+# - cabin 1: major 3000 mm, scaled 1280 + (3000 - 2048) >> 2 = 1518 =
+#   0x5EE, prediction 1 of 0 = 3000 mm, prediction 2 of 511 (0x1FF), invalid:
+#   0x7FC005EE
+# - other cabins: 0, all their measures are invalid
+# Checksum: 0x00 ^ 0x05 ^ 0xF4 ^ 0xA2 ^ 0xC0 ^ 0xFE ^ 0xEE ^ 0x05 ^ 0xC0 ^
+# 0x7F = 0x39
+ULTRA_1 = (bytes([0xA9, 0x53, 0x00, 0x05, 0xF4, 0xA2, 0xC0, 0xFE,
+                  0xEE, 0x05, 0xC0, 0x7F]) + bytes(120))
+# start angle 23 deg (0x5C0), no distances, checksum 0xC5
+ULTRA_2 = bytes([0xA5, 0x5C, 0xC0, 0x05]) + bytes(128)
+
+
+def test_dense_capsule():
+    measures, consumed, skipped = rc._process_dense_batch(DENSE_1 + DENSE_2)
+    assert (len(measures), consumed, skipped) == (40, 84, 0)
+    distance = np.zeros(40)
+    distance[[0, 1, 39]] = 1000, 2000, 500
+    assert (measures['distance'] == distance).all()
+    # 2 degrees over 40 measures: 640 + 3.2 * i in 1/64 deg
+    assert measures['angle_q6'][[0, 1, 2, 39]].tolist() == [640, 643, 646,
+                                                            764]
+    assert measures['angle'][39] == 764 / 64.
+    assert not measures['new_scan'].any()
+
+
+def test_ultra_capsule():
+    measures, consumed, skipped = rc._process_ultra_batch(ULTRA_1 + ULTRA_2)
+    assert (len(measures), consumed, skipped) == (96, 132, 0)
+    distance = np.zeros(96)
+    distance[:5] = 1000, 1020, 2980, 3000, 3000
+    assert (measures['distance'] == distance).all()
+    # raw angles of 20 deg + 3 / 96 deg (2048 in 1/65536 deg) per measure,
+    # less the offsets of their distances, in 1/65536 deg:
+    # - 1000 and 1020 mm: k2 = 98361 // 4000 = 98361 // 4080 = 24,
+    #   8 deg in 1/65536 rad = 9150, 9150 - (24 << 6) = 7614 -> 436249
+    # - 2980 and 3000 mm: k2 = 8, 9150 - (8 << 6) = 8638 -> 494921
+    # - invalid: 7.5 deg in 1/65536 rad = 8578 -> 491483
+    # e.g. (1310720 - 436249) >> 10 = 853 for measure 0
+    assert measures['angle_q6'][:6].tolist() == [853, 855, 800, 802, 804,
+                                                 810]
+    assert measures['angle'][0] == 853 / 64.
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import RplidarA2M8_RC as rc
+import RplidarA2M8_Sim as sim
+
+PACKETS = 6
+
+
+def test_normal_round_trip():
+    angle = np.arange(400) * 0.9
+    distance = 200 + 25. * np.arange(400)
+    quality = np.arange(400, dtype=np.uint8) % 64
+    new_scan = angle == 0
+    measures, consumed, skipped = rc._process_scan_batch(
+        sim.encode_scan(new_scan, quality, angle, distance))
+    assert (consumed, skipped) == (400 * 5, 0)
+    assert (measures['new_scan'] == new_scan).all()
+    assert (measures['quality'] == quality).all()
+    np.testing.assert_allclose(measures['angle'], angle, atol=1 / 64.)
+    np.testing.assert_allclose(measures['distance'], distance, atol=0.25)
+
+
+@pytest.mark.parametrize('scan_type,encode,block,first', [
+    ('express', sim.encode_express, 32, 1),
+    ('dense', sim.encode_dense, 40, 0),
+    ('ultra', sim.encode_ultra, 96, 0),
+])
+def test_capsule_round_trip(scan_type, encode, block, first):
+    start = 5 + 10. * np.arange(PACKETS)
+    distance = (300 + 40. * np.arange(PACKETS * block)).reshape(PACKETS,
+                                                                block)
+    raw = encode(np.zeros(PACKETS, dtype=bool), start, distance)
+    measures, consumed, skipped = rc._BATCH_DECODERS[scan_type](raw)
+    # measures of a packet are interpolated up to the start angle of the
+    # next one, the last packet is kept for later
+    size = rc._SCAN_TYPE[scan_type]['size']
+    assert (consumed, skipped) == ((PACKETS - 1) * size, 0)
+    expected = distance[:-1].ravel()
+    angle = (start[:-1, None] + 10. / block * (np.arange(block) + first))
+    angle = angle.ravel()
+    if scan_type == 'ultra':
+        angle -= sim.ultra_angle_offset(expected)
+        # variable bit scale keeps 10 significant bits
+        tolerance = expected / 1024.
+    else:
+        tolerance = 0
+    assert (np.abs(measures['distance'] - expected) <= tolerance).all()
+    error = (measures['angle'] - angle + 180) % 360 - 180
+    assert np.abs(error).max() <= 1 / 64.
@@ -0,0 +1,61 @@
+import numpy as np
+
+import RplidarA2M8_RC as rc
+
+
+def _revolution(count=360):
+    measures = np.zeros(count, dtype=rc.MEASURE_DTYPE)
+    measures['quality'] = 40
+    measures['angle'] = np.arange(count) * 360. / count
+    measures['angle_q6'] = (measures['angle'] * 64).astype(np.uint16)
+    measures['distance'] = 2000
+    return measures
+
+
+def test_mask_matches_apply():
+    measures = _revolution()
+    measures['distance'][10] = 0
+    measures['quality'][20] = 2
+    measures['distance'][30] = 500
+    measures['distance'][100:103] = 800
+    keep = rc.PointFilter(stats_period=0).mask(measures)
+    assert len(keep) == len(measures)
+    assert not keep[[10, 20, 30]].any()
+    # a run of 3 measures is an object, not noise
+    assert keep[100:103].all()
+    assert keep.sum() == len(measures) - 3
+    kept = rc.PointFilter(stats_period=0).apply(measures)
+    assert (kept == measures[keep]).all()
+
+
+def test_short_run_middle():
+    measures = _revolution()[:5]
+    point_filter = rc.PointFilter(stats_period=0)
+    assert point_filter.mask(measures)[2]
+    measures['distance'][2] = 4000
+    assert not point_filter.mask(measures)[2]
+    assert point_filter.stats()['median'] == 1
+
+
+def test_open_run_ends():
+    measures = _revolution(11)
+    measures['angle_q6'] = np.arange(11) * 58
+    measures['distance'] = 1000 + 200. * np.arange(11)
+    point_filter = rc.PointFilter(isolation=0, stats_period=0)
+    # as a revolution, the first measure is compared with the last ones
+    assert not point_filter.mask(measures)[0]
+    assert point_filter.mask(measures, wrap=False).all()
+    measures['distance'][-1] = 5000
+    keep = point_filter.mask(measures, wrap=False)
+    assert not keep[-1] and keep[:-1].all()
+
+
+def test_counts_add_up():
+    measures = _revolution()
+    measures['distance'][::7] = 0
+    measures['quality'][::11] = 0
+    measures['distance'][50] = 500
+    point_filter = rc.PointFilter(stats_period=0)
+    for start in range(0, len(measures), 40):
+        point_filter.mask(measures[start:start + 40], wrap=False)
+    assert sum(point_filter.stats().values()) == len(measures)
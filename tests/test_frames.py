@@ -0,0 +1,81 @@
+import RplidarA2M8_RC as rc
+
+
+def _decode_in_chunks(raw, chunk):
+    '''Decodes `raw` fed `chunk` bytes at a time, keeping the unconsumed
+    bytes like the MCU would'''
+    pending = b''
+    frames = []
+    for i in range(0, len(raw), chunk):
+        data = pending + raw[i:i + chunk]
+        decoded, consumed = rc.decode_obstacle_frames(data)
+        frames += decoded
+        pending = data[consumed:]
+    return frames, pending
+
+
+def test_round_trip():
+    frame = rc.encode_obstacle_frame(7, 1234, 0x80000001, (0, 999, 8000))
+    assert len(frame) == 12 + 2 * 3
+    frames, consumed = rc.decode_obstacle_frames(frame)
+    assert consumed == len(frame)
+    assert frames == [rc.ObstacleFrame(7, 1234, 0x80000001, (0, 999, 8000))]
+    # no distances, and distances clipped to 16 bits
+    frames, _ = rc.decode_obstacle_frames(
+        rc.encode_obstacle_frame(1, 2, 0) +
+        rc.encode_obstacle_frame(2, 3, 0b110, (70000.7, 1500.9)))
+    assert frames == [rc.ObstacleFrame(1, 2, 0, ()),
+                      rc.ObstacleFrame(2, 3, 0b110, (0xFFFF, 1500))]
+
+
+def test_sequence_and_timestamp_wrap():
+    raw = b''.join(rc.encode_obstacle_frame(seq, 65534 + seq, seq, (seq,))
+                   for seq in range(254, 258))
+    frames, _ = rc.decode_obstacle_frames(raw)
+    assert [frame.seq for frame in frames] == [254, 255, 0, 1]
+    assert [frame.timestamp for frame in frames] == [252, 253, 254, 255]
+    assert [frame.mask for frame in frames] == [254, 255, 256, 257]
+    raw = b''.join(rc.encode_obstacle_frame(0, timestamp, 0)
+                   for timestamp in (65535, 65536, 65537))
+    frames, _ = rc.decode_obstacle_frames(raw)
+    assert [frame.timestamp for frame in frames] == [65535, 0, 1]
+
+
+def test_bad_checksum_rejected():
+    good = rc.encode_obstacle_frame(1, 10, 0b1, (500,))
+    for i in range(len(rc.MCU_FRAME_SYNC), len(good)):
+        bad = bytearray(good)
+        bad[i] ^= 0x40
+        frames, _ = rc.decode_obstacle_frames(bytes(bad))
+        assert not frames, i
+    # the frame following a corrupted one is still decoded
+    bad = bytearray(rc.encode_obstacle_frame(2, 20, 0b10, (600,)))
+    bad[-1] ^= 0xFF
+    frames, consumed = rc.decode_obstacle_frames(bytes(bad) + good)
+    assert frames == [rc.ObstacleFrame(1, 10, 0b1, (500,))]
+    assert consumed == len(bad) + len(good)
+
+
+def test_resync_after_garbage():
+    frames = [rc.ObstacleFrame(seq, 100 * seq, 1 << seq, (seq, 1000 + seq))
+              for seq in range(6)]
+    encoded = [rc.encode_obstacle_frame(*frame) for frame in frames]
+    garbage = [
+        b'\x15\x16\x3d',                    # single zone bytes
+        rc.MCU_FRAME_SYNC[:1],              # lone first sync byte
+        rc.MCU_FRAME_SYNC + b'\x03',        # sync with a too short length
+        encoded[0][:9],                     # truncated frame
+        rc.MCU_FRAME_SYNC + b'\x0e' + b'\x00' * 11,  # wrong checksum
+        b'\xA5\xA5',
+    ]
+    raw = b''
+    for junk, frame in zip(garbage, encoded):
+        raw += junk + frame
+    for chunk in (1, 5, 14, len(raw)):
+        decoded, pending = _decode_in_chunks(raw, chunk)
+        assert decoded == frames, chunk
+        assert pending == b''
+    # an incomplete frame at the end is kept for the next read
+    decoded, consumed = rc.decode_obstacle_frames(raw + encoded[0][:-1])
+    assert decoded == frames
+    assert consumed == len(raw)
@@ -0,0 +1,53 @@
+import numpy as np
+
+import RplidarA2M8_RC as rc
+
+
+def test_cells_of_polar_measures():
+    grid = rc.ObstacleGrid(1000., 8000.)
+    c = grid.center
+    angle = np.array([0., 90., 180., 270., 0.])
+    distance = np.array([1000., 1001., 500., 8000., 9000.])
+    rows, cols, inside = grid.cells(angle, distance)
+    assert rows[:4].tolist() == [c - 1, c, c + 1, c]
+    assert cols[:4].tolist() == [c, c + 2, c, c - 8]
+    assert inside.tolist() == [True, True, True, True, False]
+
+
+def test_cells_held_then_released_by_decay():
+    grid = rc.ObstacleGrid(1000., 8000., hold=2)
+    grid.mark(np.array([1, 3]), np.array([8, 10]), np.array([7000., 5000.]))
+    assert grid.pop_dirty() == (slice(1, 4), slice(8, 11))
+    assert grid.pop_dirty() is None
+    assert not grid.dirty.any()
+
+    grid.decay()
+    assert grid.hits[1, 8] == grid.hits[3, 10] == 1
+    assert grid.distance[1, 8] == 7000.
+    # held cells didn't change
+    assert grid.pop_dirty() is None
+
+    # a new hit restarts the hold of its cell only
+    grid.mark(np.array([3]), np.array([10]), np.array([4500.]))
+    assert grid.pop_dirty() == (slice(3, 4), slice(10, 11))
+    grid.decay()
+    assert grid.distance[1, 8] == 0 and grid.hits[1, 8] == 0
+    assert grid.distance[3, 10] == 4500.
+    assert grid.pop_dirty() == (slice(1, 2), slice(8, 9))
+    grid.decay()
+    assert not grid.hits.any() and not grid.distance.any()
+    assert grid.pop_dirty() == (slice(3, 4), slice(10, 11))
+
+
+def test_dirty_box_of_single_cells():
+    grid = rc.ObstacleGrid(1000., 8000.)
+    grid.mark_cell(8, 2, 6000.)
+    grid.mark(np.array([5]), np.array([8]), np.array([3000.]))
+    grid.mark_cell(12, 8, 4000.)
+    assert grid.dirty.sum() == 3
+    assert grid.pop_dirty() == (slice(5, 13), slice(2, 9))
+    assert not grid.dirty.any()
+    assert grid.distance[8, 2] == 6000. and grid.hits[12, 8] == 1
+    grid.release(np.array([8]), np.array([2]))
+    assert grid.distance[8, 2] == 0 and grid.hits[8, 2] == 0
+    assert grid.pop_dirty() == (slice(8, 9), slice(2, 3))
@@ -0,0 +1,67 @@
+import pytest
+
+import RplidarA2M8_RC as rc
+
+
+class _Serial(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+        return len(data)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(rc.time, 'time', lambda: now[0])
+    return now
+
+
+def test_zone_bytes_deduplicated_and_refreshed(clock):
+    ser = _Serial()
+    mcu = rc.McuOutput(ser, refresh=0.1)
+    mcu.write(b'\x16\x15\x15', received=999.99)
+    mcu.write(b'\x16')
+    mcu.flush()
+    assert ser.writes == [b'\x15\x16']
+    assert mcu.coalesced == 2
+    assert mcu.latency.count == 2
+    assert mcu.latency.max == pytest.approx(0.01)
+
+    # persisting detections aren't sent again before `refresh`
+    clock[0] += 0.05
+    mcu.write(b'\x15\x16')
+    mcu.write(b'\x3d')
+    mcu.flush()
+    assert ser.writes[1:] == [b'\x3d']
+    clock[0] += 0.06
+    mcu.write(b'\x15\x3d')
+    mcu.flush()
+    assert ser.writes[2:] == [b'\x15']
+    # nothing queued, nothing written
+    mcu.flush()
+    assert len(ser.writes) == 3
+    assert (mcu.bytes_sent, mcu.writes, mcu.coalesced) == (4, 3, 5)
+
+
+def test_frame_replaced_until_sent(clock):
+    ser = _Serial()
+    mcu = rc.McuOutput(ser)
+    mcu.send_frame(0b1, (500,), received=999.9)
+    mcu.send_frame(0b11, (400,), received=999.95)
+    mcu.write(b'\x15')
+    mcu.flush()
+    assert len(ser.writes) == 1 and ser.writes[0][:1] == b'\x15'
+    frames, _ = rc.decode_obstacle_frames(ser.writes[0][1:])
+    # latest frame only, with the receive time of the oldest measure
+    assert frames == [rc.ObstacleFrame(1, 1000000 & 0xFFFF, 0b11, (400,))]
+    assert mcu.coalesced == 1
+    assert mcu.latency.max == pytest.approx(0.1)
+    # frames are sent every time, with the next sequence number
+    mcu.send_frame(0b11, (400,))
+    mcu.flush()
+    frames, _ = rc.decode_obstacle_frames(ser.writes[1])
+    assert [frame.seq for frame in frames] == [2]
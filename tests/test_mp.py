@@ -0,0 +1,37 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import RplidarA2M8_MP as mp
+from RplidarA2M8_RC import MEASURE_DTYPE
+
+
+def test_failed_stage_stops_pipeline():
+    # neither port can be opened, every stage must still exit
+    started = time.time()
+    mp.run('/nonexistent/lidar', '/nonexistent/mcu', slots=2, capacity=16)
+    assert time.time() - started < 10
+
+
+def test_classification_failure_sets_stop():
+    frames = mp.SharedRing(2, 16, MEASURE_DTYPE)
+    stop = multiprocessing.Event()
+    # stages leave Ctrl-C to the parent process
+    sigint = signal.getsignal(signal.SIGINT)
+
+    def publish():
+        frames.claim()[:1] = np.zeros(1, dtype=MEASURE_DTYPE)
+        frames.publish(1)
+    try:
+        # no results ring, classification fails on the first revolution
+        threading.Timer(0.1, publish).start()
+        with pytest.raises(AttributeError):
+            mp.classification(frames, None, stop)
+        assert stop.is_set()
+    finally:
+        signal.signal(signal.SIGINT, sigint)
+        frames.close()
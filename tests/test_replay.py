@@ -0,0 +1,52 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import RplidarA2M8_RC as rc
+import RplidarA2M8_Sim as sim
+from RplidarA2M8_Async import AsyncRPLidar
+from RplidarA2M8_Bench import write_capture
+
+MEASURES = 3000
+
+
+@pytest.fixture
+def capture(tmp_path):
+    angle = (np.arange(MEASURES) * 0.9) % 360
+    new_scan = np.r_[False, np.diff(angle) < 0]
+    quality = np.full(MEASURES, 47, dtype=np.uint8)
+    distance = np.full(MEASURES, 1500.)
+    path = str(tmp_path / 'session.rplcap')
+    write_capture(path, sim.encode_scan(new_scan, quality, angle, distance),
+                  'normal')
+    return path
+
+
+def _count(iterator, size=len):
+    count = 0
+    with pytest.raises(rc.RPLidarException, match='End of capture'):
+        for item in iterator:
+            count += size(item)
+    return count
+
+
+def test_replay_measures_to_the_end(capture):
+    lidar = rc.RPLidar(rc.ReplaySerial(capture))
+    assert _count(lidar.iter_measures(), lambda measure: 1) == MEASURES
+
+
+def test_replay_batches_to_the_end(capture):
+    lidar = rc.RPLidar(rc.ReplaySerial(capture))
+    assert _count(lidar.iter_measure_batches()) == MEASURES
+
+
+def test_async_replay_to_the_end(capture):
+    async def run():
+        count = 0
+        async with AsyncRPLidar(rc.ReplaySerial(capture)) as lidar:
+            with pytest.raises(rc.RPLidarException):
+                async for measures in lidar.iter_measure_batches():
+                    count += len(measures)
+        return count
+    assert asyncio.run(run()) == MEASURES
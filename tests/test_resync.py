@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import RplidarA2M8_RC as rc
+import RplidarA2M8_Sim as sim
+
+CAPSULES = [
+    ('express', sim.encode_express, 32, rc._process_express_batch),
+    ('ultra', sim.encode_ultra, 96, rc._process_ultra_batch),
+    ('dense', sim.encode_dense, 40, rc._process_dense_batch),
+]
+
+
+def _stream(encode, block, packets=40):
+    rng = np.random.RandomState(0)
+    return bytearray(encode(np.zeros(packets, dtype=bool),
+                            (np.arange(packets) * 3.) % 360,
+                            rng.uniform(500, 3000, (packets, block))))
+
+
+def _decode_in_chunks(decode, raw, chunk):
+    '''Decodes `raw` fed `chunk` bytes at a time, keeping the unconsumed
+    bytes like RPLidar.iter_measure_batches'''
+    pending = b''
+    count = skipped = 0
+    for i in range(0, len(raw), chunk):
+        data = pending + bytes(raw[i:i + chunk])
+        measures, consumed, dropped = decode(data)
+        pending = data[consumed:]
+        count += len(measures)
+        skipped += dropped
+    return count, skipped
+
+
+@pytest.mark.parametrize('scan_type,encode,block,decode', CAPSULES)
+def test_corrupted_capsule_skipped_once(scan_type, encode, block, decode):
+    size = rc._SCAN_TYPE[scan_type]['size']
+    raw = _stream(encode, block)
+    raw[10 * size + 20] ^= 0x55
+    for chunk in (size // 2, size - 1, size, size + 7, 3 * size + 5, 500,
+                  len(raw)):
+        count, skipped = _decode_in_chunks(decode, raw, chunk)
+        assert skipped == size, chunk
+        # the corrupted packet and the one before it, which can't be
+        # interpolated up to its successor, plus the last one
+        assert count == (40 - 3) * block, chunk
+
+
+@pytest.mark.parametrize('scan_type,encode,block,decode', CAPSULES)
+def test_clean_capsules_not_skipped(scan_type, encode, block, decode):
+    raw = _stream(encode, block)
+    for chunk in (50, 333, len(raw)):
+        assert _decode_in_chunks(decode, raw, chunk) == ((40 - 1) * block, 0)
+
+
+def test_corrupted_scan_packets_skipped_once():
+    rng = np.random.RandomState(0)
+    packets = 200
+    raw = bytearray(sim.encode_scan(
+        np.zeros(packets, dtype=bool), np.full(packets, 30, dtype=np.uint8),
+        np.arange(packets) * 1.8, rng.uniform(500, 3000, packets)))
+    # breaks the check bit of packet 50
+    raw[50 * 5 + 1] &= 0xFE
+    for chunk in (4, 5, 13, 64, len(raw)):
+        count, skipped = _decode_in_chunks(rc._process_scan_batch, raw,
+                                           chunk)
+        assert skipped == 5, chunk
+        assert count == packets - 1, chunk
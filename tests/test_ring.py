@@ -0,0 +1,82 @@
+import numpy as np
+
+import RplidarA2M8_RC as rc
+
+
+def _measures(first, count):
+    measures = np.zeros(count, dtype=rc.MEASURE_DTYPE)
+    measures['distance'] = np.arange(first, first + count)
+    return measures
+
+
+class _HookedData(np.ndarray):
+    '''Measures of a ring running `hook` once, in the middle of the next
+    copy out of it or write into it'''
+
+    def _run_hook(self):
+        hook = getattr(self, 'hook', None)
+        self.hook = None
+        if hook is not None:
+            hook()
+
+    def __getitem__(self, index):
+        out = np.asarray(self)[index]
+        self._run_hook()
+        return out
+
+    def __setitem__(self, index, value):
+        np.asarray(self)[index] = value
+        self._run_hook()
+
+
+def _hooked(ring, hook):
+    ring._data = ring._data.view(_HookedData)
+    ring._data.hook = hook
+
+
+def test_overrun_counted():
+    ring = rc.MeasureRing(4)
+    reader = rc.RingReader(ring)
+    for i in range(10):
+        ring.write(_measures(3 * i, 3))
+    measures = reader.read()
+    assert ring.written == reader.cursor == 30
+    assert measures['distance'].tolist() == [26, 27, 28, 29]
+    assert (reader.lost, reader.torn) == (26, 0)
+    assert ring.dropped == 0
+    # readers count their own losses
+    late = rc.RingReader(ring, cursor=20)
+    ring.write(_measures(30, 2))
+    assert reader.read()['distance'].tolist() == [30, 31]
+    assert late.read()['distance'].tolist() == [28, 29, 30, 31]
+    assert (reader.lost, late.lost) == (26, 8)
+
+
+def test_oversized_write():
+    ring = rc.MeasureRing(4)
+    ring.write(_measures(0, 10))
+    assert ring.written == 10
+    assert ring.dropped == 6
+    assert ring.latest(10)['distance'].tolist() == [6, 7, 8, 9]
+
+
+def test_copy_during_write():
+    ring = rc.MeasureRing(4)
+    ring.write(_measures(0, 4))
+    copies = []
+    # reader copies while the writer is halfway through the slots
+    _hooked(ring, lambda: copies.append(ring._copy(0, 4)))
+    ring.write(_measures(4, 2))
+    assert copies == [None]
+
+
+def test_write_during_copy():
+    ring = rc.MeasureRing(4)
+    ring.write(_measures(0, 4))
+    reader = rc.RingReader(ring)
+    _hooked(ring, lambda: ring.write(_measures(4, 4)))
+    measures = reader.read()
+    assert reader.cursor == 8
+    assert measures['distance'].tolist() == [4, 5, 6, 7]
+    assert (reader.lost, reader.torn) == (4, 1)
+    assert ring.dropped == 0
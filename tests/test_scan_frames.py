@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import RplidarA2M8_RC as rc
+import RplidarA2M8_Sim as sim
+from RplidarA2M8_Bench import write_capture
+
+STEP = 0.9
+PER_REV = 400
+
+
+@pytest.fixture
+def capture(tmp_path):
+    # half a revolution before the first new scan, then 4 revolutions,
+    # every one at its own distance
+    angle = (180 + np.arange(PER_REV // 2 + 4 * PER_REV) * STEP) % 360
+    new_scan = np.r_[False, np.diff(angle) < 0]
+    revolution = np.cumsum(new_scan)
+    distance = 1000. + 100 * revolution
+    quality = (10 + revolution).astype(np.uint8)
+    path = str(tmp_path / 'session.rplcap')
+    write_capture(path, sim.encode_scan(new_scan, quality, angle, distance),
+                  'normal')
+    return path
+
+
+def test_frames_double_buffered(capture):
+    lidar = rc.RPLidar(rc.ReplaySerial(capture))
+    frames = []
+    revolutions = []
+    with pytest.raises(rc.RPLidarException, match='End of capture'):
+        for frame in lidar.iter_frames(bins=720):
+            if frames:
+                # previous frame is still intact while the next one is used
+                previous = frames[-1]
+                assert previous is not frame
+                assert previous.revolution == frame.revolution - 1
+                assert previous.count == PER_REV
+                assert set(previous.distance[previous.distance > 0]) == {
+                    1100. + 100 * previous.revolution}
+            frames.append(frame)
+            revolutions.append(frame.revolution)
+            assert frame.count == PER_REV
+            assert set(frame.quality[frame.quality > 0]) == {
+                11 + frame.revolution}
+            # 400 measures in 720 bins: every other bin or so is empty
+            assert (frame.distance == 0).sum() == 720 - PER_REV
+    # the last revolution is never completed
+    assert revolutions == [0, 1, 2]
+    assert frames[0] is frames[2]
@@ -0,0 +1,112 @@
+import struct
+
+import pytest
+
+import RplidarA2M8_RC as rc
+
+# id, name, sample duration in us, max distance in m, answer type
+MODES = [
+    (0, 'Standard', 500., 12., 0x81),
+    (1, 'Express', 250., 12., 0x82),
+    (2, 'Boost', 125., 12., 0x84),
+    (3, 'Stability', 200., 12., 0x84),
+    # not decoded, skipped by auto
+    (4, 'Sensitivity', 62.5, 12., 0x86),
+]
+HEALTH = b'\xa5\x5a\x03\x00\x00\x00\x06' + b'\x00\x00\x00'
+
+
+def _conf(conf_type, data):
+    '''Answer of a configuration query'''
+    body = struct.pack('<I', conf_type) + data
+    return b'\xa5\x5a' + struct.pack('<IB', len(body), 0x20) + body
+
+
+def _discovery(modes):
+    '''Queries of the scan modes and their answers'''
+    exchanges = [(b'conf', _conf(0x70, struct.pack('<H', len(modes))))]
+    for mode, name, us_per_sample, max_distance, ans_type in modes:
+        exchanges += [
+            (b'conf', _conf(0x71, struct.pack('<I', int(us_per_sample * 256)))),
+            (b'conf', _conf(0x74, struct.pack('<I', int(max_distance * 256)))),
+            (b'conf', _conf(0x75, bytes([ans_type]))),
+            (b'conf', _conf(0x7F, name.encode('ascii') + b'\x00')),
+        ]
+    return exchanges
+
+
+def _start(size, response):
+    '''Health query and scan request, answered with the descriptor of the
+    scan'''
+    return [(b'health', HEALTH),
+            (b'scan', b'\xa5\x5a' + struct.pack('<IB', size | (1 << 30),
+                                                response))]
+
+
+class _Sensor(rc.ReplaySerial):
+    '''Replayed sensor keeping the bytes sent to it'''
+
+    def __init__(self, path):
+        super(_Sensor, self).__init__(path)
+        self.sent = []
+
+    def write(self, data):
+        self.sent.append(bytes(data))
+        return super(_Sensor, self).write(data)
+
+
+def _lidar(tmp_path, exchanges):
+    path = str(tmp_path / 'modes.rplcap')
+    with open(path, 'wb') as f:
+        f.write(rc.CAPTURE_MAGIC)
+        for request, answer in exchanges:
+            for direction, data in ((rc.CAPTURE_WRITE, request),
+                                    (rc.CAPTURE_READ, answer)):
+                f.write(rc.CAPTURE_RECORD.pack(0, direction, len(data)) + data)
+    sensor = _Sensor(path)
+    return rc.RPLidar(sensor, discover=True), sensor
+
+
+def test_scan_modes_discovered(tmp_path):
+    lidar, _ = _lidar(tmp_path, _discovery(MODES))
+    assert lidar.scan_modes == [rc.ScanMode(*mode) for mode in MODES]
+
+
+def test_auto_starts_fastest_decoded_mode(tmp_path):
+    lidar, sensor = _lidar(tmp_path,
+                           _discovery(MODES) + _start(132, 0x84))
+    lidar.start('auto')
+    assert lidar.scanning == [True, 132, 'ultra']
+    assert lidar.scan_mode.name == 'Boost'
+    # express scan request with working mode 2, checksum
+    # 0xA5 ^ 0x82 ^ 0x05 ^ 0x02 = 0x20
+    assert sensor.sent[-1] == b'\xa5\x82\x05\x02\x00\x00\x00\x00\x20'
+
+
+def test_start_named_mode(tmp_path):
+    lidar, sensor = _lidar(tmp_path,
+                           _discovery(MODES) + _start(132, 0x84))
+    lidar.start('Stability')
+    assert lidar.scanning == [True, 132, 'ultra']
+    assert sensor.sent[-1] == b'\xa5\x82\x05\x03\x00\x00\x00\x00\x21'
+
+
+def test_unsupported_modes_rejected(tmp_path):
+    # both are rejected once the sensor answered the health query
+    lidar, _ = _lidar(tmp_path,
+                      _discovery(MODES) + [(b'health', HEALTH)] * 2)
+    with pytest.raises(rc.RPLidarException, match='No dense scan mode'):
+        lidar.start('dense')
+    with pytest.raises(rc.RPLidarException, match='not supported'):
+        lidar.start('Sensitivity')
+
+
+def test_discovery_failure_falls_back_to_normal(tmp_path):
+    # firmware without configuration queries answers something else
+    lidar, sensor = _lidar(tmp_path, [(b'conf', HEALTH[:7])] +
+                           _start(5, 0x81))
+    assert lidar.scan_modes == []
+    lidar.start('auto')
+    assert lidar.scanning == [True, 5, 'normal']
+    assert lidar.scan_mode is None
+    assert sensor.sent[-1] == b'\xa5\x20'
@@ -0,0 +1,46 @@
+import numpy as np
+
+import RplidarA2M8_RC as rc
+
+
+def _measures(angle):
+    '''Measures of the angles in degrees, in sweep order, new_scan set when
+    the angle wraps around'''
+    angle = np.asarray(angle, dtype=float)
+    measures = np.zeros(len(angle), dtype=rc.MEASURE_DTYPE)
+    measures['new_scan'] = np.r_[False, np.diff(angle) < 0]
+    measures['quality'] = 47
+    measures['angle'] = angle
+    measures['angle_q6'] = np.round(angle * 64).astype(int) % rc.ANGLE_Q6_TURN
+    measures['distance'] = 1500
+    return measures
+
+
+def test_front_completes_past_its_end():
+    sweep = rc.SectorSweep(rc.ZoneClassifier())
+    measures = _measures(np.r_[340:360, 0:10] + 0.5)
+    assert sweep.split(measures[:10]) == []
+    # inside Front, across the start of the revolution
+    assert sweep.split(measures[10:]) == []
+    completed = sweep.split(_measures([10.5, 11.5]))
+    assert [name for name, _ in completed] == ['Front']
+    assert completed[0][1]['angle'].tolist() == measures['angle'][10:].tolist()
+
+
+def test_sectors_complete_once_per_revolution():
+    zones = rc.ZoneClassifier()
+    # 3 revolutions, one of the measures at 0 degree exactly
+    angle = np.tile(np.arange(0, 360, 0.9), 3)
+    measures = _measures(angle)
+    assert measures['new_scan'].sum() == 2
+    for chunk in (1, 7, 50, 400):
+        sweep = rc.SectorSweep(zones)
+        completed = []
+        for i in range(0, len(measures), chunk):
+            completed += sweep.split(measures[i:i + chunk])
+        names = [name for name, _ in completed]
+        # Front of the last revolution never ends
+        assert names == ['Front', 'Right', 'Back', 'Left'] * 3, chunk
+        front = [swept for name, swept in completed if name == 'Front']
+        assert len(front[1]) == len(front[2]) == 23
+        assert front[1]['new_scan'].sum() == front[2]['new_scan'].sum() == 1
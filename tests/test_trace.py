@@ -0,0 +1,47 @@
+import RplidarA2M8_RC as rc
+
+
+def _records(path):
+    '''Returns (time, direction, bytes) records of capture `path`'''
+    with open(path, 'rb') as f:
+        capture = f.read()
+    assert capture.startswith(rc.CAPTURE_MAGIC)
+    records = []
+    pos = len(rc.CAPTURE_MAGIC)
+    while pos < len(capture):
+        stamp, direction, length = rc.CAPTURE_RECORD.unpack_from(capture, pos)
+        pos += rc.CAPTURE_RECORD.size
+        records.append((stamp, direction, capture[pos:pos + length]))
+        pos += length
+    return records
+
+
+def test_dump_after_wraparound(tmp_path):
+    trace = rc.TraceRing(size=16, records=4)
+    chunks = [bytes(range(5 * i, 5 * i + 5)) for i in range(6)]
+    directions = [rc.CAPTURE_WRITE, rc.CAPTURE_READ] * 3
+    for i, (direction, data) in enumerate(zip(directions, chunks)):
+        trace.add(direction, data, stamp=100. + i)
+    assert (trace.count, trace.written) == (6, 30)
+    path = str(tmp_path / 'trace.rplcap')
+    trace.dump(path)
+    # 4 records are kept, the oldest of which has bytes overwritten
+    # already; the next one wraps around the end of the ring
+    assert _records(path) == [(0., directions[3], chunks[3]),
+                              (1., directions[4], chunks[4]),
+                              (2., directions[5], chunks[5])]
+
+
+def test_dump_oversized_and_partial(tmp_path):
+    trace = rc.TraceRing(size=16, records=4)
+    path = str(tmp_path / 'trace.rplcap')
+    trace.dump(path)
+    assert _records(path) == []
+    trace.add(rc.CAPTURE_WRITE, b'\xA5\x20', stamp=5.)
+    trace.add(rc.CAPTURE_READ, bytes(range(40)), stamp=6.)
+    trace.dump(path)
+    # only the last bytes of a read larger than the ring are kept
+    assert _records(path) == [(0., rc.CAPTURE_READ, bytes(range(24, 40)))]
+    trace.add(rc.CAPTURE_READ, b'\x01\x02', stamp=7.)
+    trace.dump(path)
+    assert _records(path) == [(0., rc.CAPTURE_READ, b'\x01\x02')]
@@ -0,0 +1,114 @@
+import numpy as np
+
+import RplidarA2M8_RC as rc
+
+
+def test_tracker_leaves_unseen_zones_unchanged():
+    tracker = rc.ZoneTracker((2, 3), confirm=2, release=1)
+    hit = np.ones((2, 3), dtype=bool)
+    distance = np.full((2, 3), 500, dtype=np.float32)
+    tracker.update(hit, distance)
+    seen = np.zeros((2, 3), dtype=bool)
+    seen[0] = True
+    confirmed, released = tracker.update(hit, distance, seen)
+    assert confirmed[0].all() and not confirmed[1].any()
+    assert tracker.hits[1].tolist() == [1, 1, 1]
+    # a miss of the other sector doesn't touch the confirmed one
+    seen = ~seen
+    confirmed, released = tracker.update(~hit, distance, seen)
+    assert not released.any()
+    assert tracker.confirmed[0].all() and not tracker.confirmed[1].any()
+    assert (tracker.distance[0] == 500).all()
+    assert (tracker.distance[1] == 0).all()
+
+
+def test_track_sector():
+    zones = rc.ZoneClassifier()
+    tracker = rc.ZoneTracker(zones.shape, confirm=1, release=1)
+    grid = rc.ObstacleGrid()
+    measures = np.zeros(1, dtype=rc.MEASURE_DTYPE)
+    measures['quality'] = 40
+    measures['distance'] = 1500
+    measures['angle'] = 5
+    measures['angle_q6'] = 5 * 64
+    front = zones.names.index('Front')
+    other = next(name for name in zones.names if name != 'Front')
+    zones.track(measures, tracker, grid)
+    assert tracker.confirmed[front].any()
+    # sweeping another sector doesn't release the front zone
+    zones.track(measures[:0], tracker, grid, sector=other)
+    assert tracker.confirmed[front].any()
+    zones.track(measures[:0], tracker, grid, sector='Front')
+    assert not tracker.confirmed[front].any()
+
+
+def _original_zone(angle, distance):
+    '''Sector name and zone index of a measure as classified by the
+    original if/elif chains of CA_SlotFront, CA_SlotLeft, CA_SlotRight and
+    CA_SlotBack, None if outside'''
+    if (350.0 < angle < 359.99999) or (0.0 < angle < 10.0):
+        sector = 'Front'
+    elif 260.0 < angle < 280.0:
+        sector = 'Left'
+    elif 80.0 < angle < 100.0:
+        sector = 'Right'
+    elif 172.0 < angle < 188.0:
+        sector = 'Back'
+    else:
+        return None
+    if not 200 < distance < 8000:
+        return None
+    for zone, bound in enumerate((1000, 2000, 3000, 4000, 5000, 6000, 7000,
+                                  8000)):
+        if distance < bound:
+            return sector, zone
+
+
+def test_classify_matches_original_bounds():
+    zones = rc.ZoneClassifier()
+    step = 1 / 64.
+    edges = (0, 10, 350, 80, 100, 172, 188, 260, 280, 360)
+    angle = np.array([edge + k * step for edge in edges for k in (-1, 0, 1)
+                      if 0 <= edge + k * step < 360] + [5, 90, 180, 270])
+    # distances are quantized to 1/4 mm
+    distance = np.array([edge + k * 0.25 for edge in (200, 1000, 8000)
+                         for k in (-1, 0, 1)] + [500, 4500])
+    angle, distance = [a.ravel() for a in np.meshgrid(angle, distance)]
+    sector, zone, inside = zones.classify(angle, distance)
+    for i in range(len(angle)):
+        expected = _original_zone(angle[i], distance[i])
+        got = ((zones.names[sector[i]], int(zone[i])) if inside[i]
+               else None)
+        assert got == expected, (angle[i], distance[i])
+
+
+class _Serial(object):
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+
+def test_slot_measure_matches_slot():
+    zones = rc.ZoneClassifier()
+    angle = np.arange(0, 360, 0.5) + 1 / 128.
+    distance = np.array([150, 999.75, 1000, 2500, 7999.75, 8000])
+    angle, distance = [a.ravel() for a in np.meshgrid(angle, distance)]
+    measures = np.zeros(len(angle), dtype=rc.MEASURE_DTYPE)
+    measures['angle'] = angle
+    measures['angle_q6'] = (angle * 64).astype(int)
+    measures['distance'] = distance
+    for sector in (None, 'Front', 'Back'):
+        grids = rc.ObstacleGrid(), rc.ObstacleGrid()
+        ports = _Serial(), _Serial()
+        for measure in measures:
+            zones.slot(measure[np.newaxis], grids[0], ports[0], sector)
+            zones.slot_measure(float(measure['angle']),
+                               float(measure['distance']), grids[1],
+                               ports[1], sector)
+        assert ports[0].data and ports[0].data == ports[1].data
+        assert (grids[0].distance == grids[1].distance).all()
+        assert (grids[0].dirty == grids[1].dirty).all()
+        assert grids[0].pop_dirty() == grids[1].pop_dirty()